@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+"""
+This script benchmarks every stage of the seasonal rainfall workflow on synthetic SILO like monthly rainfall grids, so
+the effect of a change on the run time and memory use can be measured without the rainfall archive.
+
+The synthetic grids are float32 GeoTIFFs on the SILO 0.05 degree Australian grid (841 x 681 pixels, EPSG:4326) with the
+nodata value -32767 over the ocean and gamma distributed rainfall with a wetter north. The grids can be scaled (e.g.
+--scales 0.5 1 2) to benchmark smaller or larger grids covering the same extent, a scale of 2 halves the cell size.
+
+The stages timed are;
+
+total      : the seasonal total of the monthly grids (total_rainfall.py)
+reproject  : the reprojection of the total to GDA94 / Australian Albers (reproject_raster_ea.py)
+clip       : the clip of the reprojected total to the NT boundary (clip_raster_nt_bnd_ea.py)
+percentile : the percentile score of the NT total against a synthetic history of seasonal totals (total_rain_percentileofscore.py)
+decile     : the conversion of the percentile score to decile ranks (perc_to_decile.py)
+workflow   : the end to end run of the stages above (rainfall_workflow.py, then the percentile and decile stages)
+
+The total, percentile and decile stages call the same entry points as the stage scripts, calc_total_rainfall,
+rios_percentile (or parallel_percentile with more than one worker) and perc_to_decile.rios_decile. If rios is not
+installed the total stage falls back to the in memory total_rainfall_array, the percentile stage to parallel_percentile
+and the decile stage to the rasterio decile_image below, the fallback is printed and saved in the results (rios false)
+so the times are not compared with a rios baseline by mistake.
+
+Each stage is run once to warm up, then repeat times, and the best time is reported with the throughput (input pixels
+and MB per second). The reprojection plans and boundary masks are cached in the work directory, so the warm up run
+builds them and is reported separately as the first time. The peak resident memory (RSS) of a stage is measured in a
+separate (untimed) run in a forked process, it is the peak of that process plus the largest of its worker processes (e.g.
+the parallel percentile workers), so it includes the memory of GDAL and the stage's children (not available on windows).
+
+The results can be saved as a baseline json file (--update) and later runs compared with it, any stage slower than
+the baseline by more than the tolerance is reported as a regression and the script exits with an error.
+
+Parameters:
+-----------
+
+scales : float
+            is one or more grid scales to benchmark, 1 is the SILO 0.05 degree grid (default 1).
+
+months : int
+            is the number of monthly grids in the season (default 7, e.g. October to April).
+
+years : int
+            is the number of historical seasonal totals the percentile score is calculated against (default 30).
+
+repeats : int
+            is the number of times each stage is run after the warm up run, the best time is reported (default 3).
+
+workers : int
+            is the number of processes used by the percentile stage (default 1).
+
+boundary : str
+            is the shapefile used to clip the total rainfall grid, the default is the NT boundary (clip_raster_nt_bnd_ea.NT_BND).
+
+workdir : str
+            is the directory for the synthetic grids and outputs, the default is a temporary directory removed at the end.
+
+output : str
+            is an optional json file name to write the results to.
+
+baseline : str
+            is an optional json file of earlier results to compare with.
+
+update : bool
+            if set the results are written to the baseline file.
+
+tolerance : float
+            is the fraction a stage can be slower than the baseline before it is reported as a regression (default 0.25).
+
+"""
+
+from __future__ import print_function, division
+import sys
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import multiprocessing
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+import total_rainfall
+import reproject_raster_ea
+import clip_raster_nt_bnd_ea
+import total_rain_percentileofscore
+import perc_to_decile
+import rainfall_workflow
+import output_policy
+import run_report
+
+# the SILO 0.05 degree Australian grid
+SILO_ORIGIN = (111.975, -9.975)
+SILO_CELL = 0.05
+SILO_SHAPE = (681, 841)
+SILO_NODATA = -32767
+
+STAGES = ('total', 'reproject', 'clip', 'percentile', 'decile', 'workflow')
+
+# the RIOS total, percentile and decile stages are timed when rios is installed
+RIOS = total_rain_percentileofscore.applier is not None
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("-s","--scales", type=float, nargs='+', default=[1.0], help="grid scales to benchmark, 1 is the SILO 0.05 degree grid")
+
+    p.add_argument("-m","--months", type=int, default=7, help="number of monthly grids in the season (default 7)")
+
+    p.add_argument("-y","--years", type=int, default=30, help="number of historical seasonal totals for the percentile stage (default 30)")
+
+    p.add_argument("-r","--repeats", type=int, default=3, help="number of times each stage is run after the warm up run, the best time is reported (default 3)")
+
+    p.add_argument("-w","--workers", type=int, default=1, help="number of processes used by the percentile stage (default 1)")
+
+    p.add_argument("-b","--boundary", default=clip_raster_nt_bnd_ea.NT_BND, help="shapefile used to clip the total rainfall grid")
+
+    p.add_argument("-d","--workdir", help="directory for the synthetic grids and outputs (default a temporary directory)")
+
+    p.add_argument("-o","--output", help="json file to write the results to")
+
+    p.add_argument("--baseline", help="json file of earlier results to compare with")
+
+    p.add_argument("--update", action="store_true", help="write the results to the baseline file")
+
+    p.add_argument("-t","--tolerance", type=float, default=0.25, help="fraction a stage can be slower than the baseline (default 0.25)")
+
+    cmdargs = p.parse_args()
+
+    return cmdargs
+
+
+def silo_profile(scale=1.0):
+
+    """
+    returns the rasterio profile of the SILO grid with the cell size divided by scale
+    """
+    cell = SILO_CELL / scale
+    rows, cols = int(round(SILO_SHAPE[0] * scale)), int(round(SILO_SHAPE[1] * scale))
+    west, north = SILO_ORIGIN[0] - SILO_CELL / 2.0, SILO_ORIGIN[1] + SILO_CELL / 2.0
+
+    return {'driver': 'GTiff', 'dtype': 'float32', 'nodata': SILO_NODATA, 'width': cols, 'height': rows, 'count': 1,
+            'crs': 'EPSG:4326', 'transform': from_origin(west, north, cell, cell),
+            'compress': 'lzw', 'tiled': True, 'blockxsize': 256, 'blockysize': 256}
+
+
+def land_mask(profile):
+
+    """
+    a smooth continent shaped mask covering the centre of the grid, the pixels outside it are nodata
+    """
+    transform = profile['transform']
+    lon = transform.c + (np.arange(profile['width']) + 0.5) * transform.a
+    lat = transform.f + (np.arange(profile['height']) + 0.5) * transform.e
+    lon, lat = np.meshgrid(lon, lat)
+
+    # an ellipse with a wavy coast line
+    angle = np.arctan2(lat + 26.0, lon - 134.0)
+    radius = 1.0 + 0.06 * np.sin(5 * angle) + 0.04 * np.cos(11 * angle)
+
+    return ((lon - 134.0) / 20.0) ** 2 + ((lat + 26.0) / 15.5) ** 2 <= radius ** 2
+
+
+def synthetic_months(workdir, profile, months, seed=0):
+
+    """
+    Write the synthetic monthly rainfall grids (e.g. 202010.monthly_rain.tif) to workdir, the rainfall is
+    gamma distributed with a mean falling from the north to the south. Returns the list of file names.
+    """
+    rng = np.random.default_rng(seed)
+    land = land_mask(profile)
+
+    transform = profile['transform']
+    lat = transform.f + (np.arange(profile['height']) + 0.5) * transform.e
+    mean = np.interp(lat, [-44, -30, -20, -10], [40, 25, 60, 250])[:, None]
+
+    listimg = []
+    for i in range(months):
+        year, month = 2020 + (9 + i) // 12, (9 + i) % 12 + 1
+        rain = np.round(rng.gamma(0.8, mean / 0.8, size=(profile['height'], profile['width'])), 1).astype(np.float32)
+        rain[~land] = SILO_NODATA
+
+        img = os.path.join(workdir, '%04d%02d.monthly_rain.tif' % (year, month))
+        with rasterio.open(img, 'w', **profile) as dst:
+            dst.write(rain, 1)
+        listimg.append(img)
+
+    return listimg
+
+
+def synthetic_history(workdir, img, years, policy=output_policy.DEFAULT_POLICY, seed=1):
+
+    """
+    Write a history of synthetic seasonal totals on the grid of img (the NT total) by scaling img with a
+    random factor for each year. Returns the list of file names.
+    """
+    rng = np.random.default_rng(seed)
+
+    with rasterio.open(img) as src:
+        profile = src.profile.copy()
+        total = src.read(1).astype(np.float64)
+        nodata = total == src.nodata if src.nodata is not None else np.zeros(total.shape, dtype=bool)
+
+    listimg = []
+    for year in range(years):
+        season = total * rng.gamma(8.0, 1 / 8.0) * rng.gamma(20.0, 1 / 20.0, size=total.shape)
+        name = os.path.join(workdir, 'NT_%04d%04d_total_rainfall_a2.tif' % (1990 + year, 1991 + year))
+        with rasterio.open(name, 'w', **profile) as dst:
+            dst.write(output_policy.encode(season, nodata, 'total', policy), 1)
+        listimg.append(name)
+
+    return listimg
+
+
+def decile_image(inImage, output, policy=output_policy.DEFAULT_POLICY):
+
+    """
+    convert the percentile score raster to decile ranks as perc_to_decile.py does, using rasterio (the fallback
+    decile stage when rios is not installed)
+    """
+    with rasterio.open(inImage) as src:
+        profile = src.profile.copy()
+        perc = output_policy.decode(src.read(1), src.nodata, src.scales[0])
+
+    decile = perc_to_decile.decile_from_percentile(perc)
+    rule = output_policy.stage_policy('decile', policy)
+    profile.update({'dtype': rule['dtype'], 'nodata': rule['nodata']})
+
+    with rasterio.open(output, 'w', **output_policy.cog_profile(profile, 'decile')) as dst:
+        dst.write(output_policy.encode(decile, decile == -1, 'decile', policy), 1)
+
+
+def grid_size(img):
+
+    """
+    returns the number of pixels and the number of bytes (uncompressed) of the raster image
+    """
+    with rasterio.open(img) as src:
+        pixels = src.width * src.height * src.count
+
+        return pixels, pixels * np.dtype(src.dtypes[0]).itemsize
+
+
+def total_stage(listimg, outfile):
+
+    """
+    run the total stage as total_rainfall.py does (calc_total_rainfall, or total_rainfall_array and
+    rainfall_workflow.write_raster without rios)
+    """
+    if RIOS:
+        total_rainfall.calc_total_rainfall(listimg, outfile)
+    else:
+        Total_rainfall, total_profile = total_rainfall.total_rainfall_array(listimg)
+        rainfall_workflow.write_raster(outfile, Total_rainfall, total_profile)
+
+
+def percentile_stage(history, img, outfile, workers=1):
+
+    """
+    run the percentile stage as total_rain_percentileofscore.py does (rios_percentile, or parallel_percentile
+    with more than one worker or without rios)
+    """
+    if RIOS and workers <= 1:
+        total_rain_percentileofscore.rios_percentile(history, img, outfile)
+    else:
+        total_rain_percentileofscore.parallel_percentile(history, img, outfile, workers=workers)
+
+
+def decile_stage(inImage, output):
+
+    """
+    run the decile stage as perc_to_decile.py does (rios_decile, or decile_image without rios)
+    """
+    if RIOS:
+        perc_to_decile.rios_decile(inImage, output)
+    else:
+        decile_image(inImage, output)
+
+
+def stage_peak_rss(func):
+
+    """
+    Run the stage once in a forked process and return the peak resident memory in MB of the process plus the
+    largest of its worker processes, or None where the peak resident memory or fork is not available.
+    """
+    if run_report.resource is None or 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+
+    def run():
+        func()
+        usage = [run_report.resource.getrusage(who).ru_maxrss for who in (run_report.resource.RUSAGE_SELF, run_report.resource.RUSAGE_CHILDREN)]
+        sender.send(sum(usage))
+
+    process = context.Process(target=run)
+    process.start()
+    sender.close()
+    try:
+        peak = receiver.recv()
+    except EOFError:
+        raise RuntimeError('the stage failed in the memory measurement run (exit code ' + str(process.exitcode) + ')')
+    finally:
+        process.join()
+
+    # ru_maxrss is in bytes on macOS and KB elsewhere
+    unit = 1.0 if sys.platform == 'darwin' else 1024.0
+
+    return peak * unit / 1024.0 / 1024.0
+
+
+def time_stage(func, repeats, pixels, nbytes):
+
+    """
+    Run the stage once to warm up, then repeat times and once more in a forked process to measure its peak 
+    resident memory (see stage_peak_rss). Returns the best and first (warm up) time in seconds, the throughput 
+    of the best time and the peak memory in MB.
+    """
+    start = time.perf_counter()
+    func()
+    first = time.perf_counter() - start
+
+    times = []
+    for i in range(max(repeats, 1)):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    peak = stage_peak_rss(func)
+
+    best = min(times)
+
+    return {'seconds': best, 'first_seconds': first,
+            'pixels_per_s': pixels / best if best > 0 else None,
+            'mb_per_s': nbytes / 1024.0 / 1024.0 / best if best > 0 else None,
+            'peak_mb': peak}
+
+
+def benchmark_scale(scale, workdir, months, years, repeats, workers, inshp):
+
+    """
+    Create the synthetic grids for the scale and time every stage. Returns a dictionary of the stage results.
+    """
+    griddir = os.path.join(workdir, 'scale_%g' % scale)
+    if not os.path.exists(griddir):
+        os.makedirs(griddir)
+
+    plan_cache = os.path.join(workdir, 'reprojection_plans')
+    mask_cache = os.path.join(workdir, 'boundary_masks')
+
+    profile = silo_profile(scale)
+    listimg = synthetic_months(griddir, profile, months)
+
+    total = os.path.join(griddir, 'AU_total_rainfall.tif')
+    repro = total[:-4] + '_a2.tif'
+    nt = os.path.join(griddir, 'NT_total_rainfall_a2.tif')
+    perc = os.path.join(griddir, 'NT_perc_rainfall_a2.tif')
+    decile = os.path.join(griddir, 'NT_decile_rainfall_a2.tif')
+
+    def workflow_stage():
+        nt_out = rainfall_workflow.run_season(listimg, os.path.join(griddir, 'AU_workflow.tif'), os.path.join(griddir, 'NT_workflow_a2.tif'),
+                                              inshp, cache_dir=plan_cache)
+        percentile_stage(history, nt_out, perc, workers)
+        decile_stage(perc, decile)
+
+    stages = {}
+    month_pixels, month_bytes = grid_size(listimg[0])
+
+    stages['total'] = time_stage(lambda: total_stage(listimg, total), repeats, month_pixels * months, month_bytes * months)
+    stages['reproject'] = time_stage(lambda: reproject_raster_ea.reproject_image(total, repro, cache_dir=plan_cache), repeats, *grid_size(total))
+    stages['clip'] = time_stage(lambda: clip_raster_nt_bnd_ea.clip_image(repro, nt, inshp, mask_cache), repeats, *grid_size(repro))
+
+    history = synthetic_history(griddir, nt, years)
+    nt_pixels, nt_bytes = grid_size(nt)
+    stages['percentile'] = time_stage(lambda: percentile_stage(history, nt, perc, workers),
+                                      repeats, nt_pixels * (years + 1), nt_bytes * (years + 1))
+    stages['decile'] = time_stage(lambda: decile_stage(perc, decile), repeats, *grid_size(perc))
+
+    stages['workflow'] = time_stage(workflow_stage, repeats, month_pixels * months + nt_pixels * (years + 1),
+                                    month_bytes * months + nt_bytes * (years + 1))
+
+    return {'grid': {'width': profile['width'], 'height': profile['height'], 'months': months, 'years': years}, 'stages': stages}
+
+
+def compare(results, baseline, tolerance=0.25):
+
+    """
+    Compare the stage times with the baseline. Returns the list of (grid, stage, ratio) of the stages
+    slower than the baseline by more than the tolerance.
+    """
+    regressions = []
+
+    if baseline.get('rios', results['rios']) != results['rios']:
+        print ('warning: the baseline was ' + ('' if baseline['rios'] else 'not ') + 'run with rios, the total, percentile and decile stages are not comparable')
+
+    for label, result in sorted(results['grids'].items()):
+        base = baseline.get('grids', {}).get(label)
+        if base is None:
+            print (label + ' is not in the baseline')
+            continue
+
+        for stage in STAGES:
+            if stage not in result['stages'] or stage not in base['stages']:
+                continue
+            ratio = result['stages'][stage]['seconds'] / base['stages'][stage]['seconds']
+            flag = 'REGRESSION' if ratio > 1 + tolerance else ''
+            print ('%-10s %-10s %8.3f s  baseline %8.3f s  %5.2fx  %s' % (label, stage, result['stages'][stage]['seconds'],
+                                                                       base['stages'][stage]['seconds'], ratio, flag))
+            if flag:
+                regressions.append((label, stage, ratio))
+
+    return regressions
+
+
+def print_results(results):
+
+    if not results['rios']:
+        print ('rios is not installed, the total stage was timed with total_rainfall_array, the percentile stage with parallel_percentile and the decile stage with decile_image')
+
+    print ('%-10s %-10s %10s %10s %14s %10s %10s' % ('grid', 'stage', 'best s', 'first s', 'pixels/s', 'MB/s', 'peak MB'))
+    for label, result in sorted(results['grids'].items()):
+        for stage in STAGES:
+            r = result['stages'][stage]
+            print ('%-10s %-10s %10.3f %10.3f %14.0f %10.1f %10.1f' % (label, stage, r['seconds'], r['first_seconds'],
+                                                                     r['pixels_per_s'] or 0, r['mb_per_s'] or 0, r['peak_mb'] or 0))
+
+
+def write_json(results, path):
+
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def mainRoutine():
+
+    """Run mainRoutine"""
+
+    cmdargs = getCmdargs()
+
+    workdir = cmdargs.workdir if cmdargs.workdir is not None else tempfile.mkdtemp(prefix='rainfall_benchmark_')
+
+    results = {'python': platform.python_version(), 'numpy': np.__version__, 'rasterio': rasterio.__version__,
+               'machine': platform.machine(), 'cpus': os.cpu_count(), 'repeats': cmdargs.repeats, 'rios': RIOS, 'grids': {}}
+
+    if not RIOS:
+        print ('rios is not installed, falling back to total_rainfall_array, parallel_percentile and the rasterio decile_image for the total, percentile and decile stages')
+
+    try:
+        for scale in cmdargs.scales:
+            label = 'scale_%g' % scale
+            results['grids'][label] = benchmark_scale(scale, workdir, cmdargs.months, cmdargs.years, cmdargs.repeats,
+                                                      cmdargs.workers, cmdargs.boundary)
+    finally:
+        if cmdargs.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+
+    if cmdargs.output is not None:
+        write_json(results, cmdargs.output)
+
+    regressions = []
+    if cmdargs.baseline is not None and os.path.exists(cmdargs.baseline) and not cmdargs.update:
+        with open(cmdargs.baseline) as f:
+            regressions = compare(results, json.load(f), cmdargs.tolerance)
+
+    if cmdargs.baseline is not None and cmdargs.update:
+        write_json(results, cmdargs.baseline)
+        print ('baseline saved to ' + cmdargs.baseline)
+
+    if regressions:
+        print (str(len(regressions)) + ' stages are slower than the baseline')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    mainRoutine()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Choose the block (window) size of the RIOS and block based stages from a memory budget, the number of input layers
+and their data type, instead of a fixed 256 x 256 window.
+
+The memory used by a block is estimated per pixel: every input layer is read into the block and copied into the
+(time, rows, cols) stack (two copies of the data type) with the boolean valid and comparison masks of the percentile
+engine (three bytes), plus a fixed number of float64 working arrays (the counts, percentile and encoded output) for
+every pixel. The largest window within the budget is used, so the decile stage (a single layer) reads the whole
+grid in one block while a deep history (e.g. 130 seasonal totals) is read in strips of whole rows, or in square
+windows if a strip of 256 rows does not fit. Stages with more working arrays per layer (e.g. the sorted history of the
+percentile series, see percentile_series.py) pass their own bytes per pixel of each layer (layer_bytes). The window
+height (and width of square windows) is a multiple of 256 rows where possible so the windows line up with the tiles of
+the outputs (see output_policy.py).
+
+The chosen plan is printed, e.g.
+
+block plan: 841 x 512 pixel windows (2 blocks) for 130 layers of uint16, about 413.1 MB per block (budget 512 MB)
+
+"""
+
+from __future__ import print_function, division
+import math
+import collections
+import numpy as np
+import rasterio
+
+# default memory budget of a block in MB
+DEFAULT_MEMORY_MB = 512
+
+# the windows are aligned with the 256 x 256 tiles of the outputs
+BLOCK_ALIGN = 256
+
+# smallest window side used for very deep stacks, even if it exceeds the budget
+MIN_BLOCK = 64
+
+# bytes per pixel of each layer in addition to the two copies of the data (the valid and comparison masks)
+LAYER_OVERHEAD = 3
+
+# bytes per pixel of the float64 working arrays (counts, percentile score and encoded output)
+PIXEL_OVERHEAD = 96
+
+BlockPlan = collections.namedtuple('BlockPlan', ['xsize', 'ysize', 'nblocks', 'block_mb'])
+
+
+def add_arguments(p):
+
+    """
+    add the --memory option to the argument parser of a script
+    """
+    p.add_argument("--memory", type=float, default=DEFAULT_MEMORY_MB, help="memory budget of a block in MB, sets the window size (default %(default)s)")
+
+
+def pixel_bytes(nlayers, dtype, layer_bytes=None):
+
+    """
+    returns the estimated memory used by a pixel of a block with nlayers input layers of the data type, layer_bytes
+    is the memory of each layer if the stage uses more than the two copies of the data and masks
+    """
+    if layer_bytes is None:
+        layer_bytes = 2 * np.dtype(dtype).itemsize + LAYER_OVERHEAD
+
+    return nlayers * layer_bytes + PIXEL_OVERHEAD
+
+
+def align(size, limit):
+
+    """
+    round size down to a multiple of BLOCK_ALIGN (or MIN_BLOCK for sizes smaller than BLOCK_ALIGN), at most limit
+    """
+    step = BLOCK_ALIGN if size >= BLOCK_ALIGN else MIN_BLOCK
+
+    return int(min(limit, max(MIN_BLOCK, size // step * step)))
+
+
+def plan_blocks(width, height, nlayers, dtype, memory_mb=DEFAULT_MEMORY_MB, layer_bytes=None):
+
+    """
+    Choose the window size for a grid of width x height pixels with nlayers input layers of the data type so
+    a block uses less than memory_mb (see pixel_bytes for layer_bytes). Returns a BlockPlan (window width and 
+    height, number of blocks and the estimated MB per block).
+    """
+    perPixel = pixel_bytes(nlayers, dtype, layer_bytes)
+    budget = max(1, int(memory_mb * 1024 * 1024 // perPixel))
+
+    if width * height <= budget:
+        # the whole grid in a single block
+        xsize, ysize = width, height
+    elif width * min(height, BLOCK_ALIGN) <= budget:
+        # strips of whole rows
+        xsize, ysize = width, align(budget // width, height)
+    else:
+        side = int(math.sqrt(budget))
+        xsize, ysize = align(side, width), align(side, height)
+
+    nblocks = int(math.ceil(width / xsize) * math.ceil(height / ysize))
+
+    return BlockPlan(xsize, ysize, nblocks, xsize * ysize * perPixel / 1024.0 / 1024.0)
+
+
+def image_plan(img, nlayers, memory_mb=DEFAULT_MEMORY_MB, dtype=None, layer_bytes=None):
+
+    """
+    returns the BlockPlan for the grid of img with nlayers input layers (of the data type of img unless
+    dtype is given, see pixel_bytes for layer_bytes) and prints it
+    """
+    with rasterio.open(img) as src:
+        width, height = src.width, src.height
+        dtype = dtype or src.dtypes[0]
+
+    plan = plan_blocks(width, height, nlayers, dtype, memory_mb, layer_bytes)
+
+    print ('block plan: %d x %d pixel windows (%d blocks) for %d layers of %s, about %.1f MB per block (budget %g MB)'
+           % (plan.xsize, plan.ysize, plan.nblocks, nlayers, dtype, plan.block_mb, memory_mb))
+    if plan.block_mb > memory_mb:
+        print ('warning: the smallest window (' + str(MIN_BLOCK) + ' pixels) exceeds the memory budget')
+
+    return plan
+
+
+def set_windows(controls, plan):
+
+    """
+    set the window size of the RIOS applier controls to the plan
+    """
+    controls.setWindowXsize(plan.xsize)
+    controls.setWindowYsize(plan.ysize)
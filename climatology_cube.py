@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+"""
+This script builds and maintains a pre-sorted climatology cube of the historical seasonal total rainfall grids
+(e.g. NT_*_total_rainfall_a2.tif) so a new season can be scored without re-reading the full history.
+
+The cube is saved in a directory containing:
+
+sorted.npy  : float32 array (rows, cols, layers) holding the sorted history for every pixel; nodata values are
+              stored as nan at the end of each pixel's history so the array can be memory mapped and searched.
+count.npy   : uint16 array (rows, cols) with the number of valid historical values for each pixel.
+cube.json   : sidecar with the grid (geotransform, projection, size), the nodata value and the list of seasons.
+
+There are three commands;
+
+build  : stacks the list of seasonal total rainfall grids and saves the sorted cube.
+append : inserts a newly finished season into the sorted cube without rebuilding it.
+score  : calculates the percentile score of a seasonal total against the cube using a binary search per pixel.
+
+Parameters:
+-----------
+
+cube : str
+            is the directory containing (or to contain) the climatology cube.
+
+imglist : str
+            (build) is a string to name of the txt file or csv file containing the list of seasonal rainfall grids.
+
+img : str
+            (append, score) is a string containing the name of the seasonal total rainfall grid.
+
+outfile : str
+            (score) is a name of the output percentile score image following the naming convetion: NT_201805201904_perc_rainfall_a2.tif.
+
+kind : str
+            (score) is the percentile definition (rank, weak, strict or mean) used to rank the score, the default is rank.
+
+policy : str
+            (score) is the output data type policy (see output_policy.py), the default writes the score as uint16 
+            hundredths of a percent.
+
+"""
+
+from __future__ import print_function, division
+import sys
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from osgeo import gdal
+import percentile_rank
+import output_policy
+import run_report
+
+SORTED_NAME = 'sorted.npy'
+COUNT_NAME = 'count.npy'
+SIDECAR_NAME = 'cube.json'
+
+# number of rows read from the rasters at a time
+STRIP_ROWS = 256
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    sub = p.add_subparsers(dest="command")
+
+    b = sub.add_parser("build", help="build the sorted climatology cube from a list of seasonal total rainfall grids")
+    b.add_argument("-l","--imglist", required=True, help="input list of imagery to stack, should be a pandas df without a header")
+    b.add_argument("-c","--cube", required=True, help="output directory for the climatology cube")
+
+    a = sub.add_parser("append", help="insert a newly finished season into the climatology cube")
+    a.add_argument("-i","--img", required=True, help="seasonal total rainfall grid to add to the cube")
+    a.add_argument("-c","--cube", required=True, help="directory containing the climatology cube")
+
+    s = sub.add_parser("score", help="calculate the percentile score of a seasonal total against the climatology cube")
+    s.add_argument("-i","--img", required=True, help="input imagery to calculate the percentile score")
+    s.add_argument("-c","--cube", required=True, help="directory containing the climatology cube")
+    s.add_argument("-o","--outfile", required=True, help="name of the output percentile score image")
+    s.add_argument("-k","--kind", default='rank', choices=percentile_rank.KINDS, help="percentile definition used to rank the score (default rank)")
+    s.add_argument("--policy", default=output_policy.DEFAULT_POLICY, choices=sorted(output_policy.POLICIES), help="output data type policy (see output_policy.py)")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.command is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def read_grid(ds):
+
+    """
+    returns the grid definition of a gdal dataset
+    """
+    return {'geotransform': list(ds.GetGeoTransform()),
+            'projection': ds.GetProjection(),
+            'rows': ds.RasterYSize,
+            'cols': ds.RasterXSize}
+
+
+def check_grid(grid, ds, name):
+
+    """
+    raise an error if the dataset is not on the same grid as the cube
+    """
+    other = read_grid(ds)
+
+    if (other['rows'], other['cols']) != (grid['rows'], grid['cols']) or \
+            not np.allclose(other['geotransform'], grid['geotransform']):
+        raise ValueError(name + ' is not on the same grid as the climatology cube')
+
+
+def read_strip(ds, row, nrows):
+
+    """
+    read a strip of rows from the first band as float32 with the nodata values replaced with nan
+    """
+    band = ds.GetRasterBand(1)
+    data = band.ReadAsArray(0, row, ds.RasterXSize, nrows).astype(np.float32)
+
+    nullValue = band.GetNoDataValue()
+    if nullValue is not None:
+        data[~percentile_rank.valid_mask(data, nullValue)] = np.nan
+
+    return data
+
+
+def read_sidecar(cube):
+
+    with open(os.path.join(cube, SIDECAR_NAME)) as f:
+        return json.load(f)
+
+
+def write_sidecar(cube, sidecar):
+
+    tmp = os.path.join(cube, SIDECAR_NAME + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(sidecar, f, indent=1)
+    os.replace(tmp, os.path.join(cube, SIDECAR_NAME))
+
+
+def open_cube(cube):
+
+    """
+    open the sorted history and valid count arrays as read only memory maps along with the sidecar, raises a
+    ValueError if they do not agree (e.g. an append interrupted between replacing the files)
+    """
+    sidecar = read_sidecar(cube)
+    sortedStack = np.load(os.path.join(cube, SORTED_NAME), mmap_mode='r')
+    count = np.load(os.path.join(cube, COUNT_NAME), mmap_mode='r')
+
+    if sortedStack.shape != (sidecar['rows'], sidecar['cols'], sidecar['layers']) or count.shape != sortedStack.shape[:2]:
+        raise ValueError(cube + ' has ' + str(sortedStack.shape[-1]) + ' sorted layers and ' + str(sidecar['layers'])
+                         + ' seasons in the sidecar, the climatology cube is incomplete and needs to be built again')
+
+    return sortedStack, count, sidecar
+
+
+def build_cube(listimg, cube):
+
+    """
+    Stack the seasonal total rainfall grids, sort the history of every pixel and save it as the climatology cube
+    """
+    if not os.path.exists(cube):
+        os.makedirs(cube)
+
+    datasets = [gdal.Open(img) for img in listimg]
+    for ds, img in zip(datasets, listimg):
+        if ds is None:
+            raise IOError('unable to open ' + img)
+
+    grid = read_grid(datasets[0])
+    for ds, img in zip(datasets, listimg):
+        check_grid(grid, ds, img)
+
+    rows, cols, layers = grid['rows'], grid['cols'], len(datasets)
+
+    sortedStack = np.lib.format.open_memmap(os.path.join(cube, SORTED_NAME), mode='w+', dtype=np.float32, shape=(rows, cols, layers))
+    count = np.lib.format.open_memmap(os.path.join(cube, COUNT_NAME), mode='w+', dtype=np.uint16, shape=(rows, cols))
+
+    for row in range(0, rows, STRIP_ROWS):
+        nrows = min(STRIP_ROWS, rows - row)
+
+        # stack the strip with time as the last axis, np.sort places the nan (nodata) values at the end
+        strip = np.stack([read_strip(ds, row, nrows) for ds in datasets], axis=-1)
+        sortedStack[row:row + nrows] = np.sort(strip, axis=-1)
+        count[row:row + nrows] = np.count_nonzero(~np.isnan(strip), axis=-1)
+
+    sortedStack.flush()
+    count.flush()
+
+    sidecar = dict(grid)
+    sidecar.update({'nodata': datasets[0].GetRasterBand(1).GetNoDataValue(),
+                    'layers': layers,
+                    'seasons': [os.path.basename(img) for img in listimg]})
+    write_sidecar(cube, sidecar)
+
+    print (cube + ' climatology cube built from ' + str(layers) + ' seasons')
+
+
+def append_season(img, cube):
+
+    """
+    Insert a newly finished season into the sorted cube. Each pixel's new value is merged into its sorted
+    history so the historical grids do not need to be read or sorted again.
+    """
+    sortedStack, count, sidecar = open_cube(cube)
+
+    name = os.path.basename(img)
+    if name in sidecar['seasons']:
+        raise ValueError(name + ' is already in the climatology cube')
+
+    ds = gdal.Open(img)
+    if ds is None:
+        raise IOError('unable to open ' + img)
+    check_grid(sidecar, ds, img)
+
+    rows, cols, layers = sortedStack.shape
+
+    newSorted = np.lib.format.open_memmap(os.path.join(cube, SORTED_NAME + '.tmp'), mode='w+', dtype=np.float32, shape=(rows, cols, layers + 1))
+    newCount = np.array(count, dtype=np.uint16)
+
+    k = np.arange(layers + 1)
+
+    for row in range(0, rows, STRIP_ROWS):
+        nrows = min(STRIP_ROWS, rows - row)
+
+        value = read_strip(ds, row, nrows)
+        history = np.array(sortedStack[row:row + nrows])
+        stripCount = newCount[row:row + nrows]
+        valid = ~np.isnan(value)
+
+        # insert after any equal values, nodata values go to the end with the other nan values
+        pos = searchsorted_stack(history, stripCount, value, side='right')
+        pos[~valid] = layers
+
+        source = np.where(k < pos[..., None], k, k - 1)
+        merged = np.take_along_axis(history, np.clip(source, 0, layers - 1), axis=-1)
+        merged[k == pos[..., None]] = np.broadcast_to(value[..., None], merged.shape)[k == pos[..., None]]
+
+        newSorted[row:row + nrows] = merged
+        stripCount[valid] += 1
+
+    newSorted.flush()
+    del newSorted, sortedStack, count
+
+    # every file is written in full before it replaces the old one, the sidecar last, so an interrupted append
+    # leaves either the old cube or files open_cube reports as not agreeing
+    with open(os.path.join(cube, COUNT_NAME + '.tmp'), 'wb') as f:
+        np.save(f, newCount)
+
+    os.replace(os.path.join(cube, SORTED_NAME + '.tmp'), os.path.join(cube, SORTED_NAME))
+    os.replace(os.path.join(cube, COUNT_NAME + '.tmp'), os.path.join(cube, COUNT_NAME))
+
+    sidecar['layers'] = layers + 1
+    sidecar['seasons'].append(name)
+    write_sidecar(cube, sidecar)
+
+    print (name + ' has been added to the climatology cube')
+
+
+def searchsorted_stack(sortedStack, count, values, side='left'):
+
+    """
+    Binary search for every pixel at once. sortedStack is a (rows, cols, layers) array sorted along the last axis
+    where only the first count values of each pixel are valid. Returns the index where each value would be
+    inserted to keep the pixel's valid history sorted, i.e. the number of values less than (side='left') or
+    less than or equal to (side='right') the value.
+    """
+    lo = np.zeros(values.shape, dtype=np.int64)
+    hi = np.asarray(count, dtype=np.int64).copy()
+    layers = sortedStack.shape[-1]
+
+    if layers == 0:
+        return lo
+
+    active = lo < hi
+    while np.any(active):
+        mid = (lo + hi) // 2
+        midValue = np.take_along_axis(sortedStack, np.minimum(mid, layers - 1)[..., None], axis=-1)[..., 0]
+
+        if side == 'left':
+            goRight = midValue < values
+        else:
+            goRight = midValue <= values
+
+        lo = np.where(active & goRight, mid + 1, lo)
+        hi = np.where(active & ~goRight, mid, hi)
+        active = lo < hi
+
+    return lo
+
+
+def score_image(img, cube, outfile, kind='rank', policy=output_policy.DEFAULT_POLICY):
+
+    """
+    Calculate the percentile score of a seasonal total rainfall grid against the climatology cube and write
+    the output GTiff with the data type, scale and nodata value of the output policy.
+    """
+    sortedStack, count, sidecar = open_cube(cube)
+
+    ds = gdal.Open(img)
+    if ds is None:
+        raise IOError('unable to open ' + img)
+    check_grid(sidecar, ds, img)
+
+    rows, cols = sidecar['rows'], sidecar['cols']
+
+    driver = gdal.GetDriverByName('GTiff')
+    options = ['COMPRESS=LZW', 'BIGTIFF=YES', 'TILED=YES', 'INTERLEAVE=BAND','BLOCKXSIZE=256','BLOCKYSIZE=256']
+    rule = output_policy.stage_policy('percentile', policy)
+    outImg = driver.Create(outfile, cols, rows, 1, gdal.GetDataTypeByName(output_policy.GDAL_TYPE_NAMES[rule['dtype']]), options)
+    outImg.SetGeoTransform(sidecar['geotransform'])
+    outImg.SetProjection(sidecar['projection'])
+    outBand = outImg.GetRasterBand(1)
+    outBand.SetNoDataValue(rule['nodata'])
+    outBand.SetScale(rule['scale'])
+
+    with run_report.stage('percentile', reads=[img, os.path.join(cube, SORTED_NAME)], writes=[outfile]):
+        for row in range(0, rows, STRIP_ROWS):
+            nrows = min(STRIP_ROWS, rows - row)
+
+            score = read_strip(ds, row, nrows)
+            history = np.array(sortedStack[row:row + nrows])
+            n = np.array(count[row:row + nrows])
+
+            left = searchsorted_stack(history, n, score, side='left')
+            right = searchsorted_stack(history, n, score, side='right')
+
+            perc = percentile_rank.score_from_counts(left, right, n, np.isnan(score), kind, -1)
+            outBand.WriteArray(output_policy.encode(perc, perc == -1, 'percentile', policy), 0, row)
+
+        outBand.FlushCache()
+        outImg = None
+
+        output_policy.convert_to_cog(outfile, 'percentile')
+
+    print (outfile + ' is complete')
+
+
+def mainRoutine():
+
+    """Run mainRoutine"""
+
+    cmdargs = getCmdargs()
+
+    if cmdargs.command == 'build':
+        df = pd.read_csv(cmdargs.imglist, header=None)
+        build_cube(df[0].values.tolist(), cmdargs.cube)
+
+    elif cmdargs.command == 'append':
+        append_season(cmdargs.img, cmdargs.cube)
+
+    elif cmdargs.command == 'score':
+        score_image(cmdargs.img, cmdargs.cube, cmdargs.outfile, cmdargs.kind, cmdargs.policy)
+
+
+if __name__ == "__main__":
+    mainRoutine()
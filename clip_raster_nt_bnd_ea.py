@@ -42,6 +42,14 @@ img      : str
 outputNT : str 
             is a string with the directory and the output raster file name.
 
+boundary : str
+            is the shapefile used to clip the raster, the default is nt_bnd/nt_bnd_ea.shp in this repository (or the 
+            NT_BND environment variable if it is set).
+
+cache : str
+            is the directory used to cache the rasterized boundary masks, the boundary is rasterized once for each 
+            shapefile and grid and later clips are a window slice and a mask.
+
 
 """
 
@@ -49,12 +57,36 @@ outputNT : str
 import sys
 import os
 import argparse
-import gdal
+import math
+import hashlib
+import json
+from osgeo import gdal
+import numpy as np
 import pandas as pd
 import fiona
 import rasterio
+import rasterio.features
 import rasterio.mask
+import rasterio.windows
 import pdb
+import output_policy
+import run_report
+
+# location of the nt boundary projected in GDA94 / Australian Albers 
+NT_BND = os.environ.get("NT_BND", os.path.join(os.path.dirname(os.path.abspath(__file__)), "nt_bnd", "nt_bnd_ea.shp"))
+
+# default directory for the cached boundary masks
+MASK_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "rainfall-raster-analysis", "boundary_masks")
+
+# the files making up a shapefile that are included in its checksum
+SHAPEFILE_PARTS = ('.shp', '.shx', '.dbf', '.prj')
+
+# boundary masks already loaded in this process
+loaded_masks = {}
+
+# checksums of the shapes already seen in this process, keyed by the id of the list of geometries (the list is
+# kept with its checksum so the id is not reused) or by the shapefile name and the modification times of its files
+shapes_checksums = {}
 
 
 def getCmdargs():
@@ -66,6 +98,12 @@ def getCmdargs():
     p.add_argument("-i","--img", help="raster imagery and the corresponding shapefiles used to clip the raster")
     
     p.add_argument("-o","--outputNT", help="path name of raster file for the clipped imagery")
+    
+    p.add_argument("-b","--boundary", default=NT_BND, help="shapefile used to clip the raster (default %(default)s)")
+    
+    p.add_argument("-c","--cache", default=MASK_CACHE, help="directory used to cache the rasterized boundary masks")
+    
+    p.add_argument("-s","--stage", default='total', choices=sorted(output_policy.OVERVIEW_RESAMPLING), help="stage of the image, sets the resampling of the overviews (default total)")
        
     cmdargs = p.parse_args()
     
@@ -78,6 +116,193 @@ def getCmdargs():
     return cmdargs
 
    
+def read_shapes(inshp):
+    
+    """
+    read in the geometries from the shapefile used to clip the raster image
+    """
+    with fiona.open(inshp, "r") as shapefile:
+        shapes = [feature["geometry"] for feature in shapefile]
+    
+    return shapes
+
+
+def shapefile_checksum(inshp):
+    
+    """
+    returns a checksum of the shapefile (geometry, index, attribute and projection files)
+    """
+    sha = hashlib.sha1()
+    base = os.path.splitext(inshp)[0]
+    
+    for ext in SHAPEFILE_PARTS:
+        if os.path.exists(base + ext):
+            with open(base + ext, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(chunk)
+    
+    return sha.hexdigest()
+
+
+def geometry_checksum(shapes):
+    
+    """
+    returns a checksum of a list of geometries already read from a shapefile
+    """
+    geometries = [getattr(shape, '__geo_interface__', shape) for shape in shapes]
+    
+    return hashlib.sha1(json.dumps(geometries, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def shapes_checksum(shapes):
+    
+    """
+    returns the checksum of the shapes (a shapefile name or a list of geometries), calculated once for each 
+    list of geometries or version of the shapefile in this process. A list of geometries must not be changed 
+    after it has been used to clip.
+    """
+    if isinstance(shapes, str):
+        base = os.path.splitext(shapes)[0]
+        key = (shapes,) + tuple(os.path.getmtime(base + ext) if os.path.exists(base + ext) else None for ext in SHAPEFILE_PARTS)
+        if key not in shapes_checksums:
+            shapes_checksums[key] = (shapes, shapefile_checksum(shapes))
+        return shapes_checksums[key][1]
+    
+    entry = shapes_checksums.get(id(shapes))
+    if entry is None or entry[0] is not shapes:
+        entry = shapes_checksums[id(shapes)] = (shapes, geometry_checksum(shapes))
+    
+    return entry[1]
+
+
+def shapes_window(shapes, transform, width, height):
+    
+    """
+    returns the window of the grid covering the bounds of the shapes, calculated the same way as rasterio.mask.mask 
+    with crop=True (the outermost pixels containing the shapes limited to the grid)
+    """
+    all_bounds = [rasterio.features.bounds(shape, transform=~transform) for shape in shapes]
+    
+    cols = [x for (left, bottom, right, top) in all_bounds for x in (left, right)]
+    rows = [y for (left, bottom, right, top) in all_bounds for y in (top, bottom)]
+    
+    row_start, row_stop = int(math.floor(min(rows))), int(math.ceil(max(rows)))
+    col_start, col_stop = int(math.floor(min(cols))), int(math.ceil(max(cols)))
+    
+    window = rasterio.windows.Window(col_start, row_start, max(col_stop - col_start, 0), max(row_stop - row_start, 0))
+    window = window.intersection(rasterio.windows.Window(0, 0, width, height))
+    
+    return window
+
+
+def boundary_mask(shapes, transform, width, height, cache_dir=MASK_CACHE):
+    
+    """
+    Return the window of the grid (transform, width, height) covering the shapes and a boolean mask of the window 
+    which is True inside the shapes. shapes is either the shapefile name or a list of geometries. The mask is 
+    rasterized once and saved (bit packed) in cache_dir keyed by the checksum of the shapes and the grid, set 
+    cache_dir to None to rasterize the mask without caching it.
+    """
+    checksum = shapes_checksum(shapes)
+    
+    loaded = (checksum, tuple(transform)[:6], height, width)
+    if loaded in loaded_masks:
+        return loaded_masks[loaded]
+    
+    key = hashlib.sha1(json.dumps({'shapes': checksum, 'transform': list(transform)[:6], 'shape': [height, width]}).encode('utf-8')).hexdigest()
+    
+    path = None if cache_dir is None else os.path.join(cache_dir, key + '.npz')
+    
+    if path is not None and os.path.exists(path):
+        with np.load(path) as cached:
+            col_off, row_off, win_width, win_height = cached['window'].tolist()
+            window = rasterio.windows.Window(col_off, row_off, win_width, win_height)
+            mask = np.unpackbits(cached['mask'], count=win_width * win_height).astype(bool).reshape(win_height, win_width)
+    else:
+        if isinstance(shapes, str):
+            shapes = read_shapes(shapes)
+        
+        window = shapes_window(shapes, transform, width, height)
+        if window.width == 0 or window.height == 0:
+            raise ValueError('Input shapes do not overlap raster.')
+        
+        mask = rasterio.features.geometry_mask(shapes, out_shape=(int(window.height), int(window.width)),
+                                               transform=rasterio.windows.transform(window, transform), invert=True)
+        
+        if path is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            
+            # write to a temporary file first so an interrupted run does not leave a broken mask in the cache
+            tmp = path + '.' + str(os.getpid()) + '.tmp.npz'
+            np.savez(tmp, window=np.array([window.col_off, window.row_off, window.width, window.height], dtype=np.int64),
+                     mask=np.packbits(mask.ravel()))
+            os.replace(tmp, path)
+            print ('boundary mask saved to ' + path)
+    
+    loaded_masks[loaded] = (window, mask)
+    
+    return window, mask
+
+
+def apply_mask(array, mask, nodata):
+    
+    """
+    set the pixels of the array (bands, rows, cols or rows, cols) outside the mask to nodata (or 0)
+    """
+    fill = 0 if nodata is None else nodata
+    
+    return np.where(mask, array, np.array(fill, dtype=array.dtype))
+
+
+def clip_profile(profile, window, transform, dtype, count):
+    
+    """
+    returns the metadata of the clipped raster
+    """
+    return {'driver': 'GTiff', 'dtype': dtype, 'nodata': profile.get('nodata'), 'width': int(window.width),
+            'height': int(window.height), 'count': count, 'crs': profile['crs'],
+            'transform': rasterio.windows.transform(window, transform)}
+
+
+def clip_array(array, profile, shapes, cache_dir=MASK_CACHE):
+    
+    """
+    Clip a single band array in memory to the shapes (a shapefile name or a list of geometries) using the cached 
+    boundary mask. Returns the clipped array and the updated rasterio profile.
+    """
+    with run_report.stage('clip'):
+        window, mask = boundary_mask(shapes, profile['transform'], profile['width'], profile['height'], cache_dir)
+        
+        out_image = apply_mask(array[window.toslices()], mask, profile.get('nodata'))
+    
+    return out_image, clip_profile(profile, window, profile['transform'], array.dtype.name, 1)
+
+
+def clip_image(inImage, out_tif, inshp=NT_BND, cache_dir=MASK_CACHE, stage='total'):
+    
+    """
+    Clip the raster image to the shapefile boundary and write it to out_tif as a COG with the overviews of the 
+    stage, only the window covering the boundary is read from the raster image
+    """
+    print (out_tif)
+    
+    with run_report.stage('clip', reads=[inImage], writes=[out_tif]):
+        # read in the window of the raster image covering the boundary
+        with rasterio.open(inImage) as src:
+            window, mask = boundary_mask(inshp, src.transform, src.width, src.height, cache_dir)
+            out_image = apply_mask(src.read(window=window), mask, src.nodata)
+            out_meta = clip_profile(src.profile, window, src.transform, src.dtypes[0], src.count)
+            scales = src.scales
+            
+        with rasterio.open(out_tif, "w", **output_policy.cog_profile(out_meta, stage)) as dest:
+            # keep the scale of scaled outputs (e.g. the percentile score, see output_policy.py)
+            dest.scales = scales
+            dest.write(out_image)
+    
+    return out_tif
+
+   
 def main():
     
     """
@@ -89,26 +314,9 @@ def main():
     # open the list of imagery and read it into memory
     inImage = cmdargs.img
     
-    # location of the nt boundary projected in GDA94 / Australian Albers 
-    inshp = "E:/DEPWS/code/rangeland_monitoring/PLB_report/nt_bnd/nt_bnd_ea.shp"
     out_tif = cmdargs.outputNT  
-    print (out_tif)
-        
-    # read in the shapefile used to clip the raster image
-    with fiona.open(inshp, "r") as shapefile:
-        shapes = [feature["geometry"] for feature in shapefile]
-        
-    # read in the raster image to be clipped
-    with rasterio.open(inImage) as src:
-        out_image, out_transform = rasterio.mask.mask(src, shapes, crop=True)
-        out_meta = src.meta
-            
-    out_meta.update({"driver": "GTiff","height": out_image.shape[1],"width": out_image.shape[2],"transform": out_transform})
-        
-    with rasterio.open(out_tif, "w",**out_meta) as dest:
-        dest.write(out_image)
-          
-    src.close()
+    
+    clip_image(inImage, out_tif, cmdargs.boundary, cmdargs.cache, cmdargs.stage)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
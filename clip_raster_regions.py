@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+"""
+This script clips raster images (e.g. the NT_*_total_rainfall_a2.tif or percentile layers) to every feature of a polygon
+layer (e.g. pastoral districts, bioregions or properties) in a single pass over each raster. The window covering all
+the features is read from the raster once, then either one clipped raster is written for every feature or a single
+labelled output is written holding the raster values inside the features and the id of the feature covering each pixel.
+
+The features are held in a grid based spatial index (RegionIndex), it only prunes the features outside the raster
+(e.g. a raster covering part of the regions), on a raster covering all the regions every feature is selected. The
+selected features, the window covering them and the mask of every feature (or the region id raster) are built once
+for each grid (RegionMasks), so every raster of a list on the same grid (e.g. the seasonal archive) reuses them
+instead of rasterizing thousands of small polygons (e.g. paddocks) again for each raster.
+
+Parameters:
+-----------
+
+img : str
+            is a directory path and name of the raster image to clip.
+
+imglist : str
+            is a string to name of the txt file or csv file containing a list of raster images to clip (instead of img).
+
+regions : str
+            is the polygon shapefile (in the same projection as the rasters) containing the regions to clip to.
+
+field : str
+            is the attribute used to name the region outputs (e.g. DISTRICT), the default is the feature id.
+
+outdir : str
+            is the output directory for the clipped rasters, one raster is written for every region named
+            <image name>_<region>.tif.
+
+labelled : bool
+            if set a single output is written for every raster instead (<image name>_regions.tif) along with the
+            region id raster (<image name>_regions_id.tif) and a csv relating the region ids to the field values.
+
+"""
+
+from __future__ import print_function, division
+import sys
+import os
+import re
+import math
+import argparse
+import numpy as np
+import pandas as pd
+import fiona
+import rasterio
+import rasterio.features
+import rasterio.windows
+import clip_raster_nt_bnd_ea
+import output_policy
+
+# size of the spatial index cells as a multiple of the median feature size
+INDEX_CELL_FACTOR = 2.0
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("-i","--img", help="raster image to clip to the regions")
+
+    p.add_argument("-l","--imglist", help="list of raster images to clip, should be a pandas df without a header")
+
+    p.add_argument("-r","--regions", help="polygon shapefile containing the regions to clip to")
+
+    p.add_argument("-f","--field", help="attribute used to name the region outputs (default the feature id)")
+
+    p.add_argument("-o","--outdir", help="output directory for the clipped rasters")
+
+    p.add_argument("-b","--labelled", action="store_true", help="write a single labelled output for every raster instead of one raster per region")
+
+    p.add_argument("-s","--stage", default='total', choices=sorted(output_policy.OVERVIEW_RESAMPLING), help="stage of the rasters, sets the resampling of the overviews (default total)")
+
+    cmdargs = p.parse_args()
+
+    if (cmdargs.img is None and cmdargs.imglist is None) or cmdargs.regions is None or cmdargs.outdir is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+class RegionIndex(object):
+
+    """
+    Grid based spatial index of the region bounds. Every feature is added to the grid cells its bounding box
+    covers so a query only tests the features in the cells covered by the query bounds.
+    """
+
+    def __init__(self, bounds, cell_size=None):
+
+        self.bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+
+        if cell_size is None:
+            sizes = np.maximum(self.bounds[:, 2] - self.bounds[:, 0], self.bounds[:, 3] - self.bounds[:, 1])
+            cell_size = INDEX_CELL_FACTOR * np.median(sizes) if len(sizes) else 1.0
+        self.cell_size = cell_size if cell_size > 0 else 1.0
+
+        self.cells = {}
+        for i, (left, bottom, right, top) in enumerate(self.bounds):
+            for cell in self.cover((left, bottom, right, top)):
+                self.cells.setdefault(cell, []).append(i)
+
+    def cover(self, bounds):
+
+        """
+        returns the grid cells covered by the bounds (left, bottom, right, top)
+        """
+        left, bottom, right, top = bounds
+        col0, col1 = int(math.floor(left / self.cell_size)), int(math.floor(right / self.cell_size))
+        row0, row1 = int(math.floor(bottom / self.cell_size)), int(math.floor(top / self.cell_size))
+
+        # bounds much larger than the indexed features only need the occupied cells
+        if (col1 - col0 + 1) * (row1 - row0 + 1) > len(self.cells) > 0:
+            return [(c, r) for (c, r) in self.cells if col0 <= c <= col1 and row0 <= r <= row1]
+
+        return [(c, r) for c in range(col0, col1 + 1) for r in range(row0, row1 + 1)]
+
+    def query(self, bounds):
+
+        """
+        returns the sorted indices of the features whose bounds intersect the bounds (left, bottom, right, top)
+        """
+        candidates = set()
+        for cell in self.cover(bounds):
+            candidates.update(self.cells.get(cell, ()))
+
+        if not candidates:
+            return []
+
+        candidates = np.array(sorted(candidates))
+        left, bottom, right, top = bounds
+        b = self.bounds[candidates]
+        hit = (b[:, 0] <= right) & (b[:, 2] >= left) & (b[:, 1] <= top) & (b[:, 3] >= bottom)
+
+        return candidates[hit].tolist()
+
+
+def read_regions(inshp, field=None):
+
+    """
+    read the geometries and names of the regions from the shapefile, returns the list of geometries, the list
+    of names (the field value or the feature id) and the spatial index of the regions
+    """
+    shapes = []
+    names = []
+    filenames = set()
+
+    with fiona.open(inshp, "r") as shapefile:
+        for feature in shapefile:
+            if feature["geometry"] is None:
+                continue
+            shapes.append(feature["geometry"])
+            name = str(feature["properties"][field]) if field is not None else str(feature["id"])
+            # regions sharing the same field value (or names that are the same once made safe for a file name)
+            # are told apart by their feature id, so no region output overwrites another
+            if region_filename(name) in filenames:
+                name = name + '_' + str(feature["id"])
+            suffix = 1
+            while region_filename(name) in filenames:
+                name = name + '_' + str(suffix)
+                suffix += 1
+            filenames.add(region_filename(name))
+            names.append(name)
+
+    index = RegionIndex([rasterio.features.bounds(shape) for shape in shapes])
+
+    return shapes, names, index
+
+
+def region_filename(name):
+
+    """
+    make the region name safe to use in a file name
+    """
+    return re.sub(r'[^A-Za-z0-9_\-]+', '_', name).strip('_')
+
+
+class RegionMasks(object):
+
+    """
+    The regions overlapping a grid, the window covering them, the window and mask of every region and the
+    region id raster for each grid the rasters are on. Each grid is only rasterized once so every raster on
+    the same grid shares them (as zonal_stats.RegionLabels).
+    """
+
+    def __init__(self, shapes, index):
+
+        self.shapes = shapes
+        self.index = index
+        self.plans = {}
+
+    def get(self, transform, width, height, bounds, labelled=False):
+
+        """
+        returns the plan of the grid, a dictionary with the selected region indices, the window covering them and
+        either the region id raster (labelled) or a list of (region index, region window, mask) tuples, the
+        window is None if the grid does not overlap any region
+        """
+        key = (tuple(transform)[:6], width, height, labelled)
+
+        if key not in self.plans:
+            self.plans[key] = self.plan(transform, width, height, bounds, labelled)
+
+        return self.plans[key]
+
+    def plan(self, transform, width, height, bounds, labelled):
+
+        selected = self.index.query(tuple(bounds))
+        plan = {'selected': selected, 'window': None}
+        if not selected:
+            return plan
+
+        window = clip_raster_nt_bnd_ea.shapes_window([self.shapes[i] for i in selected], transform, width, height)
+        if window.width == 0 or window.height == 0:
+            return plan
+        plan['window'] = window
+
+        if labelled:
+            # region ids start at 1 so 0 is outside all the regions, overlapping regions take the last id
+            plan['ids'] = rasterio.features.rasterize(((self.shapes[i], i + 1) for i in selected), out_shape=(int(window.height), int(window.width)),
+                                                      transform=rasterio.windows.transform(window, transform), fill=0, dtype='int32')
+            return plan
+
+        plan['regions'] = []
+        for i in selected:
+            region = clip_raster_nt_bnd_ea.shapes_window([self.shapes[i]], transform, width, height)
+            if region.width == 0 or region.height == 0:
+                continue
+            mask = rasterio.features.geometry_mask([self.shapes[i]], out_shape=(int(region.height), int(region.width)),
+                                                   transform=rasterio.windows.transform(region, transform), invert=True)
+            plan['regions'].append((i, region, mask))
+
+        return plan
+
+
+def clip_regions(img, shapes, names, index, outdir, labelled=False, stage='total', masks=None):
+
+    """
+    Clip the raster image to every region overlapping it. The window covering the overlapping regions is
+    read once and each region is clipped from it in memory. masks is an optional RegionMasks shared by the
+    rasters so the regions are only rasterized once for each grid. The outputs are COGs with the overviews
+    of the stage (the region ids use the mode). Returns the list of output file names.
+    """
+    if masks is None:
+        masks = RegionMasks(shapes, index)
+
+    base = os.path.join(outdir, os.path.basename(img)[:-4])
+    outputs = []
+
+    with rasterio.open(img) as src:
+        profile = src.profile.copy()
+        plan = masks.get(src.transform, src.width, src.height, src.bounds, labelled)
+        selected, window = plan['selected'], plan['window']
+
+        if window is None:
+            print (img + ' does not overlap any of the regions')
+            return outputs
+
+        data = src.read(window=window)
+        # the scale of scaled outputs (e.g. the percentile score, see output_policy.py) is kept in the clipped rasters
+        scales = src.scales
+
+    if labelled:
+        ids = plan['ids']
+
+        out_meta = clip_raster_nt_bnd_ea.clip_profile(profile, window, profile['transform'], data.dtype.name, data.shape[0])
+        write(base + '_regions.tif', clip_raster_nt_bnd_ea.apply_mask(data, ids > 0, profile.get('nodata')), out_meta, scales, stage)
+
+        id_meta = clip_raster_nt_bnd_ea.clip_profile(profile, window, profile['transform'], 'int32', 1)
+        id_meta['nodata'] = 0
+        write(base + '_regions_id.tif', ids[None], id_meta, stage='regions')
+
+        pd.DataFrame({'id': [i + 1 for i in selected], 'region': [names[i] for i in selected]}).to_csv(base + '_regions_id.csv', index=False)
+
+        outputs.extend([base + '_regions.tif', base + '_regions_id.tif'])
+        print (img + ' has been clipped to ' + str(len(selected)) + ' regions')
+
+        return outputs
+
+    for i, region, mask in plan['regions']:
+        # the region relative to the window read from the raster
+        rows = slice(int(region.row_off - window.row_off), int(region.row_off - window.row_off + region.height))
+        cols = slice(int(region.col_off - window.col_off), int(region.col_off - window.col_off + region.width))
+        clipped = clip_raster_nt_bnd_ea.apply_mask(data[:, rows, cols], mask, profile.get('nodata'))
+
+        out_meta = clip_raster_nt_bnd_ea.clip_profile(profile, region, profile['transform'], data.dtype.name, data.shape[0])
+        out_tif = base + '_' + region_filename(names[i]) + '.tif'
+        write(out_tif, clipped, out_meta, scales, stage)
+        outputs.append(out_tif)
+
+    print (img + ' has been clipped to ' + str(len(outputs)) + ' regions')
+
+    return outputs
+
+
+def write(out_tif, array, out_meta, scales=None, stage='total'):
+
+    with rasterio.open(out_tif, "w", **output_policy.cog_profile(out_meta, stage)) as dest:
+        if scales is not None:
+            dest.scales = scales
+        dest.write(array)
+
+
+def mainRoutine():
+
+    """Run mainRoutine"""
+
+    cmdargs = getCmdargs()
+
+    if cmdargs.imglist is not None:
+        df = pd.read_csv(cmdargs.imglist, header=None)
+        listimg = df[0].values.tolist()
+    else:
+        listimg = [cmdargs.img]
+
+    if not os.path.exists(cmdargs.outdir):
+        os.makedirs(cmdargs.outdir)
+
+    shapes, names, index = read_regions(cmdargs.regions, cmdargs.field)
+    print (str(len(shapes)) + ' regions read from ' + cmdargs.regions)
+
+    # the rasters of the list are usually on the same grid so the region masks are shared by all of them
+    masks = RegionMasks(shapes, index)
+    for img in listimg:
+        clip_regions(img, shapes, names, index, cmdargs.outdir, cmdargs.labelled, cmdargs.stage, masks)
+
+
+if __name__ == "__main__":
+    mainRoutine()
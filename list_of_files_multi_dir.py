@@ -94,7 +94,7 @@ def listdir(dirname,endfilename):
     
     for root, dirs, files in os.walk(dirname):
         for file in files:
-            if (os.path.join(root, file)):
+            if endfilename is None or file.endswith(endfilename):
                 img = (os.path.join(root, file))
                 list_img.append(img)
                     
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+This script packs the SILO monthly rainfall grids (e.g. 202105.monthly_rain.tif) into a single on-disk cube chunked
+into spatial tiles with every month of a tile stored together and a date index, so a pixel time series or a spatial
+window across all months can be read without opening every monthly file.
+
+The cube is saved in a directory containing:
+
+rain.npy   : the monthly rainfall array (tile rows, tile cols, time, 32, 32) stored as uint16 in units of 0.1 mm by
+             default (or float32), the grid is padded with the nodata value to a whole number of tiles. The array can
+             be memory mapped with numpy.load(mmap_mode='r'), use MonthlyRainfallCube to read it as (time, rows, cols).
+
+The months of a tile are a single contiguous run of the file, so the time series of a pixel (or a small window) is
+read from one run (e.g. 1,600 months of a uint16 tile is 3.2 MB) instead of a separate page of every month of a
+(time, rows, cols) array. Reading a single month reads a 2 KB chunk (4 KB for float32) from every tile and the
+ingest writes each month tile by tile.
+cube.json  : sidecar with the date index (YYYYMM for every time step), the grid (geotransform, crs, size), the tile
+             size, the scale factor and the nodata values. Cubes without a tile size (made before the cube was
+             tiled) are read as a (time, rows, cols) array.
+
+The grids are ingested one month at a time so the memory used does not depend on the length of the archive. The
+MonthlyRainfallCube class is used to read from the cube (e.g. by total_rainfall.py --cube or in a notebook).
+
+Parameters:
+-----------
+
+imglist : str
+            is a string to name of the txt file or csv file containing the list of monthly rainfall grids to ingest.
+
+cube : str
+            is the directory to save the monthly rainfall cube.
+
+dtype : str
+            is the data type used to store the rainfall, uint16 (0.1 mm units, the default) or float32.
+
+pattern : str
+            is the regular expression (with the named groups year and month) used to find the year and month in the grid
+            file names, the default matches the SILO grids e.g. 202105.monthly_rain.tif.
+
+"""
+
+from __future__ import print_function, division
+import sys
+import os
+import json
+import bisect
+import argparse
+import numpy as np
+import pandas as pd
+import rasterio
+from affine import Affine
+import rainfall_catalog
+
+DATA_NAME = 'rain.npy'
+SIDECAR_NAME = 'cube.json'
+
+# width and height of the spatial tiles of the cube
+TILE_SIZE = 32
+
+# storage options for the monthly rainfall, the scale converts the stored values to mm
+STORAGE = {'uint16': {'scale': 0.1, 'nodata': 65535},
+           'float32': {'scale': 1.0, 'nodata': -32767}}
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("-l","--imglist", help="input list of monthly rainfall grids to ingest, should be a pandas df without a header")
+
+    p.add_argument("-c","--cube", help="output directory for the monthly rainfall cube")
+
+    p.add_argument("-t","--dtype", default='uint16', choices=sorted(STORAGE), help="data type used to store the rainfall (default uint16 in 0.1 mm units)")
+
+    p.add_argument("-p","--pattern", default=rainfall_catalog.GRID_PATTERN, help="regular expression with the named groups year and month used to date the grids")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.imglist is None or cmdargs.cube is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def ingest(listimg, cube, dtype='uint16', pattern=rainfall_catalog.GRID_PATTERN):
+
+    """
+    Pack the monthly rainfall grids into the cube in date order, one month at a time
+    """
+    if not os.path.exists(cube):
+        os.makedirs(cube)
+
+    index = rainfall_catalog.MonthlyGridIndex.from_paths(listimg, pattern)
+    if not len(index):
+        raise ValueError('there are no monthly rainfall grids to ingest')
+
+    dated = [(rainfall_catalog.month_yearM(number), img) for number, img in index.dated_grids()]
+    dates = [yearM for yearM, img in dated]
+
+    missing = index.missing(dates[0], dates[-1])
+    if missing:
+        print ('warning: there are no monthly rainfall grids for ' + ', '.join(missing))
+
+    with rasterio.open(dated[0][1]) as src:
+        profile = src.profile.copy()
+
+    scale = STORAGE[dtype]['scale']
+    nodata = STORAGE[dtype]['nodata']
+    maxValue = np.iinfo(dtype).max - 1 if np.dtype(dtype).kind == 'u' else None
+
+    # the grid is padded to a whole number of tiles
+    tileRows = -(-profile['height'] // TILE_SIZE)
+    tileCols = -(-profile['width'] // TILE_SIZE)
+    padded = np.full((tileRows * TILE_SIZE, tileCols * TILE_SIZE), nodata, dtype=dtype)
+
+    data = np.lib.format.open_memmap(os.path.join(cube, DATA_NAME), mode='w+', dtype=dtype,
+                                     shape=(tileRows, tileCols, len(dated), TILE_SIZE, TILE_SIZE))
+
+    for t, (yearM, img) in enumerate(dated):
+        with rasterio.open(img) as src:
+            if (src.height, src.width) != (profile['height'], profile['width']) or src.transform != profile['transform']:
+                raise ValueError(img + ' is not on the same grid as ' + dated[0][1])
+            month = src.read(1).astype(np.float64)
+            srcNull = src.nodata
+
+        invalid = month < 0 if srcNull is None else (month == srcNull) | (month < 0)
+
+        if maxValue is not None:
+            month = np.round(month / scale)
+            if np.any(month[~invalid] > maxValue):
+                raise ValueError(img + ' has rainfall values too large to store as ' + dtype)
+
+        month[invalid] = nodata
+        padded[:profile['height'], :profile['width']] = month.astype(dtype)
+        data[:, :, t] = padded.reshape(tileRows, TILE_SIZE, tileCols, TILE_SIZE).swapaxes(1, 2)
+
+    data.flush()
+
+    sidecar = {'dates': dates,
+               'geotransform': list(profile['transform'].to_gdal()),
+               'crs': profile['crs'].to_wkt() if profile['crs'] is not None else None,
+               'rows': profile['height'],
+               'cols': profile['width'],
+               'tile': TILE_SIZE,
+               'dtype': dtype,
+               'scale': scale,
+               'nodata': nodata,
+               'source_nodata': profile['nodata'] if profile['nodata'] is not None else -32767}
+
+    with open(os.path.join(cube, SIDECAR_NAME), 'w') as f:
+        json.dump(sidecar, f, indent=1)
+
+    print (cube + ' monthly rainfall cube created with ' + str(len(dates)) + ' months (' + dates[0] + ' to ' + dates[-1] + ')')
+
+
+class MonthlyRainfallCube(object):
+
+    """
+    Read only access to a monthly rainfall cube. The data are memory mapped so only the tiles covering the
+    requested pixels are read from disk, for the requested months. Values are returned in mm as float32 with 
+    nodata set to the nodata value of the source grids (or nan).
+    """
+
+    def __init__(self, cube):
+
+        with open(os.path.join(cube, SIDECAR_NAME)) as f:
+            self.sidecar = json.load(f)
+
+        self.data = np.load(os.path.join(cube, DATA_NAME), mmap_mode='r')
+        self.dates = self.sidecar['dates']
+        self.nodata = self.sidecar['source_nodata']
+        self.grid_index = rainfall_catalog.MonthlyGridIndex((yearM, t) for t, yearM in enumerate(self.dates))
+        self.tile = self.sidecar.get('tile')
+
+    def profile(self):
+
+        """
+        returns a rasterio profile for a single band grid matching the cube
+        """
+        return {'driver': 'GTiff', 'count': 1, 'dtype': 'float32', 'nodata': self.nodata,
+                'height': self.sidecar['rows'], 'width': self.sidecar['cols'],
+                'transform': Affine.from_gdal(*self.sidecar['geotransform']),
+                'crs': self.sidecar['crs']}
+
+    def index(self, yearM_start, yearM_finish):
+
+        """
+        returns the slice of time steps between the start and finish year and month (inclusive, e.g. 202105 and 202204)
+        """
+        start = bisect.bisect_left(self.dates, str(yearM_start))
+        finish = bisect.bisect_right(self.dates, str(yearM_finish))
+
+        return slice(start, finish)
+
+    def missing(self, yearM_start, yearM_finish):
+
+        """
+        returns the list of months between the start and finish year and month that are not in the cube
+        """
+        return self.grid_index.missing(yearM_start, yearM_finish)
+
+    def decode(self, values, nodata=None):
+
+        """
+        convert the stored values to mm
+        """
+        nodata = self.nodata if nodata is None else nodata
+
+        invalid = values == self.sidecar['nodata']
+        mm = values.astype(np.float32) * np.float32(self.sidecar['scale']) if self.sidecar['scale'] != 1.0 else values.astype(np.float32)
+        mm[invalid] = nodata
+
+        return mm
+
+    def read_values(self, months, row=0, col=0, rows=None, cols=None):
+
+        """
+        returns the stored values of the months (a slice or time step) in the window of the grid as a (time, rows, 
+        cols) array, or (rows, cols) for a single time step, reading only the tiles covering the window
+        """
+        rows = self.sidecar['rows'] - row if rows is None else rows
+        cols = self.sidecar['cols'] - col if cols is None else cols
+
+        if self.tile is None:
+            return np.asarray(self.data[months, row:row + rows, col:col + cols])
+
+        tile = self.tile
+        tileRow, tileCol = row // tile, col // tile
+        tiles = np.asarray(self.data[tileRow:-(-(row + rows) // tile), tileCol:-(-(col + cols) // tile), months])
+
+        # (tile rows, tile cols, [time,] tile, tile) to ([time,] rows, cols)
+        if tiles.ndim == 4:
+            values = tiles.swapaxes(1, 2).reshape(tiles.shape[0] * tile, tiles.shape[1] * tile)
+        else:
+            values = tiles.transpose(2, 0, 3, 1, 4).reshape(tiles.shape[2], tiles.shape[0] * tile, tiles.shape[1] * tile)
+
+        row, col = row - tileRow * tile, col - tileCol * tile
+
+        return values[..., row:row + rows, col:col + cols]
+
+    def read(self, yearM_start, yearM_finish, window=None, nodata=None):
+
+        """
+        read the months between the start and finish year and month as a (time, rows, cols) array, window is an
+        optional (row offset, col offset, rows, cols) tuple. Returns the array and the list of dates.
+        """
+        months = self.index(yearM_start, yearM_finish)
+
+        if window is None:
+            values = self.read_values(months)
+        else:
+            values = self.read_values(months, *window)
+
+        return self.decode(values, nodata), self.dates[months]
+
+    def iter_months(self, yearM_start, yearM_finish, nodata=None):
+
+        """
+        yields the months between the start and finish year and month one at a time
+        """
+        for t in range(*self.index(yearM_start, yearM_finish).indices(len(self.dates))):
+            yield self.decode(self.read_values(t), nodata)
+
+    def pixel_series(self, row, col, nodata=np.nan):
+
+        """
+        returns a pandas series of the monthly rainfall for a pixel indexed by date
+        """
+        values = self.decode(self.read_values(slice(None), row, col, 1, 1)[:, 0, 0], nodata)
+
+        return pd.Series(values, index=pd.to_datetime(self.dates, format='%Y%m'))
+
+
+def mainRoutine():
+
+    """Run mainRoutine"""
+
+    cmdargs = getCmdargs()
+
+    df = pd.read_csv(cmdargs.imglist, header=None)
+
+    ingest(df[0].values.tolist(), cmdargs.cube, cmdargs.dtype, cmdargs.pattern)
+
+
+if __name__ == "__main__":
+    mainRoutine()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 """
-This code runs a number of scripts to calculate the total rainfall for a seasonal period. The script uses monthly rainfall .tif files located in the corporate drive (Z:\Landsat\rainfall\).
+This code runs a number of scripts (in the same process) to calculate the total rainfall for a seasonal period. The script uses monthly rainfall .tif files located in the corporate drive (Z:\Landsat\rainfall\).
 
 It will loop produce a seasonal total rainfall grid for every period based on the raster data available.
 
@@ -62,6 +62,55 @@ output : str
 outputNT : str 
             is a string with the directory for the NT total rainfall seasonal grid.
 
+prefix : bool
+            if set every seasonal total is calculated from a single pass over the monthly rainfall grids, keeping a running
+            (prefix) sum for each pixel so each monthly grid is only read once.
+
+windowed : bool
+            if set only the rows of the monthly rainfall grids covering the NT boundary are read, summed and reprojected (see
+            rainfall_workflow.region_plan), the NT outputs are unchanged.
+
+workers : int
+            is the number of seasons processed in parallel, each season is an independent task and a failed season 
+            is reported at the end without stopping the others (default 1).
+
+boundary : str
+            is the shapefile used to clip the total rainfall grids, the default is the NT boundary (clip_raster_nt_bnd_ea.NT_BND).
+
+direc : str
+            is the directory of monthly rainfall grids (*rain.tif) to select the grids from instead of imglist, using the 
+            saved catalog of the directory so only the directories that have changed since the last run are listed.
+
+catalog : str
+            is the json file used to save the index of the monthly rainfall grids (see rainfall_catalog.py).
+
+pattern : str
+            is the regular expression (with the named groups year and month) used to find the year and month in the monthly 
+            rainfall grid file names, the default matches the SILO grids e.g. 202105.monthly_rain.tif.
+
+allowMissing : bool
+            if set seasons with missing monthly rainfall grids are calculated from the available grids (with a warning), 
+            by default they are reported and skipped.
+
+manifest : str
+            is the json file recording the key (a hash of the monthly rainfall grids, season, boundary and settings) of every 
+            season produced (see result_manifest.py), the default is rainfall_manifest.json in the NT output directory. Seasons 
+            with the same key as the last run and unchanged outputs are skipped.
+
+force : bool
+            if set every season is calculated again, ignoring the manifest.
+
+checksum : bool
+            if set the monthly rainfall grids are compared by the checksum of their contents instead of their size and 
+            modification time.
+
+report : str
+            is an optional json file to write a run report to with the time of every stage (see run_report.py), the stages 
+            run by the worker processes are included (summed over the workers).
+
+profile : str
+            is an optional file to save the cProfile stats of the slowest stage to (requires report).
+
 """
 
 
@@ -76,6 +125,18 @@ import argparse
 import pandas as pd
 import scipy.stats.mstats as mstats
 import numpy.ma as ma
+import time
+import datetime
+import traceback
+import multiprocessing
+import rainfall_workflow
+import total_rainfall
+import clip_raster_nt_bnd_ea
+import reproject_raster_ea
+import rainfall_catalog
+import output_policy
+import result_manifest
+import run_report
 
 
 def getCmdargs():
@@ -89,52 +150,256 @@ def getCmdargs():
     p.add_argument("-f","--fmonth", help="provide the finish month e.g 05")
     p.add_argument("-o","--outdir", help="provide the output directory for the AU total rainfall grid")
     p.add_argument("-n","--outputNT", help="provide the output directory for the NT total rainfall grid")
+    p.add_argument("-p","--prefix", action="store_true", help="calculate every season from a single pass over the monthly rainfall grids using prefix sums")
+    p.add_argument("-r","--windowed", action="store_true", help="only read, sum and reproject the rows of the grids covering the NT boundary")
+    p.add_argument("-w","--workers", type=int, default=1, help="number of seasons to process in parallel (default 1)")
+    p.add_argument("-b","--boundary", default=clip_raster_nt_bnd_ea.NT_BND, help="shapefile used to clip the total rainfall grids")
+    p.add_argument("-d","--direc", help="directory of monthly rainfall grids to select the grids from using the catalog (instead of imglist)")
+    p.add_argument("-c","--catalog", help="json file used to save the index of the monthly rainfall grids (see rainfall_catalog.py)")
+    p.add_argument("-t","--pattern", default=rainfall_catalog.GRID_PATTERN, help="regular expression with the named groups year and month used to date the monthly rainfall grids")
+    p.add_argument("-m","--allowMissing", action="store_true", help="calculate seasons with missing monthly rainfall grids instead of skipping them")
+    p.add_argument("--policy", default=output_policy.DEFAULT_POLICY, choices=sorted(output_policy.POLICIES), help="output data type policy for the totals (see output_policy.py)")
+    p.add_argument("--manifest", help="json file recording the inputs of every season produced (default rainfall_manifest.json in the NT output directory)")
+    p.add_argument("--force", action="store_true", help="calculate every season again, ignoring the manifest")
+    p.add_argument("--checksum", action="store_true", help="compare the monthly rainfall grids by checksum instead of size and modification time")
+    run_report.add_arguments(p)
     cmdargs = p.parse_args()
     
-    if cmdargs.imglist is None:
+    if cmdargs.imglist is None and cmdargs.direc is None:
         p.print_help()
         sys.exit()
+    
+    if cmdargs.prefix and cmdargs.workers > 1:
+        p.error('--workers can not be used with --prefix, the seasons are produced in a single pass in one process')
         
     return cmdargs
 
 
     
-def total_rainfall(txtname, newf):
-    
+def season_tasks(index, years, sm, fm, same_year, outdir, nt_outdir, windowed=False, allow_missing=False, policy=output_policy.DEFAULT_POLICY):
+
     """
-    call the total rainfall script and run it.
-    
-    """ 
-    cmd = "python total_rainfall.py --imglist %s --output %s"% (txtname, newf) 
-       
-    os.system(cmd)
-     
-    print (newf + ' is complete')
-    
-    
-def repro(newf):
-    
+    create a task for every seasonal period with its own list of monthly rainfall grids and output file names, 
+    the grids are selected from the monthly grid index (rainfall_catalog.MonthlyGridIndex). Seasons with missing 
+    months are reported and skipped unless allow_missing is set.
     """
-    call the total reproject script and run it.
+    tasks = []
     
-    """ 
-    cmd = "python reproject_raster_ea.py --img %s"% (newf) 
-       
-    os.system(cmd)
+    for year in years:
         
-    print (newf + ' has been reprojected')
-
+        # create the year + month start and finish time for the season and the output file name
+        ysm = str(year) + sm
+        
+        # calculates the year period to process this can be over the same year or over two consecitive years 2021 to 2022
+        if same_year == 'y':            
+            yfm = str(year) + fm
+        else:            
+            yfm = str(int(year)+1) + fm  
+        
+        listimg = index.select(ysm, yfm)
+        
+        if len(listimg) == 0:
+            print ('there are no monthly rainfall grids for ' + ysm + ' to ' + yfm)
+            continue
+        
+        missing = index.missing(ysm, yfm)
+        if missing:
+            if not allow_missing:
+                print (ysm + yfm + ' has been skipped, there are no monthly rainfall grids for ' + ', '.join(missing))
+                continue
+            print ('warning: ' + ysm + yfm + ' is missing the monthly rainfall grids for ' + ', '.join(missing))
+    
+        newf  = outdir  + '\AU_' + ysm + yfm + '_total_rainfall.tif'
+        
+        out_nt = nt_outdir + "/NT_" + ysm + yfm + "_total_rainfall_a2.tif"
+        
+        tasks.append({'season': ysm + yfm, 'listimg': listimg, 'newf': newf, 'out_nt': out_nt,
+                      'start': rainfall_catalog.month_number(ysm), 'finish': rainfall_catalog.month_number(yfm), 'windowed': windowed, 'policy': policy})
     
-def clipNT(img,out_nt):
+    return tasks
+
+
+def task_outputs(task):
+
+    return [task['newf'], task['newf'][:-4] + "_a2.tif", task['out_nt']]
+
 
+def stale_tasks(tasks, manifest, inshp, force=False):
+
+    """
+    Set the manifest key of every task (a hash of its monthly rainfall grids, season, target crs, boundary and 
+    settings) and return the tasks that need to be produced; those with a new key or changed outputs (or all 
+    of them if force is set).
+    """
+    boundary = clip_raster_nt_bnd_ea.shapefile_checksum(inshp)
+    stale = []
     
-    cmd = "python clip_raster_nt_bnd_ea.py --img %s --outputNT %s"% (img,out_nt)
+    for task in tasks:
+        params = {'season': task['season'], 'dst_crs': 'EPSG:3577', 'boundary': boundary, 'windowed': task['windowed'],
+                  'policy': task['policy'], 'resampling': 'nearest'}
+        task['key'] = manifest.key('season', task['listimg'], params)
+        
+        if force or not manifest.current(task['out_nt'], task['key'], task_outputs(task)):
+            stale.append(task)
     
-    os.system(cmd)
+    print ('%d of %d seasons are up to date' % (len(tasks) - len(stale), len(tasks)))
     
-    print (out_nt + ' has been clipped to the NT boundary')
+    return stale
+
+
+def record_task(manifest, task):
+
+    """
+    save the key and outputs of a season that has been produced in the manifest
+    """
+    if manifest is not None:
+        manifest.record(task['out_nt'], task['key'], task_outputs(task))
+        manifest.save()
+
+
+def run_prefix(index, tasks, inshp, windowed=False, policy=output_policy.DEFAULT_POLICY, manifest=None):
+
+    """
+    produce every season from a single pass over the monthly rainfall grids using prefix sums (see 
+    total_rainfall.prefix_sum_totals), then reproject and clip each seasonal total as it is completed. 
+    Only the grids between the first and last month of the seasons are read. Each season produced is 
+    recorded in the manifest (if any). If the pass over the grids fails (e.g. an unreadable grid) the seasons 
+    not completed are recorded as failed with its error. Returns a dictionary of the failed seasons and their errors.
+    """
+    if not tasks:
+        return {}
+    
+    failed = {}
+    start = time.time()
+    shapes = clip_raster_nt_bnd_ea.read_shapes(inshp)
+    
+    by_season = dict((task['season'], task) for task in tasks)
+    seasons = [(task['season'], task['start'], task['finish']) for task in tasks]
+    first, last = min(task['start'] for task in tasks), max(task['finish'] for task in tasks)
+    dated_grids = [(month, img) for month, img in index.dated_grids() if first <= month <= last]
+    
+    if windowed:
+        src_window, dst_grid, dst_crop = rainfall_workflow.region_plan(dated_grids[0][1], shapes)
+    else:
+        src_window, dst_grid, dst_crop = None, None, None
+    
+    totals = total_rainfall.prefix_sum_totals(dated_grids, seasons, src_window, policy)
+    remaining = set(by_season)
+    done = 0
+    
+    while True:
+        try:
+            season, Total_rainfall, profile = next(totals)
+        except StopIteration:
+            break
+        except Exception:
+            # the pass can not continue, every season not completed yet has failed with the same error
+            error = traceback.format_exc()
+            for season in remaining:
+                failed[season] = error
+            print ('the pass over the monthly rainfall grids failed, %d seasons were not produced' % len(remaining))
+            break
+        
+        task = by_season[season]
+        remaining.discard(season)
+        done += 1
+        
+        try:
+            rainfall_workflow.run_total(Total_rainfall, profile, task['newf'], task['out_nt'], shapes, dst_grid, dst_crop)
+            record_task(manifest, task)
+        except Exception:
+            failed[season] = traceback.format_exc()
+            print (season + ' failed')
+        
+        total_elapsed = time.time() - start
+        print ('%d of %d seasons complete (%d failed), elapsed %s' % (done, len(tasks), len(failed), format_time(total_elapsed)))
     
+    return failed
+
+
+# the NT boundary shapefile and its shapes, read once in each worker process
+worker_boundary = None
+worker_shapes = None
+
+# whether the seasons processed by the worker processes are recorded in the run report (see run_report.worker)
+worker_report = False
+
+
+def init_worker(inshp, report=False):
+
+    """
+    read in the NT boundary used to clip every season processed by this worker
+    """
+    global worker_boundary, worker_shapes, worker_report
+    worker_boundary = inshp
+    worker_shapes = clip_raster_nt_bnd_ea.read_shapes(inshp)
+    worker_report = report
+
+
+def run_task(task):
+
+    """
+    produce the total rainfall, reprojected and NT clipped grids for a single season. Any error is caught and 
+    returned so the remaining seasons are still processed. The run report records of the season (see 
+    run_report.worker) are returned with the result.
+    """
+    start = time.time()
+    
+    with run_report.worker(worker_report) as records:
+        try:
+            # the boundary is also passed for seasons too large to process in memory, which clip the file with it
+            rainfall_workflow.run_season(task['listimg'], task['newf'], task['out_nt'], inshp=worker_boundary, shapes=worker_shapes, windowed=task['windowed'],
+                                         cache_dir=reproject_raster_ea.PLAN_CACHE, policy=task['policy'])
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+    
+    return task['season'], error, time.time() - start, records
+
+
+def format_time(seconds):
+
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def run_tasks(tasks, workers, inshp, manifest=None):
+
+    """
+    run the season tasks using a pool of worker processes (or in this process if workers is 1), reporting 
+    the progress and estimated time remaining. Each season produced is recorded in the manifest (if any). 
+    Returns a dictionary of the failed seasons and their errors.
+    """
+    failed = {}
+    start = time.time()
+    by_season = dict((task['season'], task) for task in tasks)
+    
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(inshp, run_report.enabled()))
+        results = pool.imap_unordered(run_task, tasks)
+    else:
+        pool = None
+        init_worker(inshp, run_report.enabled())
+        results = (run_task(task) for task in tasks)
+    
+    try:
+        for done, (season, error, elapsed, records) in enumerate(results, 1):
+            run_report.merge(records)
+            if error is not None:
+                failed[season] = error
+                print (season + ' failed')
+            else:
+                record_task(manifest, by_season[season])
+            
+            total_elapsed = time.time() - start
+            eta = total_elapsed / done * (len(tasks) - done)
+            print ('%d of %d seasons complete (%d failed), season %s took %.1f s, elapsed %s, ETA %s' % (
+                done, len(tasks), len(failed), season, elapsed, format_time(total_elapsed), format_time(eta)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     
+    return failed
     
     
 def mainRoutine():
@@ -143,88 +408,54 @@ def mainRoutine():
 
     cmdargs = getCmdargs()
     
-    imglist = cmdargs.imglist
+    with run_report.session(cmdargs.report, cmdargs.profile):
+        imglist = cmdargs.imglist
     
-    outdir = cmdargs.outdir 
+        outdir = cmdargs.outdir 
     
-    nt_outdir = cmdargs.outputNT
+        nt_outdir = cmdargs.outputNT
     
-    same_year = cmdargs.sameYear
+        same_year = cmdargs.sameYear
     
     
-    print (nt_outdir)
+        print (nt_outdir)
     
-    df = pd.read_csv(imglist,header=None)
+        if imglist is not None:
+            df = pd.read_csv(imglist,header=None)
+            index = rainfall_catalog.MonthlyGridIndex.from_paths(df[0].values.tolist(), cmdargs.pattern)
+        else:
+            # select the monthly rainfall grids from the catalog of the directory
+            catalog = rainfall_catalog.update_catalog(cmdargs.direc, "rain.tif", cmdargs.catalog, pattern=cmdargs.pattern)
+            index = rainfall_catalog.MonthlyGridIndex.from_catalog(catalog)
     
-    years = df[0].map(lambda x: str(x)[-23:-19]).unique()
+        years = index.years()
 
-    # create the datetime field from the monthly rainfall data to enable selection of the selected time period 
-    df['img_date'] = pd.to_datetime((df[0].map(lambda x: str(x)[-23:-19]) + '-' + df[0].map(lambda x: str(x)[-19:-17]) + '-' + '01'),yearfirst=True, dayfirst=False)
-
-    # start and finsih months 
-    sm = cmdargs.smonth
-    fm = cmdargs.fmonth
-
-    for year in years:
-    
-        # create the ym start and finish period 
-        ys = str(year) + '-' + sm + '-01'
-        
-        # calculates the year period to process this can be over the same year or over two consecitive years 2021 to 2022
-        if same_year == 'y':            
-            yf = str(year) + '-' + fm + '-01'
-        else:
-            yf = str(int(year)+1) + '-' + fm + '-01'
-            
-        # create the year + month start and finish time for the output file name
-        ysm = str(year) + sm
-                
-        if same_year == 'y':            
-            yfm = str(year) + fm
-        else:            
-            yfm = str(int(year)+1) + fm  
+        # start and finsih months 
+        sm = cmdargs.smonth
+        fm = cmdargs.fmonth
     
-        print (ys, yf)
+        tasks = season_tasks(index, years, sm, fm, same_year, outdir, nt_outdir, cmdargs.windowed, cmdargs.allowMissing, cmdargs.policy)
     
-        df_select = df[(df['img_date'] >= ys) & (df['img_date'] <= yf)]
-        
-        listimg = df_select[0].values.tolist()
-        
-        print (listimg)
-        print ('***************************')
+        # only the seasons whose monthly rainfall grids or settings have changed since the last run are produced
+        manifest_path = cmdargs.manifest if cmdargs.manifest is not None else os.path.join(nt_outdir, result_manifest.MANIFEST_NAME)
+        manifest = result_manifest.ResultManifest(manifest_path, cmdargs.checksum)
+        tasks = stale_tasks(tasks, manifest, cmdargs.boundary, cmdargs.force)
     
+        if cmdargs.prefix:
+            failed = run_prefix(index, tasks, cmdargs.boundary, cmdargs.windowed, cmdargs.policy, manifest)
+        else:
+            failed = run_tasks(tasks, cmdargs.workers, cmdargs.boundary, manifest)
     
-        filename = outdir  + '\AU_'+ ysm + yfm + '_total_rainfall.tif'
-        
-               
-        print (filename)
         print ("----------------------------------------------------------------------------------------------------")
+        print ('%d of %d seasons completed successfully' % (len(tasks) - len(failed), len(tasks)))
     
-        # write out the selected monthly rainfall grids to a tempory csv file  
-        with open('temp_list.csv', "w") as output:
-            writer = csv.writer(output, lineterminator='\n')
-            for file in listimg:
-                writer.writerow([file])
-        
-        txtname = 'temp_list.csv'
-        
-        print ('***************************')
-        newf  = outdir  + '\AU_' + ysm + yfm + '_total_rainfall.tif'
-       
-        total_rainfall(txtname, newf) 
-        
-        
-        # call the reporject script 
-        repro(newf)
+        if failed:
+            for season in sorted(failed):
+                print ('***************************')
+                print (season + ' failed with the error:')
+                print (failed[season])
+            sys.exit(1)
     
-        # clip the reprojected rainfall grid to the NT boundary
-        img = newf[:-4] + '_a2.tif'
-        
-        out_nt = nt_outdir + "/NT_" + ysm + yfm + "_total_rainfall_a2.tif"
-        
-        print (out_nt)
-           
-        clipNT(img,out_nt)
     
 if __name__ == "__main__":
     mainRoutine()
\ No newline at end of file
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+Output data type, scale and nodata policy for the rasters written by each stage of the workflow.
+
+compact : (the default) the seasonal total rainfall is written as uint16 whole mm (nodata 65535), the percentile score
+          as uint16 hundredths of a percent (scale 0.01, nodata 65535) and the decile rank as uint8 (nodata 0).
+float   : the seasonal total rainfall and the percentile score are written as float32 and the decile rank as int16,
+          all with the nodata value -1.
+
+The stages calculate the values in their own units (mm, percent or decile rank) with -1 flagging the nodata pixels,
+then encode them with the policy when they are written. The scale is saved in the raster (GDAL scale metadata) so the
+values can be decoded to their units again, e.g. when the percentile score is converted to deciles.
+
+Every stage writes its output as a cloud optimised GeoTIFF (COG, LZW compressed 256 x 256 tiles with internal
+overviews), so zoomed out views in QGIS, ArcMap or a web viewer only read the overviews and a part of the raster can be
+read without reading the whole file. The overviews of the total rainfall and percentile score are resampled with the
+average of the valid pixels and the decile rank with the mode, so an overview pixel is always a valid decile.
+The COG driver requires GDAL 3.1 or later.
+
+"""
+
+from __future__ import print_function, division
+import os
+import numpy as np
+import rasterio
+import rasterio.shutil
+from osgeo import gdal
+
+POLICIES = {
+    'compact': {
+        'total': {'dtype': 'uint16', 'scale': 1.0, 'nodata': 65535, 'rounding': 'trunc'},
+        'percentile': {'dtype': 'uint16', 'scale': 0.01, 'nodata': 65535, 'rounding': 'round'},
+        'decile': {'dtype': 'uint8', 'scale': 1.0, 'nodata': 0, 'rounding': 'round'}},
+    'float': {
+        'total': {'dtype': 'float32', 'scale': 1.0, 'nodata': -1, 'rounding': None},
+        'percentile': {'dtype': 'float32', 'scale': 1.0, 'nodata': -1, 'rounding': None},
+        'decile': {'dtype': 'int16', 'scale': 1.0, 'nodata': -1, 'rounding': 'round'}}}
+
+DEFAULT_POLICY = 'compact'
+
+# gdal data type names of the output data types
+GDAL_TYPE_NAMES = {'uint8': 'Byte', 'uint16': 'UInt16', 'int16': 'Int16', 'int32': 'Int32', 'float32': 'Float32'}
+
+# resampling used to build the internal overviews of the output of each stage
+OVERVIEW_RESAMPLING = {'total': 'average', 'percentile': 'average', 'decile': 'mode', 'regions': 'mode'}
+
+COG_BLOCK_SIZE = 256
+
+
+def stage_policy(stage, policy=DEFAULT_POLICY):
+
+    """
+    returns the data type, scale, nodata value and rounding used to write the output of the stage (total,
+    percentile or decile)
+    """
+    if policy not in POLICIES:
+        raise ValueError('policy can only be ' + ' or '.join(sorted(POLICIES)))
+
+    return POLICIES[policy][stage]
+
+
+def encode(values, nodata_mask, stage, policy=DEFAULT_POLICY):
+
+    """
+    Convert the values of the stage (in mm, percent or decile rank) to the output data type, dividing by the
+    scale and truncating or rounding for integer types. Pixels flagged in nodata_mask are set to the nodata
+    value and valid values are limited to the range of the data type (excluding the nodata value).
+    """
+    rule = stage_policy(stage, policy)
+    dtype = np.dtype(rule['dtype'])
+
+    stored = np.asarray(values, dtype=np.float64)
+    if rule['scale'] != 1.0:
+        stored = stored / rule['scale']
+
+    if rule['rounding'] == 'trunc':
+        stored = np.trunc(stored)
+    elif rule['rounding'] == 'round':
+        stored = np.round(stored)
+
+    if dtype.kind in 'ui':
+        info = np.iinfo(dtype)
+        low = info.min + 1 if rule['nodata'] == info.min else info.min
+        high = info.max - 1 if rule['nodata'] == info.max else info.max
+        with np.errstate(invalid='ignore'):
+            stored = np.clip(stored, low, high)
+
+    nodata_mask = np.asarray(nodata_mask) | np.isnan(stored)
+    stored[nodata_mask] = rule['nodata']
+
+    return stored.astype(dtype)
+
+
+def set_metadata(filename, stage, policy=DEFAULT_POLICY):
+
+    """
+    set the nodata value and scale of the output policy on a raster written by rios, so arcmap, qgis and the 
+    later stages recognise them
+    """
+    rule = stage_policy(stage, policy)
+
+    newImg = gdal.Open(filename, gdal.GA_Update)
+    band = newImg.GetRasterBand(1)
+    band.SetNoDataValue(rule['nodata'])
+    if rule['scale'] != 1.0:
+        band.SetScale(rule['scale'])
+        band.SetOffset(0.0)
+    newImg = None
+
+
+def cog_options(stage):
+
+    """
+    returns the creation options of the COG driver for the output of the stage (total, percentile, decile or
+    the regions labels of clip_raster_regions.py), the continuous totals and scores use a predictor (horizontal
+    differencing, or floating point for float32)
+    """
+    options = {'compress': 'lzw', 'blocksize': COG_BLOCK_SIZE, 'bigtiff': 'IF_SAFER',
+               'overviews': 'AUTO', 'overview_resampling': OVERVIEW_RESAMPLING[stage]}
+    if OVERVIEW_RESAMPLING[stage] == 'average':
+        options['predictor'] = 'YES'
+
+    return options
+
+
+def cog_profile(profile, stage):
+
+    """
+    returns a copy of the rasterio profile writing a COG with the options of the stage, rasterio writes the
+    array to memory and copies it to the COG (with its overviews) when the file is closed
+    """
+    profile = dict((key, value) for key, value in profile.items()
+                   if key.lower() not in ('tiled', 'blockxsize', 'blockysize', 'interleave', 'compress', 'predictor', 'bigtiff'))
+    profile.update(cog_options(stage))
+    profile['driver'] = 'COG'
+
+    return profile
+
+
+def convert_to_cog(filename, stage):
+
+    """
+    convert a GeoTIFF written by rios or gdal (after set_metadata) to a COG in place, the nodata value and
+    scale are copied to the COG
+    """
+    tmp = os.path.join(os.path.dirname(filename), '.' + os.path.basename(filename) + '.' + str(os.getpid()) + '.tmp.tif')
+
+    try:
+        rasterio.shutil.copy(filename, tmp, driver='COG', **cog_options(stage))
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def decode(stored, nodata=None, scale=1.0, outNull=-1):
+
+    """
+    Convert stored values back to their units (multiplying by the scale) as float64, with the nodata
+    pixels set to outNull.
+    """
+    stored = np.asarray(stored)
+
+    invalid = np.zeros(stored.shape, dtype=bool)
+    if nodata is not None:
+        invalid |= stored == nodata if not np.isnan(nodata) else np.isnan(stored)
+
+    values = stored.astype(np.float64)
+    if scale is not None and scale != 1.0:
+        values *= scale
+
+    values[invalid] = outNull
+
+    return values
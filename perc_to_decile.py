@@ -54,6 +54,21 @@ inimage: str
 output : str 
             is the directory path and name of the output decile raster image following the naming convetion: NT_201805201904_decile_rainfall_a2.tif
 
+policy : str
+            is the output data type policy (see output_policy.py), the default writes the decile rank as uint8 with the nodata value 0.
+            The percentile score is read in percent using the scale and nodata value saved in the input.
+
+manifest : str
+            is an optional json file recording the inputs of the outputs produced (see result_manifest.py), if the percentile 
+            score and policy have not changed since the output was recorded it is not produced again.
+
+checksum : bool
+            if set the input is compared by the checksum of its contents instead of its size and modification time.
+
+memory : float
+            is the memory budget of a block in MB (default 512), a single layer usually fits the whole grid in one block 
+            (see block_plan.py).
+
 """
 
 # import the modules
@@ -62,8 +77,16 @@ import os
 import argparse
 import pdb
 import numpy as np 
-from rios import applier, fileinfo
+try:
+    from rios import applier, fileinfo
+except ImportError:
+    # only the RIOS stage needs rios, the decile_from_percentile reclassification runs without it
+    applier = fileinfo = None
 from osgeo import gdal
+import output_policy
+import block_plan
+import run_report
+import result_manifest
 
 
 def getCmdargs():
@@ -75,6 +98,16 @@ def getCmdargs():
     
     p.add_argument("-o","--output", help="directroy path and name of the output image")
     
+    p.add_argument("--policy", default=output_policy.DEFAULT_POLICY, choices=sorted(output_policy.POLICIES), help="output data type policy (see output_policy.py)")
+    
+    p.add_argument("--manifest", help="json file recording the inputs of the outputs produced, the output is skipped if its input has not changed (see result_manifest.py)")
+    
+    p.add_argument("--checksum", action="store_true", help="compare the input by checksum instead of size and modification time")
+    
+    block_plan.add_arguments(p)
+    
+    run_report.add_arguments(p)
+    
     cmdargs = p.parse_args()
     
     if cmdargs.inimage is None:
@@ -90,50 +123,88 @@ def mainRoutine():
     
     cmdargs = getCmdargs()
     
+    with run_report.session(cmdargs.report, cmdargs.profile):
+        # skip the output if the percentile score has not changed since it was recorded in the manifest
+        manifest = result_manifest.open_manifest(cmdargs.manifest, cmdargs.checksum)
+        if manifest is not None:
+            key = manifest.key('decile', [cmdargs.inimage], {'policy': cmdargs.policy})
+            if manifest.current(cmdargs.output, key, [cmdargs.output]):
+                print (cmdargs.output + ' is up to date')
+                return
+        
+        rios_decile(cmdargs.inimage, cmdargs.output, cmdargs.policy, cmdargs.memory)
+        
+        if manifest is not None:
+            manifest.record(cmdargs.output, key, [cmdargs.output])
+            manifest.save()
+
+
+def rios_decile(inImage, output, policy=output_policy.DEFAULT_POLICY, memory_mb=block_plan.DEFAULT_MEMORY_MB):
+    
+    """
+    Convert the percentile score raster inImage to decile ranks with RIOS and write them to output as a COG 
+    using the data type and nodata value of the output policy.
+    """
     infiles = applier.FilenameAssociations()
     outfiles = applier.FilenameAssociations()
     otherargs = applier.OtherInputs()
-    
-    infiles.perc = cmdargs.inimage
-    outfiles.outfile = cmdargs.output
-    
+
+    infiles.perc = inImage
+    outfiles.outfile = output
+
     controls = applier.ApplierControls()
     controls.setOutputDriverName('GTiff')
     options = ['COMPRESS=LZW', 'BIGTIFF=YES', 'TILED=YES', 'INTERLEAVE=BAND','BLOCKXSIZE=256','BLOCKYSIZE=256']
     controls.setCreationOptions(options)
-    controls.setWindowXsize(256)
-    controls.setWindowYsize(256)
-    controls.setStatsIgnore(0)
+    block_plan.set_windows(controls, block_plan.image_plan(inImage, 1, memory_mb))
+    controls.setStatsIgnore(output_policy.stage_policy('decile', policy)['nodata'])
     controls.setReferenceImage(infiles.perc)
-    
-    applier.apply(decile, infiles, outfiles, otherargs,controls=controls) 
-    
-    # set the no data value to 
-    newImg = gdal.Open(cmdargs.output, gdal.GA_Update)
-    newImg.GetRasterBand(1).SetNoDataValue(-1)
+
+    # the nodata value and scale of the percentile score 
+    percImg = gdal.Open(inImage)
+    band = percImg.GetRasterBand(1)
+    otherargs.percNull = band.GetNoDataValue()
+    otherargs.percScale = band.GetScale()
+    percImg = None
+    otherargs.policy = policy
+
+    with run_report.stage('decile', reads=[inImage], writes=[output]):
+        applier.apply(decile, infiles, outfiles, otherargs,controls=controls) 
+
+    # set the no data value and convert the deciles to a COG with mode overviews
+    output_policy.set_metadata(output, 'decile', policy)
+    output_policy.convert_to_cog(output, 'decile')
 
     
+@run_report.timed_block('decile')
 def decile(info, inputs, outputs, otherargs):
     
     """
     Function to convert percentile into decile ranks 
     """
-    perc = np.array(inputs.perc[0])
-    perc[perc == -32767.0] = -1
-    perc[(perc <= 10.00000) & (perc >=0)] = 1
-    perc[(perc > 10.00001) & (perc <= 20.0)] = 2
-    perc[(perc > 20.00001) & (perc <= 30.0)] = 3
-    perc[(perc > 30.00001) & (perc <= 40.0)] = 4
-    perc[(perc > 40.00001) & (perc <= 50.0)] = 5
-    perc[(perc > 50.00001) & (perc <= 60.0)] = 6
-    perc[(perc > 60.00001) & (perc <= 70.0)] = 7
-    perc[(perc > 70.00001) & (perc <= 80.0)] = 8
-    perc[(perc > 80.00001) & (perc <= 90.0)] = 9
-    perc[(perc > 90.00001) & (perc <= 100.0)] = 10
-        
-    output = np.array([perc], dtype=np.int16)
+    perc = output_policy.decode(inputs.perc[0], otherargs.percNull, otherargs.percScale)
+    
+    decileImage = decile_from_percentile(perc)
+    output = np.array([output_policy.encode(decileImage, decileImage == -1, 'decile', otherargs.policy)])
        
     outputs.outfile = output
+
+
+def decile_from_percentile(perc, outNull=-1):
+    
+    """
+    Reclassify a percentile score array into decile ranks (1 = 0-10%, 2 = 10-20% ... 10 = 90-100%),
+    values outside 0-100 (e.g. the -1 or -32767 nodata values) are set to outNull
+    """
+    perc = np.asarray(perc, dtype=np.float64)
+    
+    with np.errstate(invalid='ignore'):
+        decile = np.clip(np.ceil(perc / 10.0), 1, 10)
+        nodata = ~((perc >= 0) & (perc <= 100))
+    
+    decile[nodata] = outNull
+    
+    return decile.astype(np.int16)
     
 if __name__ == "__main__":
     mainRoutine()
\ No newline at end of file
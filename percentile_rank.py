@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+Whole-block percentile of score engine used by the percentile stage (total_rain_percentileofscore.py).
+
+The percentile is calculated for every pixel in a block at once by counting the historical values that are
+less than (strict) and less than or equal to (weak) the score along the time axis, then combining the counts
+using the same formulas as scipy.stats.percentileofscore. Historical values equal to the nodata value are
+excluded from the counts, so each pixel is ranked against its own valid history.
+
+Running this script directly compares the engine with scipy.stats.percentileofscore on a synthetic block and
+reports the speed up.
+
+Parameters:
+-----------
+
+layers : int
+            is the number of historical layers in the synthetic stack (default 120).
+
+size : int
+            is the width and height of the synthetic block in pixels (default 256).
+
+kind : str
+            is the percentile definition to check, one of rank, weak, strict or mean (default rank).
+
+"""
+
+from __future__ import print_function, division
+import sys
+import time
+import argparse
+import numpy as np
+
+KINDS = ('rank', 'weak', 'strict', 'mean')
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("-z","--layers", type=int, default=120, help="number of historical layers in the synthetic stack")
+
+    p.add_argument("-s","--size", type=int, default=256, help="width and height of the synthetic block in pixels")
+
+    p.add_argument("-k","--kind", default='rank', choices=KINDS, help="percentile definition to check")
+
+    cmdargs = p.parse_args()
+
+    return cmdargs
+
+
+def valid_mask(stack, nullValue):
+
+    """
+    returns a boolean array flagging the values that are not nodata
+    """
+    if nullValue is None:
+        return np.ones(stack.shape, dtype=bool)
+
+    if np.isnan(nullValue):
+        return ~np.isnan(stack)
+
+    return stack != nullValue
+
+
+def percentile_from_counts(left, right, n, kind='rank'):
+
+    """
+    Combine the number of historical values strictly less than the score (left), less than or equal to
+    the score (right) and the number of valid historical values (n) into a percentile score. The formulas
+    match scipy.stats.percentileofscore, pixels without any valid history are returned as nan.
+    """
+    if kind not in KINDS:
+        raise ValueError("kind can only be 'rank', 'strict', 'weak' or 'mean'")
+
+    left = np.asarray(left, dtype=np.float64)
+    right = np.asarray(right, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if kind == 'rank':
+            plus1 = left < right
+            perct = (left + right + plus1) * (50.0 / n)
+        elif kind == 'strict':
+            perct = left * (100.0 / n)
+        elif kind == 'weak':
+            perct = right * (100.0 / n)
+        else:
+            perct = (left + right) * (50.0 / n)
+
+    perct = np.where(n > 0, perct, np.nan)
+
+    return perct
+
+
+def percentileofscore_stack(stack, score, nullValue, kind='rank', outNull=-1, zeroValue=0.01):
+
+    """
+    Calculate the percentile score for every pixel in a block.
+
+    stack is the (time, y, x) array of historical values and score the (y, x) array of values to rank.
+    Historical values equal to nullValue are excluded, pixels where the score is nodata or there is no valid
+    history are set to outNull. A percentile of zero is replaced with zeroValue so it is not confused
+    with nodata when the output is viewed.
+
+    Returns a float32 array with the same shape as score.
+    """
+    stack = np.asarray(stack)
+    score = np.asarray(score)
+
+    valid = valid_mask(stack, nullValue)
+
+    n = np.count_nonzero(valid, axis=0)
+    left = np.count_nonzero((stack < score) & valid, axis=0)
+    right = np.count_nonzero((stack <= score) & valid, axis=0)
+
+    nodata = ~valid_mask(score, nullValue)
+
+    return score_from_counts(left, right, n, nodata, kind, outNull, zeroValue)
+
+
+def score_from_counts(left, right, n, nodata, kind='rank', outNull=-1, zeroValue=0.01):
+
+    """
+    Convert the counts into the output percentile score image. A percentile of zero is replaced with
+    zeroValue and pixels flagged as nodata (or without any valid history) are set to outNull.
+
+    Returns a float32 array.
+    """
+    perct = percentile_from_counts(left, right, n, kind)
+
+    # this deals with any result that is zero and is being output as null data when it should indicate a very low value
+    perct[perct == 0] = zeroValue
+
+    perct[nodata | (np.asarray(n) == 0)] = outNull
+
+    return perct.astype(np.float32)
+
+
+def scipy_reference(stack, score, nullValue, kind='rank', outNull=-1, zeroValue=0.01):
+
+    """
+    Per pixel reference implementation using scipy.stats.percentileofscore, used to check the engine
+    """
+    from scipy import stats
+
+    valid = valid_mask(stack, nullValue)
+    scoreValid = valid_mask(score, nullValue)
+
+    results = np.full(score.shape, outNull, dtype=np.float64)
+
+    for i in range(score.shape[0]):
+        for p in range(score.shape[1]):
+            history = stack[:, i, p][valid[:, i, p]]
+            if not scoreValid[i, p] or history.size == 0:
+                continue
+            stat = stats.percentileofscore(history, score[i, p], kind=kind)
+            if stat == 0:
+                stat = zeroValue
+            results[i, p] = stat
+
+    return results.astype(np.float32)
+
+
+def synthetic_block(layers, size, nullValue=-1, seed=0):
+
+    """
+    Create a synthetic history stack and score with integer totals (to produce ties) and nodata areas
+    """
+    rng = np.random.default_rng(seed)
+
+    stack = np.round(rng.gamma(2.0, 300.0, size=(layers, size, size))).astype(np.float32)
+    score = np.round(rng.gamma(2.0, 300.0, size=(size, size))).astype(np.float32)
+
+    # a nodata region common to all layers (e.g. outside the boundary) and some missing seasons
+    stack[:, :size // 8, :] = nullValue
+    score[:size // 8, :] = nullValue
+    stack[rng.random(stack.shape) < 0.02] = nullValue
+
+    # scores outside the historical range
+    score[-1, :size // 2] = 0
+    score[-2, :size // 2] = stack.max() + 1
+
+    return stack, score
+
+
+def mainRoutine():
+
+    """
+    Compare the engine with the scipy reference on a synthetic block
+    """
+    cmdargs = getCmdargs()
+
+    nullValue = -1
+    stack, score = synthetic_block(cmdargs.layers, cmdargs.size, nullValue)
+
+    start = time.perf_counter()
+    engine = percentileofscore_stack(stack, score, nullValue, kind=cmdargs.kind)
+    engineTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = scipy_reference(stack, score, nullValue, kind=cmdargs.kind)
+    referenceTime = time.perf_counter() - start
+
+    mismatch = np.count_nonzero(engine != reference)
+
+    print ('pixels compared: ', score.size)
+    print ('mismatched pixels: ', mismatch)
+    print ('scipy reference: %.3f s, engine: %.4f s, speed up: %.0fx' % (referenceTime, engineTime, referenceTime / engineTime))
+
+    if mismatch:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    mainRoutine()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+This script calculates the percentile score (and optionally the decile rank) of every historical season against the
+other seasons in a single pass, instead of running total_rain_percentileofscore.py once per season with a different
+list of seasons each time.
+
+The seasonal total rainfall grids are staged once into a memory mapped (time, rows, cols) stack (as the parallel
+percentile stage does) and the stack is scored block by block. The outputs are multi band rasters with one band per
+season in the order of the list, each band is named after its seasonal total grid.
+
+all   : (the default) every season is ranked against all the other seasons (leave one out). The history of each pixel
+        is sorted once, the number of seasons less than (and less than or equal to) every season is its position in
+        the sorted history, the season itself is then removed from the counts.
+prior : every season is only ranked against the seasons before it in the list, i.e. how the season ranked at the time.
+        The first season has no history and is set to nodata.
+
+Parameters:
+-----------
+
+imglist : str
+            is a string to name of the txt file or csv file containing the list of seasonal rainfall grids in date order.
+
+percentile : str
+            is an optional name of the output percentile score series e.g. NT_perc_rainfall_series_a2.tif.
+
+decile : str
+            is an optional name of the output decile rank series e.g. NT_decile_rainfall_series_a2.tif.
+
+kind : str
+            is the percentile definition (rank, weak, strict or mean) used to rank the score, the default is rank.
+
+prior : bool
+            if set each season is only ranked against the seasons before it in the list.
+
+policy : str
+            is the output data type policy (see output_policy.py), the default writes the percentile score as uint16
+            hundredths of a percent and the decile rank as uint8 with the nodata value 0.
+
+memory : float
+            is the memory budget of a block in MB (default 512), see block_plan.py.
+
+manifest : str
+            is an optional json file recording the inputs of the outputs produced (see result_manifest.py), if the seasonal
+            totals and settings have not changed since the outputs were recorded they are not produced again.
+
+checksum : bool
+            if set the inputs are compared by the checksum of their contents instead of their size and modification time.
+
+"""
+
+from __future__ import print_function, division
+import sys
+import os
+import shutil
+import tempfile
+import argparse
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.windows
+import percentile_rank
+import total_rain_percentileofscore
+import perc_to_decile
+import output_policy
+import block_plan
+import run_report
+import result_manifest
+
+# bytes per pixel of each season held in a block in addition to the staged history (in the data type of the grids):
+# the valid mask, the int64 sort order and the int32 positions in the sorted history (about 21 bytes measured at the
+# peak of leave_one_out_block, the percentile and decile are calculated and encoded one season at a time)
+SERIES_LAYER_BYTES = 24
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("-l","--imglist", help="input list of seasonal total rainfall grids in date order, should be a pandas df without a header")
+
+    p.add_argument("-p","--percentile", help="name of the output percentile score series")
+
+    p.add_argument("-d","--decile", help="name of the output decile rank series")
+
+    p.add_argument("-k","--kind", default='rank', choices=percentile_rank.KINDS, help="percentile definition used to rank the score (default rank)")
+
+    p.add_argument("-r","--prior", action="store_true", help="only rank each season against the seasons before it in the list")
+
+    p.add_argument("--policy", default=output_policy.DEFAULT_POLICY, choices=sorted(output_policy.POLICIES), help="output data type policy (see output_policy.py)")
+
+    p.add_argument("--manifest", help="json file recording the inputs of the outputs produced, the outputs are skipped if their inputs have not changed (see result_manifest.py)")
+
+    p.add_argument("--checksum", action="store_true", help="compare the inputs by checksum instead of size and modification time")
+
+    block_plan.add_arguments(p)
+
+    run_report.add_arguments(p)
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.imglist is None or (cmdargs.percentile is None and cmdargs.decile is None):
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def leave_one_out_block(stack, nullValue, kind='rank', outNull=-1):
+
+    """
+    Calculate the percentile score of every layer of the (time, rows, cols) stack against all the other layers.
+    Returns a float32 (time, rows, cols) array with the nodata values (and pixels without any other valid
+    season) set to outNull. The working arrays are int32 (or smaller) and freed as soon as they are used, the
+    float64 percentile is calculated one season at a time.
+    """
+    valid = percentile_rank.valid_mask(stack, nullValue)
+    layers = stack.shape[0]
+
+    values = stack.astype(np.float32)
+    values[~valid] = np.nan
+    count = np.count_nonzero(valid, axis=0).astype(np.int32)
+
+    # sort the history of every pixel once, the nodata values (nan) are placed at the end
+    order = np.argsort(values, axis=0, kind='stable')
+    sortedValues = np.take_along_axis(values, order, axis=0)
+    del values
+    k = np.arange(layers, dtype=np.int32).reshape((layers,) + (1,) * (stack.ndim - 1))
+
+    # the number of values less than (the position of the first of a run of equal values) and less than or
+    # equal to (the position after the last of the run) each sorted value
+    first = np.ones(stack.shape, dtype=bool)
+    first[1:] = sortedValues[1:] != sortedValues[:-1]
+    sortedLeft = np.where(first, k, np.int32(0))
+    del first
+    np.maximum.accumulate(sortedLeft, axis=0, out=sortedLeft)
+
+    last = np.ones(stack.shape, dtype=bool)
+    last[:-1] = sortedValues[:-1] != sortedValues[1:]
+    del sortedValues
+    sortedRight = np.where(last, k + 1, np.int32(layers))
+    del last
+    np.minimum.accumulate(sortedRight[::-1], axis=0, out=sortedRight[::-1])
+
+    # back to the order of the seasons
+    left = np.empty(stack.shape, dtype=np.int32)
+    np.put_along_axis(left, order, sortedLeft, axis=0)
+    del sortedLeft
+    right = np.empty(stack.shape, dtype=np.int32)
+    np.put_along_axis(right, order, sortedRight, axis=0)
+    del sortedRight, order
+
+    # remove the season itself, it is equal to (but not less than) its own value
+    right -= valid
+
+    series = np.empty(stack.shape, dtype=np.float32)
+    for t in range(layers):
+        series[t] = percentile_rank.score_from_counts(left[t], right[t], count - valid[t], ~valid[t], kind, outNull)
+
+    return series
+
+
+def prior_block(stack, nullValue, kind='rank', outNull=-1):
+
+    """
+    Calculate the percentile score of every layer of the (time, rows, cols) stack against the layers before it.
+    Returns a float32 (time, rows, cols) array, the first layer has no history and is set to outNull.
+    """
+    series = np.empty(stack.shape, dtype=np.float32)
+    for t in range(stack.shape[0]):
+        series[t] = percentile_rank.percentileofscore_stack(stack[:t], stack[t], nullValue, kind=kind, outNull=outNull)
+
+    return series
+
+
+@run_report.timed_block('percentile_series')
+def series_block(stack, nullValue, kind='rank', prior=False):
+
+    np.seterr(all='ignore')
+
+    if prior:
+        return prior_block(stack, nullValue, kind)
+
+    return leave_one_out_block(stack, nullValue, kind)
+
+
+def encode_series(series, stage, policy):
+
+    """
+    returns the percentile score series (or the decile rank series of the stage 'decile') encoded with the output
+    policy, one season at a time so the float64 temporaries of a single season are held
+    """
+    rule = output_policy.stage_policy(stage, policy)
+    encoded = np.empty(series.shape, dtype=rule['dtype'])
+
+    for t in range(series.shape[0]):
+        values = series[t]
+        if stage == 'decile':
+            values = perc_to_decile.decile_from_percentile(values)
+        encoded[t] = output_policy.encode(values, values == -1, stage, policy)
+
+    return encoded
+
+
+def series_profile(profile, stage, nbands, policy):
+
+    """
+    returns the rasterio profile of a tiled GTiff series of the stage (percentile or decile) with nbands bands
+    """
+    rule = output_policy.stage_policy(stage, policy)
+
+    profile = profile.copy()
+    profile.update({'driver': 'GTiff', 'count': nbands, 'dtype': rule['dtype'], 'nodata': rule['nodata'], 'compress': 'lzw',
+                    'BIGTIFF': 'IF_SAFER', 'tiled': True, 'interleave': 'band', 'blockxsize': output_policy.COG_BLOCK_SIZE,
+                    'blockysize': output_policy.COG_BLOCK_SIZE})
+
+    return profile
+
+
+def percentile_series(listimg, percentile=None, decile=None, kind='rank', prior=False, policy=output_policy.DEFAULT_POLICY,
+                      memory_mb=block_plan.DEFAULT_MEMORY_MB):
+
+    """
+    Calculate the percentile score series and/or decile rank series of the seasonal total rainfall grids. The
+    grids are read once into a memory mapped stack next to the first output. Each output has one band per
+    season and is written as a COG (see output_policy.py).
+    """
+    if percentile is None and decile is None:
+        raise ValueError('at least one of the percentile or decile outputs is required')
+
+    outputs = [(name, stage) for name, stage in ((percentile, 'percentile'), (decile, 'decile')) if name is not None]
+    names = [os.path.splitext(os.path.basename(img))[0] for img in listimg]
+
+    with rasterio.open(listimg[0]) as src:
+        profile = src.profile.copy()
+        nullValue = src.nodata
+
+    # the staged history, its sorted copy, ranks and the output series are held for every season of a block
+    layer_bytes = np.dtype(profile['dtype']).itemsize + SERIES_LAYER_BYTES
+    plan = block_plan.image_plan(listimg[0], len(listimg), memory_mb, layer_bytes=layer_bytes)
+
+    stage_dir = tempfile.mkdtemp(prefix='series_', dir=os.path.dirname(os.path.abspath(outputs[0][0])))
+
+    try:
+        with run_report.stage('percentile_series', reads=listimg, writes=[name for name, stage in outputs]):
+            stack_name, score_name = total_rain_percentileofscore.stage_stack(listimg, None, stage_dir)
+            stack = np.load(stack_name, mmap_mode='r')
+
+            datasets = {}
+            try:
+                for name, stage in outputs:
+                    datasets[stage] = rasterio.open(name, 'w', **series_profile(profile, stage, len(listimg), policy))
+                    datasets[stage].descriptions = tuple(names)
+                    if stage == 'percentile':
+                        datasets[stage].scales = (output_policy.stage_policy(stage, policy)['scale'],) * len(listimg)
+
+                for row, col, rows, cols in total_rain_percentileofscore.block_windows(profile['height'], profile['width'], plan.xsize, plan.ysize):
+                    series = series_block(np.asarray(stack[:, row:row + rows, col:col + cols]), nullValue, kind, prior)
+                    window = rasterio.windows.Window(col, row, cols, rows)
+
+                    for stage, dst in datasets.items():
+                        dst.write(encode_series(series, stage, policy), window=window)
+            finally:
+                for dst in datasets.values():
+                    dst.close()
+                del stack
+
+            for name, stage in outputs:
+                output_policy.convert_to_cog(name, stage)
+    finally:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+
+    for name, stage in outputs:
+        print (name + ' is complete')
+
+
+def mainRoutine():
+
+    """Run mainRoutine"""
+
+    cmdargs = getCmdargs()
+
+    with run_report.session(cmdargs.report, cmdargs.profile):
+        # read in the list of historical seasonal totals
+        df = pd.read_csv(cmdargs.imglist, header=None)
+        listimg = df[0].values.tolist()
+
+        outputs = [name for name in (cmdargs.percentile, cmdargs.decile) if name is not None]
+
+        # skip the outputs if the seasonal totals have not changed since they were recorded in the manifest
+        manifest = result_manifest.open_manifest(cmdargs.manifest, cmdargs.checksum)
+        if manifest is not None:
+            key = manifest.key('percentile_series', listimg, {'kind': cmdargs.kind, 'prior': cmdargs.prior, 'policy': cmdargs.policy,
+                                                              'outputs': [cmdargs.percentile is not None, cmdargs.decile is not None]})
+            if manifest.current(outputs[0], key, outputs):
+                for name in outputs:
+                    print (name + ' is up to date')
+                return
+
+        percentile_series(listimg, cmdargs.percentile, cmdargs.decile, cmdargs.kind, cmdargs.prior, cmdargs.policy, cmdargs.memory)
+
+        if manifest is not None:
+            manifest.record(outputs[0], key, outputs)
+            manifest.save()
+
+
+if __name__ == "__main__":
+    mainRoutine()
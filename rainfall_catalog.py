@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+"""
+This script maintains an index (catalog) of the monthly rainfall grids in a directory tree (e.g. Z:/Landsat/rainfall/)
+so the seasonal scripts can select the grids for a date range without walking the whole tree on every run.
+
+The tree is scanned with os.scandir keeping only the files whose name ends with the given string (e.g. rain.tif). The
+year and month of each grid are parsed from the file name once and saved in the index with the file size and
+modification time, along with the modification time of every directory. Later runs only list the directories whose
+modification time has changed (files added, removed or renamed), the records of the unchanged directories are reused.
+
+The MonthlyGridIndex class holds the grids sorted by date and returns the grids for any period with a binary search,
+reporting any months missing from the period rather than silently producing a short total.
+
+Parameters:
+-----------
+
+direc : str
+            is a directory path to the location of the directory and sub-directories to search.
+
+endfilen : str
+            is a string indetifying the end of the file name to search for e.g. rain.tif .
+
+pattern : str
+            is the regular expression used to find the year and month in the file names, with the named groups year and
+            month, the default matches the SILO monthly rainfall grids e.g. 202105.monthly_rain.tif.
+
+catalog : str
+            is the name of the json file used to save the index, the default is a file in
+            ~/.cache/rainfall-raster-analysis/catalogs named from the directory and end of the file name.
+
+yearM_S : str
+            is an optional year and month (e.g. 202010) of the first grid to list.
+
+yearM_f : str
+            is an optional year and month (e.g. 202104) of the last grid to list.
+
+txtfile : str
+            is an optional txt or csv file name to write the list of grids to.
+
+full : bool
+            if set every directory is listed again, e.g. if grids have been overwritten in place.
+
+"""
+
+from __future__ import print_function, division
+import sys
+import os
+import re
+import csv
+import bisect
+import json
+import hashlib
+import argparse
+
+# default directory for the saved catalogs
+CATALOG_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "rainfall-raster-analysis", "catalogs")
+
+# regular expression used to find the year and month in the monthly rainfall grid file names
+GRID_PATTERN = r'(?P<year>\d{4})(?P<month>\d{2})\.monthly_rain\.tif$'
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("-d","--direc", help="path to directory to look in")
+
+    p.add_argument("-e","--endfilen", default="rain.tif", help="end of the file name e.g. rain.tif")
+
+    p.add_argument("-p","--pattern", default=GRID_PATTERN, help="regular expression with the named groups year and month used to date the grids")
+
+    p.add_argument("-c","--catalog", help="json file used to save the index of the grids")
+
+    p.add_argument("-s","--yearM_S", help="the year and month of the first grid to list i.e. 202010")
+
+    p.add_argument("-f","--yearM_f", help="the year and month of the last grid to list i.e. 202104")
+
+    p.add_argument("-o","--txtfile", help="name of out put txt or csv file containing the list of files")
+
+    p.add_argument("--full", action="store_true", help="list every directory again instead of only the changed directories")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.direc is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def file_yearM(name, pattern=GRID_PATTERN):
+
+    """
+    find the year and month (e.g. 202105) in the monthly rainfall grid file name using the regular expression,
+    returns None if the file name does not match
+    """
+    match = re.search(pattern, os.path.basename(str(name)))
+
+    if match is None:
+        return None
+
+    year, month = int(match.group('year')), int(match.group('month'))
+    if not 1 <= month <= 12:
+        return None
+
+    return '%04d%02d' % (year, month)
+
+
+def month_number(yearM):
+
+    """
+    convert a year and month (e.g. 202105 as a string or int, or a (year, month) tuple) to a month number
+    (year * 12 + month - 1)
+    """
+    if isinstance(yearM, tuple):
+        year, month = yearM
+    else:
+        yearM = str(yearM)
+        year, month = int(yearM[:4]), int(yearM[4:6])
+
+    if not 1 <= month <= 12:
+        raise ValueError(str(yearM) + ' is not a valid year and month')
+
+    return year * 12 + month - 1
+
+
+def month_yearM(number):
+
+    """
+    convert a month number back to the year and month string (e.g. 202105)
+    """
+    return '%04d%02d' % (number // 12, number % 12 + 1)
+
+
+class MissingMonthsError(ValueError):
+
+    """
+    raised when there are no grids for some of the months in a period
+    """
+
+    def __init__(self, start, finish, missing):
+
+        self.missing = missing
+        ValueError.__init__(self, 'there are no monthly rainfall grids for ' + ', '.join(missing) + ' in the period ' + str(start) + ' to ' + str(finish))
+
+
+class MonthlyGridIndex(object):
+
+    """
+    The monthly rainfall grids sorted by date. The grids for a period are found with a binary search on the
+    month numbers (year * 12 + month - 1) and any missing months in the period are reported.
+    """
+
+    def __init__(self, dated_grids):
+
+        """
+        dated_grids is a list of (year and month, grid) pairs, the year and month as accepted by month_number
+        """
+        dated = sorted((month_number(yearM), img) for yearM, img in dated_grids)
+
+        self.months = [number for number, img in dated]
+        self.paths = [img for number, img in dated]
+
+        duplicated = sorted(set(month_yearM(a) for a, b in zip(self.months, self.months[1:]) if a == b))
+        if duplicated:
+            raise ValueError('there is more than one monthly rainfall grid for ' + ', '.join(duplicated))
+
+    @classmethod
+    def from_paths(cls, paths, pattern=GRID_PATTERN):
+
+        """
+        create the index from a list of grid file names, file names not matching the pattern are ignored
+        """
+        dated = [(file_yearM(img, pattern), img) for img in paths]
+        unmatched = [img for yearM, img in dated if yearM is None]
+        if unmatched:
+            print (str(len(unmatched)) + ' files do not match the grid file name pattern and have been ignored')
+
+        return cls((yearM, img) for yearM, img in dated if yearM is not None)
+
+    @classmethod
+    def from_catalog(cls, catalog):
+
+        """
+        create the index from a catalog (see update_catalog)
+        """
+        return cls((yearM, img) for yearM, img in catalog_grids(catalog))
+
+    def __len__(self):
+
+        return len(self.months)
+
+    def dated_grids(self):
+
+        """
+        returns the list of (month number, grid) pairs in date order
+        """
+        return list(zip(self.months, self.paths))
+
+    def years(self):
+
+        """
+        returns the sorted list of years with at least one grid
+        """
+        return sorted(set(number // 12 for number in self.months))
+
+    def select(self, start, finish):
+
+        """
+        returns the grids between the start and finish year and month (inclusive, e.g. 202010 and 202104)
+        """
+        lo = bisect.bisect_left(self.months, month_number(start))
+        hi = bisect.bisect_right(self.months, month_number(finish))
+
+        return self.paths[lo:hi]
+
+    def missing(self, start, finish):
+
+        """
+        returns the list of months (e.g. 202012) between start and finish without a grid
+        """
+        first, last = month_number(start), month_number(finish)
+        lo = bisect.bisect_left(self.months, first)
+        hi = bisect.bisect_right(self.months, last)
+        present = set(self.months[lo:hi])
+
+        return [month_yearM(number) for number in range(first, last + 1) if number not in present]
+
+    def season(self, start, finish, allow_missing=False):
+
+        """
+        returns the grids for every month between start and finish, raising a MissingMonthsError if any
+        month is missing (or printing a warning if allow_missing is set)
+        """
+        missing = self.missing(start, finish)
+
+        if missing:
+            error = MissingMonthsError(start, finish, missing)
+            if not allow_missing:
+                raise error
+            print ('warning: ' + str(error))
+
+        return self.select(start, finish)
+
+
+def catalog_path(dirname, endfilename):
+
+    """
+    returns the default catalog file name for the directory and end of the file name
+    """
+    key = hashlib.sha1((os.path.abspath(dirname) + '|' + str(endfilename)).encode('utf-8')).hexdigest()
+
+    return os.path.join(CATALOG_CACHE, key + '.json')
+
+
+def load_catalog(path):
+
+    """
+    read a saved catalog, returns None if it does not exist
+    """
+    if path is None or not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_catalog(catalog, path):
+
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(catalog, f)
+    os.replace(tmp, path)
+
+
+def scan(dirname, endfilename=None, previous=None, pattern=GRID_PATTERN):
+
+    """
+    Scan the directory tree with os.scandir and return the catalog. Directories with the same modification
+    time as in the previous catalog are not listed again, their files and sub directories are reused.
+    Returns the catalog and the number of directories listed.
+    """
+    old = {}
+    if previous is not None and previous.get('endfilename') == endfilename:
+        old = previous['dirs']
+
+    # the files only need to be dated again if the pattern has changed
+    redate = previous is not None and previous.get('pattern') != pattern
+
+    dirs = {}
+    listed = 0
+    stack = ['']
+
+    while stack:
+        rel = stack.pop()
+        path = os.path.join(dirname, rel) if rel else dirname
+        mtime = os.stat(path).st_mtime_ns
+
+        if rel in old and old[rel]['mtime'] == mtime:
+            record = old[rel]
+            if redate:
+                for name, info in record['files'].items():
+                    info['yearM'] = file_yearM(name, pattern)
+        else:
+            listed += 1
+            record = {'mtime': mtime, 'subdirs': [], 'files': {}}
+
+            for entry in os.scandir(path):
+                if entry.is_dir():
+                    record['subdirs'].append(entry.name)
+                elif entry.is_file() and (endfilename is None or entry.name.endswith(endfilename)):
+                    st = entry.stat()
+                    record['files'][entry.name] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'yearM': file_yearM(entry.name, pattern)}
+
+        dirs[rel] = record
+        stack.extend(os.path.join(rel, sub) if rel else sub for sub in record['subdirs'])
+
+    return {'root': os.path.abspath(dirname), 'endfilename': endfilename, 'pattern': pattern, 'dirs': dirs}, listed
+
+
+def update_catalog(dirname, endfilename=None, path=None, full=False, pattern=GRID_PATTERN):
+
+    """
+    Load the saved catalog of the directory tree, rescan the changed directories and save it again.
+    Returns the catalog.
+    """
+    if path is None:
+        path = catalog_path(dirname, endfilename)
+
+    previous = None if full else load_catalog(path)
+    catalog, listed = scan(dirname, endfilename, previous, pattern)
+
+    save_catalog(catalog, path)
+    print (str(listed) + ' of ' + str(len(catalog['dirs'])) + ' directories listed, catalog saved to ' + path)
+
+    return catalog
+
+
+def catalog_grids(catalog):
+
+    """
+    returns the (year and month, file name) pairs of the dated files in the catalog
+    """
+    grids = []
+    for rel, record in catalog['dirs'].items():
+        for name, info in record['files'].items():
+            if info['yearM'] is not None:
+                grids.append((info['yearM'], os.path.join(catalog['root'], rel, name) if rel else os.path.join(catalog['root'], name)))
+
+    return grids
+
+
+def query(catalog, yearM_start=None, yearM_finish=None):
+
+    """
+    returns the files in the catalog with a year and month between yearM_start and yearM_finish (inclusive,
+    e.g. 202010 and 202104, either can be None) sorted by date
+    """
+    index = MonthlyGridIndex.from_catalog(catalog)
+
+    if not len(index):
+        return []
+
+    start = month_yearM(index.months[0]) if yearM_start is None else yearM_start
+    finish = month_yearM(index.months[-1]) if yearM_finish is None else yearM_finish
+
+    return index.select(start, finish)
+
+
+def mainRoutine():
+
+    """Run mainRoutine"""
+
+    cmdargs = getCmdargs()
+
+    catalog = update_catalog(cmdargs.direc, cmdargs.endfilen, cmdargs.catalog, cmdargs.full, cmdargs.pattern)
+
+    list_img = query(catalog, cmdargs.yearM_S, cmdargs.yearM_f)
+    print (str(len(list_img)) + ' grids selected')
+
+    if cmdargs.yearM_S is not None and cmdargs.yearM_f is not None:
+        missing = MonthlyGridIndex.from_catalog(catalog).missing(cmdargs.yearM_S, cmdargs.yearM_f)
+        if missing:
+            print ('there are no monthly rainfall grids for ' + ', '.join(missing))
+
+    if cmdargs.txtfile is not None:
+        with open(cmdargs.txtfile, "w") as output:
+            writer = csv.writer(output, lineterminator='\n')
+            for file in list_img:
+                writer.writerow([file])
+
+
+if __name__ == "__main__":
+    mainRoutine()
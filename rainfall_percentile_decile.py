@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+This script combines the percentile score (total_rain_percentileofscore.py) and decile rank (perc_to_decile.py) stages.
+The seasonal total rainfall and the historical totals are read once per block and the percentile score raster,
+the decile rank raster or both are written from the same pass, so the decile no longer needs to re-read the
+percentile raster.
+
+Parameters:
+-----------
+
+imglist : str
+            is a string to name of the txt file or csv file containing the list of seasonal rainfall grids used to compare the current seasonal period with.
+
+img: str
+             is a string containing the name of the input file to calculate the percentile score
+
+percentile : str
+            is an optional name of the output percentile score image following the naming convetion: NT_201805201904_perc_rainfall_a2.tif.
+
+decile : str
+            is an optional name of the output decile rank image following the naming convetion: NT_201805201904_decile_rainfall_a2.tif.
+
+kind : str
+            is the percentile definition (rank, weak, strict or mean) used to rank the score, the default is rank.
+
+policy : str
+            is the output data type policy (see output_policy.py), the default writes the percentile score as uint16 
+            hundredths of a percent and the decile rank as uint8 with the nodata value 0.
+
+memory : float
+            is the memory budget of a block in MB (default 512), the window size is chosen from the budget, the number of 
+            layers and their data type (see block_plan.py).
+
+"""
+
+from __future__ import print_function, division
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from rios import applier, fileinfo
+import percentile_rank
+import total_rain_percentileofscore
+import perc_to_decile
+import output_policy
+import block_plan
+import run_report
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("-l","--imglist", help="input list of imagery to process, should be a pandas df without a header")
+
+    p.add_argument("-i","--img", help="input imagery to calculate the percentile score")
+
+    p.add_argument("-p","--percentile", help="name of the output percentile score image")
+
+    p.add_argument("-d","--decile", help="name of the output decile rank image")
+
+    p.add_argument("-k","--kind", default='rank', choices=percentile_rank.KINDS, help="percentile definition used to rank the score (default rank)")
+
+    p.add_argument("--policy", default=output_policy.DEFAULT_POLICY, choices=sorted(output_policy.POLICIES), help="output data type policy (see output_policy.py)")
+
+    block_plan.add_arguments(p)
+
+    run_report.add_arguments(p)
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.imglist is None or (cmdargs.percentile is None and cmdargs.decile is None):
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def percentile_decile(listimg, img, percentile=None, decile=None, kind='rank', policy=output_policy.DEFAULT_POLICY, memory_mb=block_plan.DEFAULT_MEMORY_MB):
+
+    """
+    Calculate the percentile score of img against the list of historical totals and write the percentile
+    and/or decile rank rasters. Each output has its own data type, scale, creation options and nodata value
+    set by the output policy.
+    """
+    if percentile is None and decile is None:
+        raise ValueError('at least one of the percentile or decile outputs is required')
+
+    infiles = applier.FilenameAssociations()
+    outfiles = applier.FilenameAssociations()
+    otherargs = applier.OtherInputs()
+
+    infiles.imglist = listimg
+    infiles.img = img
+
+    controls = applier.ApplierControls()
+    controls.setOutputDriverName('GTiff')
+    block_plan.set_windows(controls, block_plan.image_plan(img, len(listimg) + 1, memory_mb))
+
+    # percentile score, the floating point (or horizontal differencing for the scaled integer scores) predictor
+    # improves the compression of the scores
+    if percentile is not None:
+        outfiles.percentile = percentile
+        predictor = 'PREDICTOR=3' if output_policy.stage_policy('percentile', policy)['dtype'].startswith('float') else 'PREDICTOR=2'
+        controls.setCreationOptions(['COMPRESS=LZW', predictor, 'BIGTIFF=YES', 'TILED=YES', 'INTERLEAVE=BAND','BLOCKXSIZE=256','BLOCKYSIZE=256'], imagename='percentile')
+        controls.setStatsIgnore(output_policy.stage_policy('percentile', policy)['nodata'], imagename='percentile')
+
+    # integer decile ranks 1 to 10
+    if decile is not None:
+        outfiles.decile = decile
+        controls.setCreationOptions(['COMPRESS=LZW', 'BIGTIFF=YES', 'TILED=YES', 'INTERLEAVE=BAND','BLOCKXSIZE=256','BLOCKYSIZE=256'], imagename='decile')
+        controls.setStatsIgnore(output_policy.stage_policy('decile', policy)['nodata'], imagename='decile')
+
+    # set up the nodata values
+    imginfo = fileinfo.ImageInfo(img)
+    otherargs.coverNull = imginfo.nodataval[0]
+    otherargs.kind = kind
+    otherargs.writePercentile = percentile is not None
+    otherargs.writeDecile = decile is not None
+    otherargs.policy = policy
+
+    with run_report.stage('percentile_decile', reads=listimg + [img], writes=[name for name in (percentile, decile) if name is not None]):
+        applier.apply(dostats, infiles, outfiles, otherargs, controls=controls)
+
+    for output, stage in ((percentile, 'percentile'), (decile, 'decile')):
+        if output is not None:
+            output_policy.set_metadata(output, stage, policy)
+            output_policy.convert_to_cog(output, stage)
+            print (output + ' is complete')
+
+
+@run_report.timed_block('percentile_decile')
+def dostats(info, inputs, outputs, otherargs):
+
+    """
+    Called from RIOS. calculate the percentile score for the block and convert it to decile ranks
+    """
+    np.seterr(all='ignore')
+
+    percImage = total_rain_percentileofscore.percentile_block(inputs, otherargs)
+    percentile = output_policy.encode(percImage, percImage == -1, 'percentile', otherargs.policy)
+
+    if otherargs.writePercentile:
+        outputs.percentile = np.array([percentile])
+
+    if otherargs.writeDecile:
+        # the decile is ranked from the stored percentile score (e.g. rounded to 0.01), as perc_to_decile.py reads
+        # it, so a score on a decile boundary gets the same rank from both scripts
+        rule = output_policy.stage_policy('percentile', otherargs.policy)
+        decile = perc_to_decile.decile_from_percentile(output_policy.decode(percentile, rule['nodata'], rule['scale']))
+        outputs.decile = np.array([output_policy.encode(decile, decile == -1, 'decile', otherargs.policy)])
+
+
+def mainRoutine():
+
+    cmdargs = getCmdargs()
+
+    with run_report.session(cmdargs.report, cmdargs.profile):
+        # read in the list of historical seasonal totals
+        df = pd.read_csv(cmdargs.imglist, header=None)
+        listimg = df[0].values.tolist()
+
+        percentile_decile(listimg, cmdargs.img, cmdargs.percentile, cmdargs.decile, cmdargs.kind, cmdargs.policy, cmdargs.memory)
+
+
+if __name__ == "__main__":
+    mainRoutine()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+"""
+This script runs the seasonal total rainfall workflow in a single process. The total rainfall is calculated from the
+monthly rainfall grids (total_rainfall.py), reprojected to GDA94 / Australian Albers (reproject_raster_ea.py) and clipped
+to the NT boundary (clip_raster_nt_bnd_ea.py) by calling the functions directly rather than starting a new python
+interpreter for every stage.
+
+When the grids fit within the memory limit the arrays are passed between the stages in memory and only the stage
+outputs are written to disk, otherwise each stage reads the previous stage's output file. Any failure raises an error.
+
+Parameters:
+-----------
+
+imglist : str
+            is a string to name of the txt file or csv file containing the list of monthly rainfall grids used to produce the output
+            total rainfall grid.
+
+output : str
+            is a string with the directory and the output file name given to the total rainfall seasonal grid.
+
+outputNT : str
+            is a string with the directory and the output file name given to the NT total rainfall seasonal grid.
+
+windowed : bool
+            if set only the rows of the monthly rainfall grids covering the NT boundary (plus a small margin) are read, summed 
+            and reprojected, the NT output is unchanged but the AU and _a2 outputs only cover the window.
+
+boundary : str
+            is the shapefile used to clip the total rainfall grid, the default is the NT boundary (clip_raster_nt_bnd_ea.NT_BND).
+
+cache : str
+            is the directory used to cache the reprojection plans (see reproject_raster_ea.get_plan), the default is 
+            ~/.cache/rainfall-raster-analysis/reprojection_plans.
+
+"""
+
+from __future__ import print_function, division
+import sys
+import argparse
+import math
+import rasterio
+import rasterio.features
+import rasterio.windows
+from rasterio.warp import transform_bounds
+import total_rainfall
+import reproject_raster_ea
+import clip_raster_nt_bnd_ea
+import output_policy
+import run_report
+
+# arrays larger than this (in MB) are passed between the stages on disk
+MEMORY_LIMIT_MB = 1024
+
+# number of pixels added around the region window in both the source and destination grids
+REGION_MARGIN = 2
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("-l","--imglist", help="Input list of imagery to calculate the total rainfall for the given period")
+
+    p.add_argument("-a","--output", help="provide the output directory and file name for the total rainfall grid")
+
+    p.add_argument("-n","--outputNT", help="provide the output directory and file name for the NT total rainfall grid")
+
+    p.add_argument("-w","--windowed", action="store_true", help="only read, sum and reproject the rows of the grids covering the NT boundary")
+
+    p.add_argument("-b","--boundary", default=clip_raster_nt_bnd_ea.NT_BND, help="shapefile used to clip the total rainfall grid")
+
+    p.add_argument("-c","--cache", default=reproject_raster_ea.PLAN_CACHE, help="directory used to cache the reprojection plans")
+
+    p.add_argument("--policy", default=output_policy.DEFAULT_POLICY, choices=sorted(output_policy.POLICIES), help="output data type policy for the totals (see output_policy.py)")
+
+    run_report.add_arguments(p)
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.imglist is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def write_raster(path, array, profile, stage='total'):
+
+    """
+    write a single band array to disk as a COG with the overviews of the stage (see output_policy.cog_profile)
+    """
+    with run_report.stage('write', writes=[path]):
+        with rasterio.open(path, 'w', **output_policy.cog_profile(profile, stage)) as dst:
+            dst.write(array, 1)
+
+
+def fits_in_memory(img, limit_mb=MEMORY_LIMIT_MB):
+
+    """
+    check if the grid of img is small enough to pass between the stages in memory, allowing for the
+    float32 running total, the total and the reprojected copy
+    """
+    with rasterio.open(img) as src:
+        size_mb = src.width * src.height * 4 * 3 / 1024.0 / 1024.0
+
+    return size_mb <= limit_mb
+
+
+def pad_window(window, margin, width, height):
+
+    """
+    round a window out to whole pixels, add the margin and limit it to the grid (width, height)
+    """
+    col0 = max(int(math.floor(window.col_off)) - margin, 0)
+    row0 = max(int(math.floor(window.row_off)) - margin, 0)
+    col1 = min(int(math.ceil(window.col_off + window.width)) + margin, width)
+    row1 = min(int(math.ceil(window.row_off + window.height)) + margin, height)
+
+    if col1 <= col0 or row1 <= row0:
+        raise ValueError('the region does not overlap the grid')
+
+    return rasterio.windows.Window(col0, row0, col1 - col0, row1 - row0)
+
+
+def region_plan(img, shapes, dst_crs='EPSG:3577', margin=REGION_MARGIN):
+
+    """
+    Work out the part of the grids needed to produce the region covered by the shapes (in dst_crs). 
+
+    The destination rows covering the region are cut from the grid the full source is reprojected to, so the pixels 
+    line up with the full continent output, and the source rows cover the reprojected bounds of those rows. Full 
+    width rows are used because gdal's approximate warp transformer is calculated along each destination scanline, 
+    so warping full width rows gives exactly the same pixels as warping the whole grid; the region columns are 
+    then cropped out of the reprojected rows.
+
+    Returns the source window, the destination grid (transform, width, height) of the rows and the window of the
+    region within those rows.
+    """
+    with rasterio.open(img) as src:
+        profile = src.profile.copy()
+
+    dst_transform, dst_width, dst_height = reproject_raster_ea.default_grid(profile, dst_crs)
+
+    # the bounds of the region in the destination crs
+    shape_bounds = [rasterio.features.bounds(shape) for shape in shapes]
+    region = (min(b[0] for b in shape_bounds), min(b[1] for b in shape_bounds),
+              max(b[2] for b in shape_bounds), max(b[3] for b in shape_bounds))
+
+    region_window = pad_window(rasterio.windows.from_bounds(*region, transform=dst_transform), margin, dst_width, dst_height)
+
+    # full width destination rows covering the region
+    dst_window = rasterio.windows.Window(0, region_window.row_off, dst_width, region_window.height)
+    dst_grid = (rasterio.windows.transform(dst_window, dst_transform), int(dst_window.width), int(dst_window.height))
+    dst_crop = rasterio.windows.Window(region_window.col_off, 0, region_window.width, region_window.height)
+
+    # full width source rows covering the destination rows
+    src_bounds = transform_bounds(dst_crs, profile['crs'], *rasterio.windows.bounds(dst_window, dst_transform), densify_pts=21)
+    src_rows = pad_window(rasterio.windows.from_bounds(*src_bounds, transform=profile['transform']), margin, profile['width'], profile['height'])
+    src_window = rasterio.windows.Window(0, src_rows.row_off, profile['width'], src_rows.height)
+
+    return src_window, dst_grid, dst_crop
+
+
+def run_season(listimg, output, outputNT, inshp=clip_raster_nt_bnd_ea.NT_BND, shapes=None, windowed=False, cache_dir=reproject_raster_ea.PLAN_CACHE,
+               policy=output_policy.DEFAULT_POLICY):
+
+    """
+    Produce the total rainfall grid (output), the reprojected grid (output with _a2.tif) and the NT clipped grid
+    (outputNT) for the list of monthly rainfall grids. The shapes used for clipping can be supplied to avoid
+    re-reading the shapefile for every season. If windowed is set only the part of the grids covering the
+    shapes is processed (see region_plan). The reprojection plans are cached in cache_dir (None to warp
+    with gdal every time) and the totals are written with the output policy. Returns the NT output file name.
+    """
+    if len(listimg) == 0:
+        raise ValueError('there are no monthly rainfall grids to calculate ' + output)
+
+    repro_img = output[:-4] + "_a2.tif"
+
+    if shapes is None:
+        shapes = clip_raster_nt_bnd_ea.read_shapes(inshp)
+
+    if windowed:
+        src_window, dst_grid, dst_crop = region_plan(listimg[0], shapes)
+        Total_rainfall, profile = total_rainfall.total_rainfall_array(listimg, src_window, policy)
+        return run_total(Total_rainfall, profile, output, outputNT, shapes, dst_grid, dst_crop, cache_dir)
+
+    if fits_in_memory(listimg[0]):
+        Total_rainfall, profile = total_rainfall.total_rainfall_array(listimg, policy=policy)
+        return run_total(Total_rainfall, profile, output, outputNT, shapes, cache_dir=cache_dir)
+
+    total_rainfall.calc_total_rainfall(listimg, output, policy)
+    reproject_raster_ea.reproject_image(output, repro_img, cache_dir=cache_dir)
+    clip_raster_nt_bnd_ea.clip_image(repro_img, outputNT, inshp)
+
+    print (outputNT + ' has been clipped to the NT boundary')
+
+    return outputNT
+
+
+def run_total(Total_rainfall, profile, output, outputNT, shapes, dst_grid=None, dst_crop=None, cache_dir=reproject_raster_ea.PLAN_CACHE):
+
+    """
+    Write the total rainfall array (output), reproject it (output with _a2.tif) and clip it to the shapes
+    (outputNT) passing the arrays between the stages in memory. dst_grid is an optional destination grid
+    (transform, width, height) for the reprojection and dst_crop an optional window cropped from the 
+    reprojected grid (see region_plan) and cache_dir the reprojection plan cache. Returns the NT output file name.
+    """
+    repro_img = output[:-4] + "_a2.tif"
+
+    write_raster(output, Total_rainfall, profile)
+    print (output + ' is complete')
+
+    repro, repro_profile = reproject_raster_ea.reproject_array(Total_rainfall, profile, dst_grid=dst_grid, cache_dir=cache_dir)
+    if dst_crop is not None:
+        repro = repro[dst_crop.toslices()]
+        repro_profile = total_rainfall.window_profile(repro_profile, dst_crop)
+    write_raster(repro_img, repro, repro_profile)
+    print (output + ' has been reprojected')
+
+    clipped, clip_profile = clip_raster_nt_bnd_ea.clip_array(repro, repro_profile, shapes)
+    write_raster(outputNT, clipped, clip_profile)
+
+    print (outputNT + ' has been clipped to the NT boundary')
+
+    return outputNT
+
+
+def mainRoutine():
+
+    """Run mainRoutine"""
+
+    cmdargs = getCmdargs()
+
+    with run_report.session(cmdargs.report, cmdargs.profile):
+        listimg = total_rainfall.readlist(cmdargs.imglist)
+
+        run_season(listimg, cmdargs.output, cmdargs.outputNT, cmdargs.boundary, windowed=cmdargs.windowed, cache_dir=cmdargs.cache, policy=cmdargs.policy)
+
+
+if __name__ == "__main__":
+    mainRoutine()
@@ -38,6 +38,10 @@ Parameters:
 img : str 
             is a directory path and name of the raster image to reproject to GDA94 / Australian Albers.
 
+cache : str
+            is an optional directory used to cache the reprojection plan (the source pixel used for every output pixel), 
+            so repeated reprojections of the same grid are a numpy gather instead of a warp.
+
 """
 
 
@@ -47,8 +51,23 @@ import argparse
 import numpy as np
 import pandas as pd
 import rasterio
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+import rasterio.transform
+import rasterio.crs
+from rasterio.warp import calculate_default_transform, reproject, Resampling, transform
+import hashlib
+import json
 import pdb
+import output_policy
+import run_report
+
+# default directory for the cached reprojection plans
+PLAN_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "rainfall-raster-analysis", "reprojection_plans")
+
+# reprojection plans already loaded in this process
+loaded_plans = {}
+
+# number of sub-pixel samples along each axis used to build the weights for average resampling
+AVERAGE_SAMPLES = 4
 
 
 #function to get cmd line inputs
@@ -57,6 +76,10 @@ def getCmdargs():
     p = argparse.ArgumentParser()
     
     p.add_argument("-i","--img", help="raster imagery to reproject to GDA94 / Australian Albers")
+    
+    p.add_argument("-c","--cache", help="directory used to cache the reprojection plan, by default the image is warped with gdal")
+    
+    p.add_argument("-s","--stage", default='total', choices=sorted(output_policy.OVERVIEW_RESAMPLING), help="stage of the image, sets the resampling of the overviews (default total)")
  
 
     cmdargs = p.parse_args()
@@ -70,34 +93,291 @@ def getCmdargs():
     return cmdargs
 
    
-def main():
+def default_grid(profile, dst_crs='EPSG:3577'):
     
-    cmdargs = getCmdargs()
+    """
+    returns the (transform, width, height) of the grid the source profile is reprojected to
+    """
+    return calculate_default_transform(profile['crs'], dst_crs, profile['width'], profile['height'],
+                                       *rasterio.transform.array_bounds(profile['height'], profile['width'], profile['transform']))
+
+
+def reproject_array(array, profile, dst_crs='EPSG:3577', dst_grid=None, cache_dir=None):
+    
+    """
+    Reproject a single band array in memory using nearest neighbour resampling. The destination grid 
+    (transform, width, height) defaults to the grid calculated from the full extent of the source. If a 
+    cache directory is supplied the cached reprojection plan for the grid is used (see get_plan).
+    Returns the reprojected array and the updated rasterio profile.
+    """
+    if dst_grid is None:
+        dst_grid = default_grid(profile, dst_crs)
+    dst_transform, width, height = dst_grid
+    
+    kwargs = profile.copy()
+    kwargs.update({'crs': dst_crs,'transform': dst_transform,'width': width,'height': height})
+    
+    nodata = profile.get('nodata')
+    
+    with run_report.stage('reproject'):
+        if cache_dir is not None:
+            plan = get_plan(profile, dst_crs, 'nearest', dst_grid, cache_dir)
+            return plan.apply(array, nodata), kwargs
         
-    # open the list of imagery and read it into memory
-    inImage = cmdargs.img
+        destination = np.full((height, width), 0 if nodata is None else nodata, dtype=array.dtype)
         
-    # create the output file name by removeing the .shp and replacing it with .tif
-    out_img = inImage[:-4] + "_a2.tif"
-    print (out_img)
-              
-    #pdb.set_trace()
+        reproject(source=array,destination=destination,src_transform=profile['transform'],src_crs=profile['crs'],src_nodata=nodata,
+                  dst_transform=dst_transform,dst_crs=dst_crs,dst_nodata=nodata,resampling=Resampling.nearest)
+    
+    return destination, kwargs
+
+
+class ReprojectionPlan(object):
+    
+    """
+    The mapping from the source grid to the destination grid. For nearest neighbour resampling the plan holds 
+    the flat index of the source pixel used for every destination pixel (-1 outside the source), for bilinear 
+    and average resampling it holds (destination index, source index, weight) triplets which are combined 
+    with a bincount, ignoring nodata source pixels.
+    """
+    
+    def __init__(self, resampling, shape, src_index, dst_index=None, weights=None):
+        
+        self.resampling = resampling
+        self.shape = tuple(shape)
+        self.src_index = src_index
+        self.dst_index = dst_index
+        self.weights = weights
+    
+    def apply(self, array, nodata=None):
+        
+        """
+        reproject the source array, destination pixels without a valid source pixel are set to nodata (or 0)
+        """
+        fill = 0 if nodata is None else nodata
+        values = np.asarray(array).ravel()
+        
+        if self.resampling == 'nearest':
+            destination = np.full(self.src_index.size, fill, dtype=values.dtype)
+            inside = self.src_index >= 0
+            destination[inside] = values[self.src_index[inside]]
+            return destination.reshape(self.shape)
+        
+        sample = values[self.src_index].astype(np.float64)
+        valid = ~np.isnan(sample)
+        if nodata is not None:
+            valid &= sample != nodata
+        
+        size = self.shape[0] * self.shape[1]
+        total = np.bincount(self.dst_index[valid], weights=self.weights[valid] * sample[valid], minlength=size)
+        weight = np.bincount(self.dst_index[valid], weights=self.weights[valid], minlength=size)
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = total / weight
+        
+        if np.issubdtype(values.dtype, np.integer):
+            result = np.round(result)
+        result[weight == 0] = fill
+        
+        return result.astype(values.dtype).reshape(self.shape)
+    
+    def save(self, path):
         
-    dst_crs = 'EPSG:3577'
-
-    with rasterio.open(inImage) as src:
-        transform, width, height = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
-        kwargs = src.meta.copy()
-        kwargs.update({'crs': dst_crs,'transform': transform,'width': width,'height': height})
-                        
-        with rasterio.open(out_img, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
-                reproject(source=rasterio.band(src, i),destination=rasterio.band(dst,i),src_transform=src.transform,src_crs=src.crs,dst_transform=transform,dst_crs=dst_crs,resampling=Resampling.nearest)
+        arrays = {'shape': np.array(self.shape), 'src_index': self.src_index}
+        if self.dst_index is not None:
+            arrays.update({'dst_index': self.dst_index, 'weights': self.weights})
+        
+        # write to a temporary file first so an interrupted run does not leave a broken plan in the cache
+        tmp = path + '.' + str(os.getpid()) + '.tmp.npz'
+        np.savez(tmp, resampling=np.array(self.resampling), **arrays)
+        os.replace(tmp, path)
+    
+    @classmethod
+    def load(cls, path):
+        
+        with np.load(path) as plan:
+            dst_index = plan['dst_index'] if 'dst_index' in plan else None
+            weights = plan['weights'] if 'weights' in plan else None
+            return cls(str(plan['resampling']), plan['shape'], plan['src_index'], dst_index, weights)
+
+
+def plan_key(profile, dst_crs, resampling, dst_grid):
+    
+    """
+    returns a hash identifying the source grid, the destination grid and the resampling
+    """
+    dst_transform, width, height = dst_grid
+    
+    key = {'src_crs': rasterio.crs.CRS.from_user_input(profile['crs']).to_wkt(),
+           'src_transform': list(profile['transform'])[:6],
+           'src_shape': [profile['height'], profile['width']],
+           'dst_crs': rasterio.crs.CRS.from_user_input(dst_crs).to_wkt(),
+           'dst_transform': list(dst_transform)[:6],
+           'dst_shape': [height, width],
+           'resampling': resampling}
+    
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def build_nearest_plan(profile, dst_crs, dst_grid):
+    
+    """
+    Build the nearest neighbour plan by warping an image of the source pixel indices with gdal, so the plan picks 
+    exactly the same source pixels as reproject (including gdal's approximate transformer).
+    """
+    dst_transform, width, height = dst_grid
+    
+    index = np.arange(profile['height'] * profile['width'], dtype=np.int32).reshape(profile['height'], profile['width'])
+    destination = np.full((height, width), -1, dtype=np.int32)
+    
+    reproject(source=index,destination=destination,src_transform=profile['transform'],src_crs=profile['crs'],src_nodata=-1,
+              dst_transform=dst_transform,dst_crs=dst_crs,dst_nodata=-1,resampling=Resampling.nearest)
+    
+    return ReprojectionPlan('nearest', (height, width), destination.ravel())
+
+
+def source_coords(profile, dst_crs, dst_transform, rows, cols):
+    
+    """
+    returns the fractional source pixel (col, row) coordinates of the destination pixel coordinates
+    """
+    xs, ys = rasterio.transform.xy(dst_transform, rows, cols, offset='ul')
+    src_xs, src_ys = transform(dst_crs, profile['crs'], np.asarray(xs).ravel(), np.asarray(ys).ravel())
+    src_cols, src_rows = ~profile['transform'] * (np.asarray(src_xs), np.asarray(src_ys))
+    
+    return src_cols, src_rows
+
+
+def build_weighted_plan(profile, dst_crs, dst_grid, resampling):
+    
+    """
+    Build the plan for bilinear (the four source pixels around each destination pixel centre) or average 
+    (sub-pixel samples of each destination pixel) resampling using the exact coordinate transformation.
+    """
+    dst_transform, width, height = dst_grid
+    rows, cols = np.mgrid[0:height, 0:width]
+    dst_flat = (rows * width + cols).ravel()
+    
+    dst_parts, src_parts, weight_parts = [], [], []
+    
+    def add(dst, src_cols, src_rows, weight):
+        inside = (src_cols >= 0) & (src_cols < profile['width']) & (src_rows >= 0) & (src_rows < profile['height']) & (weight > 0)
+        dst_parts.append(dst[inside])
+        src_parts.append((src_rows[inside] * profile['width'] + src_cols[inside]).astype(np.int64))
+        weight_parts.append(weight[inside].astype(np.float32))
+    
+    if resampling == 'bilinear':
+        src_cols, src_rows = source_coords(profile, dst_crs, dst_transform, rows.ravel() + 0.5, cols.ravel() + 0.5)
+        # the pixel centres of the source are at the half pixel positions
+        fx = src_cols - 0.5
+        fy = src_rows - 0.5
+        c0 = np.floor(fx).astype(np.int64)
+        r0 = np.floor(fy).astype(np.int64)
+        wx = fx - c0
+        wy = fy - r0
+        for dc, dr, weight in ((0, 0, (1 - wx) * (1 - wy)), (1, 0, wx * (1 - wy)), (0, 1, (1 - wx) * wy), (1, 1, wx * wy)):
+            add(dst_flat, c0 + dc, r0 + dr, weight)
+    
+    elif resampling == 'average':
+        weight = np.full(dst_flat.size, 1.0 / AVERAGE_SAMPLES ** 2)
+        for i in range(AVERAGE_SAMPLES):
+            for j in range(AVERAGE_SAMPLES):
+                offset_row = (i + 0.5) / AVERAGE_SAMPLES
+                offset_col = (j + 0.5) / AVERAGE_SAMPLES
+                src_cols, src_rows = source_coords(profile, dst_crs, dst_transform, rows.ravel() + offset_row, cols.ravel() + offset_col)
+                add(dst_flat, np.floor(src_cols).astype(np.int64), np.floor(src_rows).astype(np.int64), weight)
+    
+    else:
+        raise ValueError('resampling can only be nearest, bilinear or average')
+    
+    return ReprojectionPlan(resampling, (height, width), np.concatenate(src_parts), np.concatenate(dst_parts), np.concatenate(weight_parts))
+
+
+def get_plan(profile, dst_crs='EPSG:3577', resampling='nearest', dst_grid=None, cache_dir=PLAN_CACHE):
+    
+    """
+    Return the reprojection plan for the source grid described by the rasterio profile, loading it from the 
+    cache directory if it has been built before, otherwise building it and saving it to the cache.
+    """
+    if dst_grid is None:
+        dst_grid = default_grid(profile, dst_crs)
+    
+    key = plan_key(profile, dst_crs, resampling, dst_grid)
+    
+    if key in loaded_plans:
+        return loaded_plans[key]
+    
+    path = os.path.join(cache_dir, key + '.npz')
+    
+    if os.path.exists(path):
+        plan = ReprojectionPlan.load(path)
+    else:
+        if resampling == 'nearest':
+            plan = build_nearest_plan(profile, dst_crs, dst_grid)
+        else:
+            plan = build_weighted_plan(profile, dst_crs, dst_grid, resampling)
+        
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        plan.save(path)
+        print ('reprojection plan saved to ' + path)
+    
+    loaded_plans[key] = plan
+    
+    return plan
+
+
+def reproject_image(inImage, out_img=None, dst_crs='EPSG:3577', cache_dir=None, stage='total'):
+    
+    """
+    Reproject the raster image to GDA94 / Australian Albers, by default the output file name 
+    is the input file name with _a2.tif replacing .tif. If a cache directory is supplied the 
+    cached reprojection plan is used. The output is a COG with the overviews of the stage.
+    Returns the output file name.
+    """
+    if out_img is None:
+        # create the output file name by removeing the .tif and replacing it with _a2.tif
+        out_img = inImage[:-4] + "_a2.tif"
+    print (out_img)
+    
+    with run_report.stage('reproject', reads=[inImage], writes=[out_img]):
+        if cache_dir is not None:
+            with rasterio.open(inImage) as src:
+                profile = src.profile.copy()
+                bands = src.read()
+            
+            plan = get_plan(profile, dst_crs, 'nearest', cache_dir=cache_dir)
+            kwargs = profile.copy()
+            kwargs.update({'crs': dst_crs,'transform': default_grid(profile, dst_crs)[0],'width': plan.shape[1],'height': plan.shape[0]})
+            
+            with rasterio.open(out_img, 'w', **output_policy.cog_profile(kwargs, stage)) as dst:
+                for i in range(bands.shape[0]):
+                    dst.write(plan.apply(bands[i], profile.get('nodata')), i + 1)
+            print (out_img, ' has been reprojected')
+            
+            return out_img
+
+        with rasterio.open(inImage) as src:
+            transform, width, height = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+            kwargs = src.meta.copy()
+            kwargs.update({'crs': dst_crs,'transform': transform,'width': width,'height': height})
+                            
+            with rasterio.open(out_img, 'w', **output_policy.cog_profile(kwargs, stage)) as dst:
+                for i in range(1, src.count + 1):
+                    reproject(source=rasterio.band(src, i),destination=rasterio.band(dst,i),src_transform=src.transform,src_crs=src.crs,dst_transform=transform,dst_crs=dst_crs,resampling=Resampling.nearest)
     print (out_img, ' has been reprojected')
     
-    repro_img = out_img
+    return out_img
+
+   
+def main():
+    
+    cmdargs = getCmdargs()
+        
+    # open the list of imagery and read it into memory
+    inImage = cmdargs.img
     
-    src.close()
+    reproject_image(inImage, cache_dir=cmdargs.cache, stage=cmdargs.stage)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
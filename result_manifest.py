@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Manifest of the outputs produced by the workflow, keyed by a hash of everything used to produce them, so a rerun only
+recalculates the outputs whose inputs have changed (e.g. after SILO revises a few historical monthly grids).
+
+The key of an output is the sha1 of the stage name, the name and fingerprint of every input file and the parameters of
+the stage (e.g. the season, target crs, boundary checksum and output policy). The fingerprint of a file is its size and
+modification time, or the sha1 of its contents if checksum is set (slower, but not fooled by files copied or touched
+without changing). The manifest also saves the size and modification time of the outputs, so an output that has been
+deleted or overwritten outside the workflow is recalculated.
+
+Because the key of a stage includes the fingerprints of its input files, a recalculated seasonal total changes the key
+of the percentile and decile outputs made from it, so the change is carried down the workflow.
+
+"""
+
+from __future__ import print_function, division
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = 'rainfall_manifest.json'
+
+
+def file_fingerprint(path, checksum=False):
+
+    """
+    returns the size and modification time of the file (or the sha1 of its contents if checksum is set),
+    None if the file does not exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    if not checksum:
+        return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+
+    return {'size': st.st_size, 'sha1': sha.hexdigest()}
+
+
+class ResultManifest(object):
+
+    """
+    The saved keys and output fingerprints of the results produced by the workflow. Each result is named
+    (e.g. by its main output file) and holds the key of its inputs and the fingerprints of its outputs.
+    """
+
+    def __init__(self, path, checksum=False):
+
+        self.path = path
+        self.checksum = checksum
+        self.inputs = {}
+        self.results = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.results = json.load(f).get('results', {})
+
+    def input_fingerprint(self, path):
+
+        # the input files do not change during a run so each is only fingerprinted once
+        if path not in self.inputs:
+            self.inputs[path] = file_fingerprint(path, self.checksum)
+
+        return self.inputs[path]
+
+    def key(self, stage, inputs, params=None):
+
+        """
+        returns the key (sha1) of the stage run on the input files with the parameters (a json serialisable dictionary)
+        """
+        content = {'stage': stage,
+                   'inputs': [[os.path.basename(str(path)), self.input_fingerprint(path)] for path in inputs],
+                   'params': params or {}}
+
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def current(self, name, key, outputs):
+
+        """
+        check if the result was produced with the same key and its outputs have not changed since
+        """
+        record = self.results.get(name)
+        if record is None or record['key'] != key:
+            return False
+
+        return all(out in record['outputs'] and file_fingerprint(out) == record['outputs'][out] for out in outputs)
+
+    def record(self, name, key, outputs):
+
+        """
+        save the key and the fingerprints of the outputs of a result that has just been produced
+        """
+        self.results[name] = {'key': key, 'outputs': dict((out, file_fingerprint(out)) for out in outputs)}
+
+    def forget(self, name):
+
+        self.results.pop(name, None)
+
+    def save(self):
+
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        tmp = self.path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'results': self.results}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def open_manifest(path, checksum=False):
+
+    """
+    returns the manifest saved in path, or None if path is None (no manifest is kept)
+    """
+    if path is None:
+        return None
+
+    return ResultManifest(path, checksum)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Opt-in instrumentation of the workflow scripts. When a run report is requested (--report on the command line of the
+workflow scripts) the wall and CPU time of every stage and of every RIOS block, the size of the files read and written
+by each stage and the peak resident memory are recorded and written to a json run report at the end of the run, so it
+can be seen whether reading, warping or ranking dominates a slow run.
+
+If a profile file is also given (--profile) every stage is run under cProfile and the profile of the slowest stage is
+saved, it can be viewed with python -m pstats or snakeviz.
+
+When no report is requested the stages and blocks are run without any timing.
+
+The report holds;
+
+stages : for every stage the number of calls, wall and CPU seconds and the bytes read and written.
+blocks : for every RIOS callback the number of blocks, the total wall and CPU seconds and the slowest block.
+files  : every file read or written with its size and the stage it belongs to.
+
+Stages and blocks run in worker processes (e.g. the parallel percentile blocks or the seasons of
+multi_seasonal_rainfall.py) are recorded in the worker with worker and returned with the result of the task, the
+parent process adds them to its report with merge. Their wall and CPU seconds are summed over the workers, so they
+can be more than the wall time of the run.
+
+"""
+
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import datetime
+import functools
+import contextlib
+import cProfile
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, the peak memory is not reported
+    resource = None
+
+# the report of the current run, None when the run is not instrumented
+current = None
+
+
+def add_arguments(p):
+
+    """
+    add the --report and --profile options to the argument parser of a script
+    """
+    p.add_argument("--report", help="json file to write a run report with the time of every stage and block")
+
+    p.add_argument("--profile", help="file to save the cProfile stats of the slowest stage to (requires --report)")
+
+
+def peak_rss_mb():
+
+    """
+    returns the peak resident memory of this process and its finished child processes in MB (None on windows)
+    """
+    if resource is None:
+        return None
+
+    # ru_maxrss is in bytes on macOS and KB elsewhere
+    unit = 1.0 if sys.platform == 'darwin' else 1024.0
+    selfRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    childRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+
+    return max(selfRss, childRss) / 1024.0 / 1024.0
+
+
+def file_size(path):
+
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+class RunReport(object):
+
+    """
+    The timings recorded for a run, see stage and timed_block.
+    """
+
+    def __init__(self, script, profile_path=None):
+
+        self.script = script
+        self.profile_path = profile_path
+        self.started = datetime.datetime.now().isoformat(timespec='seconds')
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.stages = {}
+        self.blocks = {}
+        self.files = []
+        self.profiler = None
+        self.slowest = None
+
+    def add_files(self, stage, paths, mode):
+
+        total = 0
+        for path in paths:
+            size = file_size(path)
+            self.files.append({'path': str(path), 'stage': stage, 'mode': mode, 'bytes': size})
+            total += size or 0
+
+        return total
+
+    @contextlib.contextmanager
+    def stage(self, name, reads=(), writes=()):
+
+        record = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'read_bytes': 0, 'written_bytes': 0})
+        record['read_bytes'] += self.add_files(name, reads, 'read')
+
+        # stages run inside another stage are included in the outer stage's profile
+        profiler = None
+        if self.profile_path is not None and self.profiler is None:
+            profiler = self.profiler = cProfile.Profile()
+            profiler.enable()
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+            if profiler is not None:
+                profiler.disable()
+                self.profiler = None
+                if self.slowest is None or wall > self.slowest[1]:
+                    self.slowest = (name, wall, profiler)
+
+            record['calls'] += 1
+            record['wall_seconds'] += wall
+            record['cpu_seconds'] += cpu
+            record['written_bytes'] += self.add_files(name, writes, 'written')
+
+    def add_block(self, name, wall, cpu):
+
+        record = self.blocks.get(name)
+        if record is None:
+            record = self.blocks[name] = {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'max_wall_seconds': 0.0}
+
+        record['count'] += 1
+        record['wall_seconds'] += wall
+        record['cpu_seconds'] += cpu
+        record['max_wall_seconds'] = max(record['max_wall_seconds'], wall)
+
+    def records(self):
+
+        return {'stages': self.stages, 'blocks': self.blocks, 'files': self.files}
+
+    def merge(self, records):
+
+        for name, worker in records['stages'].items():
+            record = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'read_bytes': 0, 'written_bytes': 0})
+            for field in record:
+                record[field] += worker[field]
+
+        for name, worker in records['blocks'].items():
+            record = self.blocks.setdefault(name, {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'max_wall_seconds': 0.0})
+            record['count'] += worker['count']
+            record['wall_seconds'] += worker['wall_seconds']
+            record['cpu_seconds'] += worker['cpu_seconds']
+            record['max_wall_seconds'] = max(record['max_wall_seconds'], worker['max_wall_seconds'])
+
+        self.files.extend(records['files'])
+
+    def summary(self):
+
+        report = {'script': self.script,
+                  'argv': sys.argv[1:],
+                  'started': self.started,
+                  'wall_seconds': time.perf_counter() - self.wall,
+                  'cpu_seconds': time.process_time() - self.cpu,
+                  'peak_rss_mb': peak_rss_mb(),
+                  'stages': self.stages,
+                  'blocks': self.blocks,
+                  'files': self.files}
+
+        if self.slowest is not None:
+            report['profile'] = {'stage': self.slowest[0], 'path': self.profile_path}
+
+        return report
+
+    def write(self, path):
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if self.slowest is not None:
+            self.slowest[2].dump_stats(self.profile_path)
+
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+        print ('run report saved to ' + path)
+
+
+@contextlib.contextmanager
+def session(path, profile_path=None, script=None):
+
+    """
+    Instrument the code run inside the session and write the run report to path at the end. Nothing is
+    recorded if path is None.
+    """
+    global current
+
+    if path is None:
+        yield None
+        return
+
+    current = RunReport(script or os.path.basename(sys.argv[0]), profile_path)
+    try:
+        yield current
+    finally:
+        report, current = current, None
+        report.write(path)
+
+
+def enabled():
+
+    """
+    returns True inside a session, passed to the worker processes so they know to record their tasks
+    """
+    return current is not None
+
+
+@contextlib.contextmanager
+def worker(enabled):
+
+    """
+    Record the stages and blocks of a task run in a worker process (or in this process as a task) in a report of
+    its own. Yields a dictionary that holds the records at the end of the task, to be returned with the result
+    and added to the report of the parent process with merge, or None if enabled (see enabled) is False.
+    """
+    global current
+
+    if not enabled:
+        yield None
+        return
+
+    outer, current = current, RunReport('worker')
+    records = {}
+    try:
+        yield records
+    finally:
+        records.update(current.records())
+        current = outer
+
+
+def merge(records):
+
+    """
+    add the records of a worker task (see worker) to the report of the session, nothing is recorded outside a
+    session or if records is None
+    """
+    if current is not None and records is not None:
+        current.merge(records)
+
+
+@contextlib.contextmanager
+def stage(name, reads=(), writes=()):
+
+    """
+    time the code run inside the stage and record the size of the files it reads and writes (the written
+    files are measured at the end of the stage), nothing is recorded outside a session
+    """
+    if current is None:
+        yield None
+        return
+
+    with current.stage(name, reads, writes) as record:
+        yield record
+
+
+def timed_block(name):
+
+    """
+    decorator for the RIOS callbacks (and other per block functions) recording the wall and CPU time of
+    every block under name, nothing is recorded outside a session
+    """
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current is None:
+                return func(*args, **kwargs)
+
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if current is not None:
+                    current.add_block(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+        return wrapper
+
+    return decorator
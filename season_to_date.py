@@ -0,0 +1,550 @@
+#!/usr/bin/env python
+"""
+This script updates the season to date total rainfall as each new SILO monthly rainfall grid arrives during the season,
+instead of summing every month from the start of the season again.
+
+The running total and the count of valid months of every pixel (on the monthly rainfall grid) are kept in a state
+directory with the months already added and the size and modification time of their grids. An update only reads the
+months that are not in the state yet; if a grid already added has changed (e.g. SILO has revised the month) or the
+season start is different the total is summed again from the start of the season.
+
+After the update the season to date total is written (AU grid, reprojected _a2 grid and the NT clip, as in
+rainfall_workflow.py) and scored against the same period of every earlier season, e.g. October to January 2022-2023 is
+ranked against October to January of every earlier year. The running total of the same period of every earlier
+season is also kept in the state directory (see PeriodTotals), so each monthly update only adds the new month of the
+period for every earlier season (one grid per year) before the totals are sorted into a climatology cube (see
+climatology_cube.py). Later runs of the same season length only score the new total against the cube. The cube is
+built again if the historical grids, boundary or settings change (see result_manifest.py).
+
+The season to date total can also be scored against a climatology cube of full seasons (cube).
+
+Parameters:
+-----------
+
+imglist : str
+            is a string to name of the txt file or csv file containing the list of monthly rainfall grids.
+
+direc : str
+            is the directory of monthly rainfall grids to select the grids from using the catalog (instead of imglist).
+
+catalog : str
+            is the json file used to save the index of the monthly rainfall grids (see rainfall_catalog.py).
+
+pattern : str
+            is the regular expression (with the named groups year and month) used to find the year and month in the monthly
+            rainfall grid file names, the default matches the SILO grids e.g. 202105.monthly_rain.tif.
+
+yearM_S : str
+            is the year and month of the start of the season i.e. 202210.
+
+yearM_f : str
+            is the year and month of the latest month to include, the default is the latest monthly rainfall grid.
+
+state : str
+            is the directory used to keep the running total, valid month count and same period climatology cubes of the season.
+
+output : str
+            is the directory and file name of the AU season to date total rainfall grid.
+
+outputNT : str
+            is the directory and file name of the NT season to date total rainfall grid.
+
+percentile : str
+            is an optional name of the percentile score of the season to date total against the same period of the earlier seasons.
+
+cube : str
+            is an optional climatology cube of full seasons (see climatology_cube.py) to score the season to date total against.
+
+seasonPercentile : str
+            is the name of the percentile score against the full season climatology cube (required with cube).
+
+kind : str
+            is the percentile definition (rank, weak, strict or mean) used to rank the score, the default is rank.
+
+boundary : str
+            is the shapefile used to clip the total rainfall grid, the default is the NT boundary (clip_raster_nt_bnd_ea.NT_BND).
+
+"""
+
+from __future__ import print_function, division
+import sys
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+import rasterio
+from affine import Affine
+import rainfall_catalog
+import rainfall_workflow
+import total_rainfall
+import reproject_raster_ea
+import clip_raster_nt_bnd_ea
+import climatology_cube
+import percentile_rank
+import output_policy
+import result_manifest
+import run_report
+
+STATE_NAME = 'state.json'
+TOTAL_NAME = 'total.npy'
+COUNT_NAME = 'count.npy'
+CLIMATOLOGY_DIR = 'climatology'
+PERIOD_NAME = 'period.json'
+PERIOD_TOTAL_NAME = 'period_total.npy'
+PERIOD_INVALID_NAME = 'period_invalid.npy'
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("-l","--imglist", help="input list of monthly rainfall grids, should be a pandas df without a header")
+
+    p.add_argument("-d","--direc", help="directory of monthly rainfall grids to select the grids from using the catalog (instead of imglist)")
+
+    p.add_argument("-c","--catalog", help="json file used to save the index of the monthly rainfall grids (see rainfall_catalog.py)")
+
+    p.add_argument("-t","--pattern", default=rainfall_catalog.GRID_PATTERN, help="regular expression with the named groups year and month used to date the monthly rainfall grids")
+
+    p.add_argument("-s","--yearM_S", help="the year and month of the start of the season i.e. 202210")
+
+    p.add_argument("-f","--yearM_f", help="the year and month of the latest month to include (default the latest grid)")
+
+    p.add_argument("-u","--state", help="directory used to keep the running total of the season")
+
+    p.add_argument("-a","--output", help="output directory and file name for the AU season to date total rainfall grid")
+
+    p.add_argument("-n","--outputNT", help="output directory and file name for the NT season to date total rainfall grid")
+
+    p.add_argument("-p","--percentile", help="name of the percentile score against the same period of the earlier seasons")
+
+    p.add_argument("--cube", help="climatology cube of full seasons to score the season to date total against")
+
+    p.add_argument("--seasonPercentile", help="name of the percentile score against the full season climatology cube")
+
+    p.add_argument("-k","--kind", default='rank', choices=percentile_rank.KINDS, help="percentile definition used to rank the score (default rank)")
+
+    p.add_argument("-b","--boundary", default=clip_raster_nt_bnd_ea.NT_BND, help="shapefile used to clip the total rainfall grid")
+
+    p.add_argument("--policy", default=output_policy.DEFAULT_POLICY, choices=sorted(output_policy.POLICIES), help="output data type policy (see output_policy.py)")
+
+    run_report.add_arguments(p)
+
+    cmdargs = p.parse_args()
+
+    if (cmdargs.imglist is None and cmdargs.direc is None) or cmdargs.yearM_S is None or cmdargs.state is None or cmdargs.outputNT is None:
+        p.print_help()
+        sys.exit()
+
+    if cmdargs.cube is not None and cmdargs.seasonPercentile is None:
+        p.error('--seasonPercentile is required with --cube')
+
+    return cmdargs
+
+
+class SeasonState(object):
+
+    """
+    The running total rainfall (float64, as total_rainfall.sum_months) and count of valid months (uint16) of every
+    pixel of the season, with the months added so far and the fingerprint (size and modification time) of their grids.
+    """
+
+    def __init__(self, state_dir):
+
+        self.state_dir = state_dir
+        self.start = None
+        self.months = {}
+        self.grid = None
+        self.total = None
+        self.count = None
+
+        path = os.path.join(state_dir, STATE_NAME)
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.start, self.months, self.grid = saved['start'], saved['months'], saved['grid']
+            self.total = np.load(os.path.join(state_dir, TOTAL_NAME))
+            self.count = np.load(os.path.join(state_dir, COUNT_NAME))
+
+    def reset(self, start, profile):
+
+        """
+        start a new season at the year and month start on the grid of the rasterio profile
+        """
+        self.start = start
+        self.months = {}
+        self.grid = {'geotransform': list(profile['transform'].to_gdal()), 'rows': profile['height'],
+                     'cols': profile['width'], 'nodata': profile['nodata']}
+        self.total = np.zeros((profile['height'], profile['width']), dtype=np.float64)
+        self.count = np.zeros((profile['height'], profile['width']), dtype=np.uint16)
+
+    def matches(self, start, profile, dated):
+
+        """
+        check the state is for the season starting at start on the same grid, and every month already added
+        (in dated, a list of (year and month, grid) pairs) still has the same grid
+        """
+        if self.start != start or self.grid is None or self.total.dtype != np.float64:
+            return False
+
+        if (self.grid['rows'], self.grid['cols']) != (profile['height'], profile['width']) or \
+                Affine.from_gdal(*self.grid['geotransform']) != profile['transform']:
+            return False
+
+        grids = dict(dated)
+        return all(yearM in grids and result_manifest.file_fingerprint(grids[yearM]) == fingerprint
+                   for yearM, fingerprint in self.months.items())
+
+    def add_month(self, yearM, img):
+
+        """
+        add the monthly rainfall grid to the running total, the nodata pixels (see total_rainfall.invalid_month)
+        are not added and not counted
+        """
+        profile = {'height': self.grid['rows'], 'width': self.grid['cols'], 'transform': Affine.from_gdal(*self.grid['geotransform'])}
+        month = total_rainfall.read_month(img, profile)
+
+        valid = ~total_rainfall.invalid_month(month, self.grid['nodata'])
+        np.add(self.total, month, out=self.total, where=valid, casting='unsafe')
+        self.count += valid
+
+        self.months[yearM] = result_manifest.file_fingerprint(img)
+
+    def season_total(self):
+
+        """
+        returns the season to date total rainfall (rounded with total_rainfall.round_total) with the pixels without
+        a valid value for every month set to -1, as in total_rainfall.sum_months
+        """
+        Total_rainfall = total_rainfall.round_total(self.total)
+        Total_rainfall[self.count < len(self.months)] = -1
+
+        return Total_rainfall
+
+    def save(self):
+
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir)
+
+        # the arrays are saved before the json so an interrupted save is not mistaken for a valid state
+        for name, array in ((TOTAL_NAME, self.total), (COUNT_NAME, self.count)):
+            tmp = os.path.join(self.state_dir, name + '.' + str(os.getpid()) + '.tmp.npy')
+            np.save(tmp, array)
+            os.replace(tmp, os.path.join(self.state_dir, name))
+
+        tmp = os.path.join(self.state_dir, STATE_NAME + '.' + str(os.getpid()) + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'start': self.start, 'months': self.months, 'grid': self.grid}, f, indent=1)
+        os.replace(tmp, os.path.join(self.state_dir, STATE_NAME))
+
+
+class PeriodTotals(object):
+
+    """
+    The running total of the same period (starting at the same calendar month as the season) of every earlier
+    season, kept as int32 tenths of a mm (the precision of the SILO grids, see total_rainfall.TOTAL_DECIMALS) so
+    the totals are exact, with a flag of the pixels with a nodata month. The totals are memory mapped (one layer
+    per earlier season) and each update only adds the months of the period that are not in the totals yet, i.e.
+    one monthly rainfall grid for every earlier season.
+    """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.nmonths = None
+        self.starts = []
+        self.grids = {}
+        self.grid = None
+        self.total = None
+        self.invalid = None
+
+        path = os.path.join(directory, PERIOD_NAME)
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.nmonths, self.starts, self.grids, self.grid = saved['nmonths'], saved['starts'], saved['grids'], saved['grid']
+            if self.nmonths is not None:
+                self.total = np.load(os.path.join(directory, PERIOD_TOTAL_NAME), mmap_mode='r+')
+                self.invalid = np.load(os.path.join(directory, PERIOD_INVALID_NAME), mmap_mode='r+')
+
+    def reset(self, starts, profile):
+
+        """
+        start new totals of the earlier seasons starting at the month numbers starts on the grid of the rasterio profile
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        self.nmonths = 0
+        self.starts = list(starts)
+        self.grids = {}
+        self.grid = {'geotransform': list(profile['transform'].to_gdal()), 'rows': profile['height'],
+                     'cols': profile['width'], 'nodata': profile['nodata']}
+
+        shape = (len(self.starts), profile['height'], profile['width'])
+        self.total = np.lib.format.open_memmap(os.path.join(self.directory, PERIOD_TOTAL_NAME), mode='w+', dtype=np.int32, shape=shape)
+        self.invalid = np.lib.format.open_memmap(os.path.join(self.directory, PERIOD_INVALID_NAME), mode='w+', dtype=bool, shape=shape)
+
+    def matches(self, starts, nmonths, profile, grids):
+
+        """
+        check the totals cover every earlier season in starts for at most nmonths on the same grid, and every
+        grid already added for those seasons is still in grids (a dictionary of month number and grid) with the
+        same fingerprint
+        """
+        if self.nmonths is None or self.nmonths > nmonths or not set(starts) <= set(self.starts):
+            return False
+
+        if (self.grid['rows'], self.grid['cols']) != (profile['height'], profile['width']) or \
+                Affine.from_gdal(*self.grid['geotransform']) != profile['transform']:
+            return False
+
+        return all(number in grids and result_manifest.file_fingerprint(grids[number]) == self.grids.get(rainfall_catalog.month_yearM(number))
+                   for start in starts for number in range(start, start + self.nmonths))
+
+    def keep(self, starts):
+
+        """
+        drop the earlier seasons not in starts (e.g. a season without a grid for the new month of the period)
+        """
+        if list(starts) == self.starts:
+            return
+
+        layers = [self.starts.index(start) for start in starts]
+
+        # copied one season at a time so the totals are not read into memory
+        for name, array in ((PERIOD_TOTAL_NAME, self.total), (PERIOD_INVALID_NAME, self.invalid)):
+            tmp = os.path.join(self.directory, name + '.' + str(os.getpid()) + '.tmp.npy')
+            kept = np.lib.format.open_memmap(tmp, mode='w+', dtype=array.dtype, shape=(len(layers),) + array.shape[1:])
+            for j, layer in enumerate(layers):
+                kept[j] = array[layer]
+            kept.flush()
+            del kept
+            os.replace(tmp, os.path.join(self.directory, name))
+        self.total = self.invalid = None
+
+        self.starts = list(starts)
+        self.grids = dict((yearM, fingerprint) for yearM, fingerprint in self.grids.items()
+                          if any(start <= rainfall_catalog.month_number(yearM) < start + self.nmonths for start in starts))
+        self.total = np.load(os.path.join(self.directory, PERIOD_TOTAL_NAME), mmap_mode='r+')
+        self.invalid = np.load(os.path.join(self.directory, PERIOD_INVALID_NAME), mmap_mode='r+')
+
+    def add_month(self, grids):
+
+        """
+        add the next month of the period of every earlier season, grids is a dictionary of month number and grid
+        """
+        profile = {'height': self.grid['rows'], 'width': self.grid['cols'], 'transform': Affine.from_gdal(*self.grid['geotransform'])}
+        scale = 10 ** total_rainfall.TOTAL_DECIMALS
+
+        for i, start in enumerate(self.starts):
+            img = grids[start + self.nmonths]
+            month = total_rainfall.read_month(img, profile)
+
+            nodata = total_rainfall.invalid_month(month, self.grid['nodata'])
+            self.total[i] += np.where(nodata, 0, np.round(month.astype(np.float64) * scale)).astype(np.int32)
+            self.invalid[i] |= nodata
+
+            self.grids[rainfall_catalog.month_yearM(start + self.nmonths)] = result_manifest.file_fingerprint(img)
+
+        self.nmonths += 1
+
+    def season_total(self, i):
+
+        """
+        returns the total rainfall of the i th earlier season in mm with the pixels with a nodata month set to -1,
+        as in total_rainfall.sum_months
+        """
+        Total_rainfall = self.total[i] / float(10 ** total_rainfall.TOTAL_DECIMALS)
+        Total_rainfall[self.invalid[i]] = -1
+
+        return Total_rainfall
+
+    def save(self, nmonths=None):
+
+        """
+        save the seasons and grids added, nmonths is None while the totals are being updated so an interrupted
+        update is summed again
+        """
+        if nmonths is not None:
+            self.total.flush()
+            self.invalid.flush()
+
+        tmp = os.path.join(self.directory, PERIOD_NAME + '.' + str(os.getpid()) + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'nmonths': nmonths, 'starts': self.starts, 'grids': self.grids, 'grid': self.grid}, f, indent=1)
+        os.replace(tmp, os.path.join(self.directory, PERIOD_NAME))
+
+
+def update_state(index, start, finish, state_dir, allow_missing=False):
+
+    """
+    Add the monthly rainfall grids between start and finish that are not in the saved state of the season
+    to the running total, summing the season again if the state is for a different season or grid or an
+    added grid has changed. Returns the state and the number of months read.
+    """
+    index.season(start, finish, allow_missing)
+    dated = [(rainfall_catalog.month_yearM(number), img) for number, img in index.dated_grids()
+             if rainfall_catalog.month_number(start) <= number <= rainfall_catalog.month_number(finish)]
+
+    if not dated:
+        raise rainfall_catalog.MissingMonthsError(start, finish, index.missing(start, finish))
+
+    with rasterio.open(dated[0][1]) as src:
+        profile = src.profile.copy()
+
+    state = SeasonState(state_dir)
+    if not state.matches(start, profile, dated):
+        if state.start is not None:
+            print ('the saved state is for a different season or grid, or a monthly rainfall grid has changed, the season is summed again')
+        state.reset(start, profile)
+
+    new_months = [(yearM, img) for yearM, img in dated if yearM not in state.months]
+    with run_report.stage('total', reads=[img for yearM, img in new_months]):
+        for yearM, img in new_months:
+            state.add_month(yearM, img)
+    added = len(new_months)
+
+    state.save()
+    print ('%d months added, the season to date total covers %d months (%s to %s)' % (added, len(state.months), start, dated[-1][0]))
+
+    return state, added
+
+
+def period_climatology(index, start, nmonths, state_dir, shapes, policy=output_policy.DEFAULT_POLICY, cache_dir=reproject_raster_ea.PLAN_CACHE):
+
+    """
+    Build (or reuse) the climatology cube of the NT total rainfall of the nmonths starting at the month of
+    start in every earlier year with all the months available. The running totals of the earlier seasons
+    (see PeriodTotals) are extended by the months of the period not added yet, usually one grid per earlier
+    season for each monthly update, then reprojected and clipped to the shapes and sorted into the cube.
+    Returns the climatology cube directory.
+    """
+    first = rainfall_catalog.month_number(start)
+    cube = os.path.join(state_dir, CLIMATOLOGY_DIR, '%02d_%02d' % (first % 12 + 1, nmonths))
+
+    # the earlier seasons with every month of the period
+    seasons = []
+    for year in range(index.years()[0], first // 12):
+        season_start = year * 12 + first % 12
+        season_finish = season_start + nmonths - 1
+        if season_finish < first and not index.missing(rainfall_catalog.month_yearM(season_start), rainfall_catalog.month_yearM(season_finish)):
+            seasons.append((rainfall_catalog.month_yearM(season_start) + rainfall_catalog.month_yearM(season_finish), season_start, season_finish))
+
+    if not seasons:
+        raise ValueError('there are no earlier seasons with all the monthly rainfall grids for the same period')
+
+    dated_grids = [(number, img) for number, img in index.dated_grids() if seasons[0][1] <= number <= seasons[-1][2]]
+
+    manifest = result_manifest.ResultManifest(os.path.join(state_dir, result_manifest.MANIFEST_NAME))
+    key = manifest.key('period_climatology', [img for number, img in dated_grids],
+                       {'seasons': seasons, 'boundary': clip_raster_nt_bnd_ea.geometry_checksum(shapes), 'policy': policy})
+    outputs = [os.path.join(cube, climatology_cube.SORTED_NAME), os.path.join(cube, climatology_cube.COUNT_NAME)]
+
+    if manifest.current(cube, key, outputs):
+        return cube
+
+    print ('building the climatology of ' + str(len(seasons)) + ' earlier seasons for ' + str(nmonths) + ' months from ' + start[4:6])
+
+    grids = dict(index.dated_grids())
+    with rasterio.open(dated_grids[0][1]) as src:
+        grid_profile = src.profile.copy()
+
+    # extend the running totals of the earlier seasons by the months of the period not added yet
+    periods = PeriodTotals(os.path.join(state_dir, CLIMATOLOGY_DIR, 'period_%02d' % (first % 12 + 1)))
+    starts = [season_start for season, season_start, season_finish in seasons]
+    if periods.matches(starts, nmonths, grid_profile, grids):
+        periods.keep(starts)
+    else:
+        if periods.nmonths is not None:
+            print ('the saved period totals are for a longer period, other seasons or grid, or a monthly rainfall grid has changed, the period is summed again')
+        periods.reset(starts, grid_profile)
+
+    with run_report.stage('total', reads=[grids[season_start + offset] for season_start in starts for offset in range(periods.nmonths, nmonths)]):
+        periods.save()
+        while periods.nmonths < nmonths:
+            periods.add_month(grids)
+        periods.save(nmonths)
+
+    history_dir = os.path.join(state_dir, CLIMATOLOGY_DIR, 'history_%02d_%02d' % (first % 12 + 1, nmonths))
+    if not os.path.exists(history_dir):
+        os.makedirs(history_dir)
+
+    listimg = []
+    for i, (season, season_start, season_finish) in enumerate(seasons):
+        Total_rainfall, profile = total_rainfall.encode_total(periods.season_total(i), grid_profile, policy)
+        repro, repro_profile = reproject_raster_ea.reproject_array(Total_rainfall, profile, cache_dir=cache_dir)
+        clipped, clip_profile = clip_raster_nt_bnd_ea.clip_array(repro, repro_profile, shapes)
+
+        out_nt = os.path.join(history_dir, 'NT_' + season + '_total_rainfall_a2.tif')
+        rainfall_workflow.write_raster(out_nt, clipped, clip_profile)
+        listimg.append(out_nt)
+
+    climatology_cube.build_cube(sorted(listimg), cube)
+    shutil.rmtree(history_dir, ignore_errors=True)
+
+    manifest.record(cube, key, outputs)
+    manifest.save()
+
+    return cube
+
+
+def update_season(index, start, finish, state_dir, output, outputNT, inshp=clip_raster_nt_bnd_ea.NT_BND, percentile=None,
+                  kind='rank', allow_missing=False, policy=output_policy.DEFAULT_POLICY, cache_dir=reproject_raster_ea.PLAN_CACHE):
+
+    """
+    Add the new monthly rainfall grids to the season to date total, write the AU, reprojected and NT totals
+    and (if percentile is given) score the NT total against the same period of the earlier seasons. finish
+    defaults to the latest monthly rainfall grid. Returns the NT output file name.
+    """
+    if finish is None:
+        finish = rainfall_catalog.month_yearM(index.months[-1])
+
+    if output is None:
+        output = os.path.join(state_dir, 'AU_' + start + finish + '_total_rainfall.tif')
+
+    state, added = update_state(index, start, finish, state_dir, allow_missing)
+
+    shapes = clip_raster_nt_bnd_ea.read_shapes(inshp)
+
+    with rasterio.open(index.select(start, finish)[0]) as src:
+        profile = src.profile.copy()
+
+    Total_rainfall, profile = total_rainfall.encode_total(state.season_total(), profile, policy)
+    rainfall_workflow.run_total(Total_rainfall, profile, output, outputNT, shapes, cache_dir=cache_dir)
+
+    if percentile is not None:
+        nmonths = rainfall_catalog.month_number(finish) - rainfall_catalog.month_number(start) + 1
+        cube = period_climatology(index, start, nmonths, state_dir, shapes, policy, cache_dir)
+        climatology_cube.score_image(outputNT, cube, percentile, kind, policy)
+
+    return outputNT
+
+
+def mainRoutine():
+
+    """Run mainRoutine"""
+
+    cmdargs = getCmdargs()
+
+    with run_report.session(cmdargs.report, cmdargs.profile):
+        if cmdargs.imglist is not None:
+            df = pd.read_csv(cmdargs.imglist, header=None)
+            index = rainfall_catalog.MonthlyGridIndex.from_paths(df[0].values.tolist(), cmdargs.pattern)
+        else:
+            catalog = rainfall_catalog.update_catalog(cmdargs.direc, "rain.tif", cmdargs.catalog, pattern=cmdargs.pattern)
+            index = rainfall_catalog.MonthlyGridIndex.from_catalog(catalog)
+
+        outputNT = update_season(index, cmdargs.yearM_S, cmdargs.yearM_f, cmdargs.state, cmdargs.output, cmdargs.outputNT,
+                                 cmdargs.boundary, cmdargs.percentile, cmdargs.kind, policy=cmdargs.policy)
+
+        if cmdargs.cube is not None:
+            climatology_cube.score_image(outputNT, cmdargs.cube, cmdargs.seasonPercentile, cmdargs.kind, cmdargs.policy)
+
+
+if __name__ == "__main__":
+    mainRoutine()
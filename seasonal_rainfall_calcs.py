@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 """
-This code runs a number of scripts to caluculate the total rainfall for a seasonal period defined by the user. The script generates
+This code runs a number of scripts (in the same process) to caluculate the total rainfall for a seasonal period defined by the user. The script generates
 a list of all available monthly rainfall .tif files located in the coporate drive (Z:\Landsat\rainfall\) and then selects 
 out the requried preiod based on the year and month defined by the user. 
 
@@ -58,6 +58,39 @@ yearM_f : str
 output : str 
             is a string with the directory and the output file name given to the total rainfall seasonal grid.
 
+windowed : bool
+            if set only the rows of the monthly rainfall grids covering the NT boundary are read, summed and reprojected, 
+            the NT output is unchanged but the AU total rainfall grid only covers the window.
+
+boundary : str
+            is the shapefile used to clip the total rainfall grid, the default is the NT boundary (clip_raster_nt_bnd_ea.NT_BND).
+
+catalog : str
+            is the json file used to save the index of the monthly rainfall grids, only the directories that have changed 
+            since the last run are listed again (see rainfall_catalog.py).
+
+pattern : str
+            is the regular expression (with the named groups year and month) used to find the year and month in the monthly 
+            rainfall grid file names, the default matches the SILO grids e.g. 202105.monthly_rain.tif.
+
+allowMissing : bool
+            if set the total is calculated from the available grids (with a warning) when some months are missing, by default 
+            missing months raise an error.
+
+state : str
+            is an optional directory used to keep the running total of the current season, only the monthly rainfall grids 
+            added since the last run are read and summed (see season_to_date.py).
+
+percentile : str
+            is an optional name of the percentile score of the season to date total against the same period of the earlier 
+            seasons (requires state).
+
+report : str
+            is an optional json file to write a run report to with the time of every stage (see run_report.py).
+
+profile : str
+            is an optional file to save the cProfile stats of the slowest stage to (requires report).
+
 """
 
 
@@ -68,6 +101,12 @@ import argparse
 import pandas as pd
 import fnmatch
 import csv
+import rainfall_catalog
+import rainfall_workflow
+import clip_raster_nt_bnd_ea
+import output_policy
+import season_to_date
+import run_report
 
 
 #function to get cmd line inputs
@@ -85,59 +124,56 @@ def getCmdargs():
     
     p.add_argument("-n","--outputNT", help="provide the output directory and file name for the NT total rainfall grid")
     
-    cmdargs = p.parse_args()
-    if cmdargs.yearM_S is None:
-        p.print_help()
-        sys.exit()
-
-    return cmdargs
+    p.add_argument("-w","--windowed", action="store_true", help="only read, sum and reproject the rows of the grids covering the NT boundary")
     
-def create_rainfall_list(dirname,endfilename,txtname): 
+    p.add_argument("-b","--boundary", default=clip_raster_nt_bnd_ea.NT_BND, help="shapefile used to clip the total rainfall grid")
     
-    """
-    create the list of available rainfall grids
+    p.add_argument("-c","--catalog", help="json file used to save the index of the monthly rainfall grids (see rainfall_catalog.py)")
     
-    """
-    cmd = "python list_of_files_multi_dir.py --direc %s --endfilen %s --txtfile %s"% (dirname,endfilename, txtname) 
-       
-    os.system(cmd)
+    p.add_argument("-t","--pattern", default=rainfall_catalog.GRID_PATTERN, help="regular expression with the named groups year and month used to date the monthly rainfall grids")
     
+    p.add_argument("-m","--allowMissing", action="store_true", help="calculate the total even if some monthly rainfall grids are missing")
     
+    p.add_argument("--policy", default=output_policy.DEFAULT_POLICY, choices=sorted(output_policy.POLICIES), help="output data type policy for the total (see output_policy.py)")
     
-def total_rainfall(txtname, newf):
+    p.add_argument("-u","--state", help="directory used to keep the running total of the season, only the new monthly rainfall grids are added (see season_to_date.py)")
     
-    """
-    call the total rainfall script and run it.
+    p.add_argument("-p","--percentile", help="name of the percentile score against the same period of the earlier seasons (requires --state)")
     
-    """ 
-    cmd = "python total_rainfall.py --imglist %s --output %s"% (txtname, newf) 
-       
-    os.system(cmd)
-     
-    print (newf + ' is complete')
+    run_report.add_arguments(p)
     
+    cmdargs = p.parse_args()
+    if cmdargs.yearM_S is None:
+        p.print_help()
+        sys.exit()
     
-def repro(newf):
+    if cmdargs.percentile is not None and cmdargs.state is None:
+        p.error('--percentile requires --state')
+
+    return cmdargs
+    
+def create_rainfall_list(dirname, endfilename, yearM_start, yearM_finish, catalog=None, pattern=rainfall_catalog.GRID_PATTERN, allow_missing=False): 
     
     """
-    call the total reproject script and run it.
+    create the list of rainfall grids for every month between the start and finish year and month from the catalog 
+    of the directory, only the directories that have changed since the last run are listed again. Missing months 
+    raise an error unless allow_missing is set.
     
-    """ 
-    cmd = "python reproject_raster_ea.py --img %s"% (newf) 
-       
-    os.system(cmd)
-        
-    print (newf + ' has been reprojected')
-
+    """
+    index = create_rainfall_index(dirname, endfilename, catalog, pattern)
     
-def clipNT(img,out_nt):
-
+    list_img = index.season(yearM_start, yearM_finish, allow_missing)
     
-    cmd = "python clip_raster_nt_bnd_ea.py --img %s --outputNT %s"% (img,out_nt)
+    return list_img
+
+
+def create_rainfall_index(dirname, endfilename, catalog=None, pattern=rainfall_catalog.GRID_PATTERN):
     
-    os.system(cmd)
+    """
+    create the index of every monthly rainfall grid from the catalog of the directory
     
-    print (out_nt + ' has been clipped to the NT boundary')
+    """
+    return rainfall_catalog.MonthlyGridIndex.from_catalog(rainfall_catalog.update_catalog(dirname, endfilename, catalog, pattern=pattern))
        
 
 def main():
@@ -146,49 +182,38 @@ def main():
     """
     
     cmdargs = getCmdargs()
-   
-    # cmdargs for the image list script 
-    dirname = "Z:/Landsat/rainfall/" 
-    endfilename = "rain.tif"
-    txtname = cmdargs.txtfile
-    nt_clip = cmdargs.outputNT
-    
-    # cmdargs for the output seasonal rainfall grid 
-    newf = cmdargs.output
-    
-    create_rainfall_list(dirname,endfilename,txtname)
-   
-    # select the date range for the seasonal total rainfall grid 
-    df=pd.read_csv(txtname,header=None)
-    
-    # extract out the year and month from the individual monthly rainfall grids
-    df['yearM'] = df[0].map(lambda x: str(x)[-23:-17]).astype(int)
-    
-    # do the selection for the period to calculate   
-    yearM_start = int(cmdargs.yearM_S)
-    yearM_finish = int(cmdargs.yearM_f)
-                  
-    imglist = df[(df['yearM'] >= yearM_start) & (df['yearM'] <= yearM_finish)]
-    img_to_process=imglist[0]
-     
-    # write out the list of rainfall grids to obtain the total
-    with open(txtname, "w") as output:
-        writer = csv.writer(output, lineterminator='\n')
-        for file in img_to_process:
-            writer.writerow([file])
-            
-    # call the total rainfall script
-    total_rainfall(txtname, newf)
     
-    # call the reporject script 
-    repro(newf)
+    with run_report.session(cmdargs.report, cmdargs.profile):
+        # cmdargs for the image list script 
+        dirname = "Z:/Landsat/rainfall/" 
+        endfilename = "rain.tif"
+        txtname = cmdargs.txtfile
+        nt_clip = cmdargs.outputNT
+    
+        # cmdargs for the output seasonal rainfall grid 
+        newf = cmdargs.output
+    
+        # select the monthly rainfall grids for the period to calculate from the catalog
+        yearM_start = cmdargs.yearM_S
+        yearM_finish = cmdargs.yearM_f
     
-    # clip the reprojected rainfall grid to the NT boundary
-    img = newf[:-4] + "_a2.tif"
+        if cmdargs.state is not None:
+            # only add the monthly rainfall grids that have arrived since the last run to the season to date total
+            index = create_rainfall_index(dirname, endfilename, cmdargs.catalog, cmdargs.pattern)
+            season_to_date.update_season(index, yearM_start, yearM_finish, cmdargs.state, newf, nt_clip, cmdargs.boundary, cmdargs.percentile,
+                                         allow_missing=cmdargs.allowMissing, policy=cmdargs.policy)
+            return
     
-    out_nt = nt_clip
-           
-    clipNT(img,out_nt)
+        img_to_process = create_rainfall_list(dirname, endfilename, yearM_start, yearM_finish, cmdargs.catalog, cmdargs.pattern, cmdargs.allowMissing)
+     
+        # write out the list of rainfall grids to obtain the total
+        with open(txtname, "w") as output:
+            writer = csv.writer(output, lineterminator='\n')
+            for file in img_to_process:
+                writer.writerow([file])
+            
+        # calculate the total rainfall, reproject it and clip the reprojected rainfall grid to the NT boundary
+        rainfall_workflow.run_season(img_to_process, newf, nt_clip, cmdargs.boundary, windowed=cmdargs.windowed, policy=cmdargs.policy)
     
     
 if __name__ == "__main__":
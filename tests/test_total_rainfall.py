@@ -0,0 +1,77 @@
+"""
+Check the total rainfall paths (summing each season and the single pass prefix sums) give identical totals.
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+rasterio = pytest.importorskip('rasterio')
+pytest.importorskip('rios')
+pytest.importorskip('osgeo')
+
+import total_rainfall
+
+NODATA = -32767
+
+
+def write_months(directory, years, shape=(120, 160), seed=0):
+
+    """
+    write float32 monthly rainfall grids in 0.1 mm (as the SILO grids) with a few nodata pixels, returns
+    a list of (month number, file name) tuples
+    """
+    rng = np.random.default_rng(seed)
+    profile = {'driver': 'GTiff', 'height': shape[0], 'width': shape[1], 'count': 1, 'dtype': 'float32',
+               'nodata': NODATA, 'transform': rasterio.Affine(0.05, 0, 110, 0, -0.05, -10), 'crs': 'EPSG:4326'}
+
+    dated = []
+    for year in years:
+        for month in range(1, 13):
+            data = (rng.integers(0, 3000, shape) / 10.0).astype(np.float32)
+            data[rng.random(shape) < 0.001] = NODATA
+
+            name = os.path.join(str(directory), '%d%02d.monthly_rain.tif' % (year, month))
+            with rasterio.open(name, 'w', **profile) as dst:
+                dst.write(data, 1)
+            dated.append((year * 12 + month - 1, name))
+
+    return dated
+
+
+def exact_total(names):
+
+    """
+    the total of the grids in whole mm summed as integer tenths of a mm, with -1 for any nodata month
+    """
+    tenths = 0
+    nodata = False
+    for name in names:
+        with rasterio.open(name) as src:
+            data = src.read(1)
+        nodata = nodata | (data == NODATA)
+        tenths = tenths + np.round(data * 10).astype(np.int64)
+
+    return np.where(nodata, -1, tenths // 10)
+
+
+def test_prefix_sum_totals_match_sum_months(tmp_path):
+
+    dated = write_months(tmp_path, range(2000, 2006))
+    seasons = [(str(year), year * 12 + 9, year * 12 + 15) for year in range(2000, 2005)]
+
+    prefix = dict((key, (total, profile)) for key, total, profile in total_rainfall.prefix_sum_totals(dated, seasons))
+
+    for key, start, finish in seasons:
+        names = [name for month, name in dated if start <= month <= finish]
+        total, profile = total_rainfall.total_rainfall_array(names)
+
+        np.testing.assert_array_equal(total, prefix[key][0])
+        assert profile['dtype'] == prefix[key][1]['dtype']
+
+        exact = exact_total(names)
+        valid = exact != -1
+        np.testing.assert_array_equal(total[valid], exact[valid])
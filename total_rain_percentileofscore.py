@@ -46,22 +46,72 @@ img: str
              
 output : str 
             is a name of the output percentile score image following the naming convetion: NT_201805201904_perc_rainfall_a2.tif.
+
+cube : str
+            is an optional directory containing a pre-sorted climatology cube built with climatology_cube.py, 
+            when it is provided the score is ranked against the cube instead of the list of imagery.
+
+kind : str
+            is the percentile definition (rank, weak, strict or mean) used to rank the score, the default is rank.
+
+policy : str
+            is the output data type policy (see output_policy.py), compact writes the percentile score as uint16 hundredths 
+            of a percent (scale 0.01, nodata 65535) and float writes float32 with the nodata value -1.
+
+workers : int
+            is the number of processes used to calculate the percentile score. When it is more than 1 the history is 
+            staged once into a memory mapped stack next to the output, and the blocks are scored by a pool of workers 
+            that all read the same memory map. The output is the same for any number of workers.
+
+memory : float
+            is the memory budget of a block in MB (default 512), the window size is chosen from the budget, the number of 
+            layers and their data type (see block_plan.py). The budget is shared between the workers.
+
+manifest : str
+            is an optional json file recording the inputs of the outputs produced (see result_manifest.py), if the seasonal 
+            totals (or cube), kind and policy have not changed since the output was recorded it is not produced again. 
+            A seasonal total recalculated by multi_seasonal_rainfall.py changes its inputs so the output is produced again.
+
+checksum : bool
+            if set the inputs are compared by the checksum of their contents instead of their size and modification time.
             
 """
 
 from __future__ import print_function, division
 import sys
 import os
-from rios import applier, fileinfo
+try:
+    from rios import applier, fileinfo
+except ImportError:
+    # only the RIOS stage needs rios, the parallel and cube percentile scores run without it
+    applier = fileinfo = None
 import numpy as np
 import csv
 import pdb
 import argparse
 import pandas as pd
 from osgeo import gdal
-import scipy.stats.mstats as mstats
-import numpy.ma as ma
-from scipy import stats
+import shutil
+import tempfile
+import math
+import multiprocessing
+import rasterio
+import rasterio.windows
+import percentile_rank
+import climatology_cube
+import output_policy
+import block_plan
+import run_report
+import result_manifest
+
+# width and height of the blocks scored by the workers
+BLOCK_SIZE = 256
+
+# the staged history and score, opened once in each worker process
+worker_arrays = None
+
+# whether the blocks scored by the worker processes are recorded in the run report (see run_report.worker)
+worker_report = False
 
 
 def getCmdargs():
@@ -75,10 +125,26 @@ def getCmdargs():
     p.add_argument("-i","--img", help="input imagery to calculate the percentile score")
     
     p.add_argument("-o","--outfile", help="name of the output percentile score image")
+    
+    p.add_argument("-c","--cube", help="directory containing a pre-sorted climatology cube (see climatology_cube.py) used instead of the list of imagery")
+    
+    p.add_argument("-k","--kind", default='rank', choices=percentile_rank.KINDS, help="percentile definition used to rank the score (default rank) see scipy.stats.percentileofscore")
+    
+    p.add_argument("--policy", default=output_policy.DEFAULT_POLICY, choices=sorted(output_policy.POLICIES), help="output data type policy (see output_policy.py)")
+    
+    p.add_argument("-w","--workers", type=int, default=1, help="number of processes used to score blocks in parallel (default 1, uses rios)")
+    
+    p.add_argument("--manifest", help="json file recording the inputs of the outputs produced, the output is skipped if its inputs have not changed (see result_manifest.py)")
+    
+    p.add_argument("--checksum", action="store_true", help="compare the inputs by checksum instead of size and modification time")
+    
+    block_plan.add_arguments(p)
+    
+    run_report.add_arguments(p)
    
     cmdargs = p.parse_args()
     
-    if cmdargs.imglist is None:
+    if cmdargs.imglist is None and cmdargs.cube is None:
         p.print_help()
         sys.exit()
         
@@ -89,12 +155,46 @@ def mainRoutine():
     
     cmdargs = getCmdargs()
     
-    # read in the list of disturbance layers to sum
-    df=pd.read_csv(cmdargs.imglist,header=None)
-         
-    listimg = df[0].values.tolist()
-    print (listimg)
+    with run_report.session(cmdargs.report, cmdargs.profile):
+        if cmdargs.cube is not None:
+            listimg = None
+            inputs = [cmdargs.img, os.path.join(cmdargs.cube, climatology_cube.SORTED_NAME)]
+        else:
+            # read in the list of disturbance layers to sum
+            df=pd.read_csv(cmdargs.imglist,header=None)
+                 
+            listimg = df[0].values.tolist()
+            print (listimg)
+            inputs = listimg + [cmdargs.img]
+        
+        # skip the output if the seasonal totals have not changed since it was recorded in the manifest
+        manifest = result_manifest.open_manifest(cmdargs.manifest, cmdargs.checksum)
+        if manifest is not None:
+            key = manifest.key('percentile', inputs, {'kind': cmdargs.kind, 'policy': cmdargs.policy})
+            if manifest.current(cmdargs.outfile, key, [cmdargs.outfile]):
+                print (cmdargs.outfile + ' is up to date')
+                return
+        
+        if cmdargs.cube is not None:
+            # score against the pre-sorted climatology cube, the output is written with the nodata value set
+            climatology_cube.score_image(cmdargs.img, cmdargs.cube, cmdargs.outfile, cmdargs.kind, cmdargs.policy)
+        elif cmdargs.workers > 1:
+            parallel_percentile(listimg, cmdargs.img, cmdargs.outfile, cmdargs.kind, cmdargs.workers, cmdargs.policy, cmdargs.memory)
+        else:
+            rios_percentile(listimg, cmdargs.img, cmdargs.outfile, cmdargs.kind, cmdargs.policy, cmdargs.memory)
+        
+        if manifest is not None:
+            manifest.record(cmdargs.outfile, key, [cmdargs.outfile])
+            manifest.save()
+
+
+def rios_percentile(listimg, img, outfile, kind='rank', policy=output_policy.DEFAULT_POLICY, memory_mb=block_plan.DEFAULT_MEMORY_MB):
     
+    """
+    Calculate the percentile score of img against the list of historical totals with RIOS and write it to 
+    outfile using the data type, scale and nodata value of the output policy. The window size is chosen 
+    from the memory budget and the number of layers (see block_plan.py).
+    """
     # set up rios
     infiles = applier.FilenameAssociations()
     outfiles = applier.FilenameAssociations()
@@ -102,23 +202,34 @@ def mainRoutine():
     
     # read in the list of imagery to calculate the sum
     infiles.imglist = listimg
-    infiles.img = cmdargs.img
-    outfiles.stat1 = "temp_pecentile_output_to_delete.img"
+    infiles.img = img
+    outfiles.stat1 = outfile
        
     controls = applier.ApplierControls()
     controls.setOutputDriverName('GTiff')
     options = ['COMPRESS=LZW', 'BIGTIFF=YES', 'TILED=YES', 'INTERLEAVE=BAND','BLOCKXSIZE=256','BLOCKYSIZE=256']
     controls.setCreationOptions(options)
-    controls.setWindowXsize(256)
-    controls.setWindowYsize(256)
+    block_plan.set_windows(controls, block_plan.image_plan(img, len(listimg) + 1, memory_mb))
+    # the nodata value is set on the output when it is created so arcmap or qgis recognise it
+    controls.setStatsIgnore(output_policy.stage_policy('percentile', policy)['nodata'])
     
     # set up the nodata values
     imginfo = fileinfo.ImageInfo(infiles.img)
     otherargs.coverNull = imginfo.nodataval[0]   
+    otherargs.kind = kind
+    otherargs.policy = policy
+    
+    with run_report.stage('percentile', reads=listimg + [img], writes=[outfile]):
+        applier.apply(dostats, infiles, outfiles, otherargs,controls=controls)  
     
-    applier.apply(dostats, infiles, outfiles, otherargs,controls=controls)  
+    # save the scale of the percentile score in the output and convert it to a COG with overviews
+    output_policy.set_metadata(outfile, 'percentile', policy)
+    output_policy.convert_to_cog(outfile, 'percentile')
+    
+    print (outfile + ' is complete')
 
 
+@run_report.timed_block('percentile')
 def dostats(info, inputs, outputs, otherargs):
     
     """
@@ -127,135 +238,172 @@ def dostats(info, inputs, outputs, otherargs):
     """
     np.seterr(all='ignore')
     
+    percImage = percentile_block(inputs, otherargs)
+       
+    outputs.stat1 = np.array([output_policy.encode(percImage, percImage == -1, 'percentile', otherargs.policy)])
+
+
+def percentile_block(inputs, otherargs):
+    
+    """
+    calculate the percentile score for a RIOS block with the nodata areas set to -1, the block 
+    requires the inputs imglist (history) and img (score)
+    """
     nullValue  = otherargs.coverNull
     # select the first band in the image.
     index = 0
-    # read in the list of images for the given year and iterate over each pixel masking out the nodata values.
+    # read in the list of images for the given year, the nodata values are excluded by the percentile engine.
     stack = np.array([img[index] for img in inputs.imglist])
-    maskedstack = ma.masked_array(stack,stack==nullValue)
     
     # read in the image to caluclate the percetile score 
-    img = inputs.img
-    masked_score = ma.masked_array(img,img==nullValue)
+    score = inputs.img[index]
     
-    x = int(maskedstack.shape[2])
-    y = int(maskedstack.shape[1])
-    z = int(maskedstack.shape[0])
-
-    # get the shape of the array for the image to caluclate the percetile score
-    scores = inputs.img.shape
-        
-    # extract out each of the array shape values to use in reshaping the array 
-    x1 = int(masked_score.shape[2])
-    y1 = int(masked_score.shape[1])
-    z1 = int(masked_score.shape[0])
+    # calculate the percentile score for every pixel in the block at once, the nodata areas are set to -1 
+    percImage = percentile_rank.percentileofscore_stack(stack, score, nullValue, kind=otherargs.kind, outNull=-1)
     
-    #print (x1, y1, z1)
-
+    # use the total rainfall image to define the nodata areas in the percentile image.
+    percImage[score == -1] = -1
     
-    # list to save the percentile score 
-    ndata = []
+    return percImage
     
-    # iterate over the elements in the array to calculate the percentile score for the given values 
-    for i in range(y):
+
+def stage_stack(listimg, img, stage_dir):
     
-        a1 = maskedstack[:,i]
-        #print (a1)
+    """
+    Copy the history (listimg) into a (time, rows, cols) memory mapped stack and the score (img) into a 
+    (rows, cols) memory mapped array in stage_dir, reading one image at a time. The arrays keep the data type 
+    of the images so the scores match the rios path. Returns the file names of the stack and the score (None 
+    if img is None, only the history is staged).
+    """
+    with rasterio.open(img or listimg[0]) as src:
+        profile = src.profile.copy()
+        score = src.read(1) if img is not None else None
     
-        a2 = masked_score[:,i]
-        
-        for p in range(x):
-        
-            a1_1 = a1[:,p]
-     
-            score = a2[:,p]
-        
-            stat = stats.percentileofscore(a1_1, score)
-            
-            # this deals with any result that is zero and is being output as null data when it should indicate a very low value
-            if stat == 0:
-                
-                stat = 0.01
-            else:
-                stat = stat
-                
-            # append the results to a list before reshaping them to output as an image 
-            ndata.append(stat)
-   
-    new_array = np.array([ndata])
+    dtypes = []
+    for name in listimg:
+        with rasterio.open(name) as src:
+            if (src.height, src.width) != (profile['height'], profile['width']) or not src.transform.almost_equals(profile['transform']):
+                raise ValueError(name + ' is not on the same grid as ' + (img or listimg[0]))
+            dtypes.append(src.dtypes[0])
     
-    rshape = new_array.reshape([z1,y1,x1])
-   
-    percImage = rshape
-   
-    results = np.zeros(scores, dtype=np.float32)
+    stack_name = os.path.join(stage_dir, 'history.npy')
+    score_name = os.path.join(stage_dir, 'score.npy')
     
-    results = percImage
+    stack = np.lib.format.open_memmap(stack_name, mode='w+', dtype=np.result_type(*dtypes), shape=(len(listimg), profile['height'], profile['width']))
+    for t, name in enumerate(listimg):
+        with rasterio.open(name) as src:
+            stack[t] = src.read(1)
+    stack.flush()
+    del stack
     
-    output = np.array(results,dtype=np.float32)
-       
-    outputs.stat1 = output
+    if score is None:
+        return stack_name, None
     
+    np.save(score_name, score)
+    
+    return stack_name, score_name
+
 
-def apply_new_nodata():
+def block_windows(height, width, xsize=BLOCK_SIZE, ysize=BLOCK_SIZE):
+    
     """
-    This function applies a new nodata value to the percentile output
-    it uses the nodata areas defined by the input image.
+    returns the (row, col, rows, cols) blocks of xsize by ysize pixels covering the grid
     """
-    cmdargs = getCmdargs()
-    infiles = applier.FilenameAssociations()
-    outfiles = applier.FilenameAssociations()
-    otherargs = applier.OtherInputs()
-    
-    # read input img that the percentile has been calculated 
-    infiles.img = cmdargs.img 
-    
-    # this reads in the output from applying the model 
-    infiles.model = 'temp_pecentile_output_to_delete.img'
-    
-    # set up the output file name
-    final_output = cmdargs.outfile
+    return [(row, col, min(ysize, height - row), min(xsize, width - col))
+            for row in range(0, height, ysize) for col in range(0, width, xsize)]
+
+
+def init_worker(stack_name, score_name, nullValue, kind, policy, report=False):
     
-    outfiles.model_nodata = final_output
+    """
+    open the staged history and score as read only memory maps, shared by all the blocks scored by this worker
+    """
+    global worker_arrays, worker_report
+    worker_arrays = (np.load(stack_name, mmap_mode='r'), np.load(score_name, mmap_mode='r'), nullValue, kind, policy)
+    worker_report = report
+
 
-    applier.apply(defineNoData, infiles, outfiles, otherargs)
+def score_block(block):
     
-    # set the nodata value using gdal
-    setNodataValue(final_output)
+    """
+    score a block in a worker process, returns the block, its score and the run report records of the block
+    """
+    with run_report.worker(worker_report) as records:
+        result = score_window(block)
     
-    # removes the temp file
-    os.remove("temp_pecentile_output_to_delete.img")
-    # needed if script is run on a windows system
-    os.remove("temp_pecentile_output_to_delete.img.aux.xml")    
+    return result + (records,)
 
+
+@run_report.timed_block('percentile')
+def score_window(block):
     
-def defineNoData(info, inputs, outputs, otherargs):
-    
-    """ this function reads in the modelled data an applies a nodata value '
-    based on the nodata values in the imput img"""
+    """
+    calculate the percentile score for a block of the staged history, as in percentile_block
+    """
+    stack, score, nullValue, kind, policy = worker_arrays
+    row, col, rows, cols = block
     
-    # read in the percentile image 
-    model = np.array(inputs.model)
-        
-    # read in a total rainfall img 
-    mask = np.array(inputs.img.astype(np.float32))
+    blockScore = np.asarray(score[row:row + rows, col:col + cols])
+    percImage = percentile_rank.percentileofscore_stack(np.asarray(stack[:, row:row + rows, col:col + cols]), blockScore, nullValue, kind=kind, outNull=-1)
+    percImage[blockScore == -1] = -1
     
-    # use the total rainfall image to define the nodata areas in the percentile image.
-    model[(mask==-1)] = -1
+    return block, output_policy.encode(percImage, percImage == -1, 'percentile', policy)
 
-    # save out the percentile image with the nodata areas masked
-    model_nodata = model   
-    outputs.model_nodata = model_nodata
 
+def parallel_percentile(listimg, img, outfile, kind='rank', workers=None, policy=output_policy.DEFAULT_POLICY, memory_mb=block_plan.DEFAULT_MEMORY_MB):
     
-def setNodataValue(final_output):
+    """
+    Calculate the percentile score of img against the list of historical totals using a pool of worker 
+    processes. The history is staged once into a memory mapped stack which every worker reads directly, 
+    only the block positions and the scored blocks are passed between the processes. Each block is scored 
+    independently so the output does not depend on the number of workers. The memory budget is shared 
+    between the workers (see block_plan.py).
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
     
-    """this function sets the new no data value so 
-    when it is open in arcmap or qgis it recognises the new values"""
+    plan = block_plan.image_plan(img, len(listimg) + 1, memory_mb / workers)
     
-    newImg = gdal.Open(final_output, gdal.GA_Update)
-    newImg.GetRasterBand(1).SetNoDataValue(-1)
+    with rasterio.open(img) as src:
+        profile = src.profile.copy()
+        nullValue = src.nodata
     
+    stage_dir = tempfile.mkdtemp(prefix='percentile_', dir=os.path.dirname(os.path.abspath(outfile)))
+    pool = None
+    
+    try:
+        with run_report.stage('percentile', reads=listimg + [img], writes=[outfile]):
+            stack_name, score_name = stage_stack(listimg, img, stage_dir)
+            # at least one block for every worker
+            ysize = plan.ysize if plan.nblocks >= workers else int(math.ceil(profile['height'] / workers))
+            blocks = block_windows(profile['height'], profile['width'], plan.xsize, ysize)
+        
+            rule = output_policy.stage_policy('percentile', policy)
+            profile.update({'count': 1, 'dtype': rule['dtype'], 'nodata': rule['nodata']})
+        
+            if workers > 1:
+                pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(stack_name, score_name, nullValue, kind, policy, run_report.enabled()))
+                results = pool.imap_unordered(score_block, blocks)
+            else:
+                init_worker(stack_name, score_name, nullValue, kind, policy, run_report.enabled())
+                results = (score_block(block) for block in blocks)
+        
+            # the blocks are gathered in memory and written as a COG with overviews when the file is closed
+            with rasterio.open(outfile, 'w', **output_policy.cog_profile(profile, 'percentile')) as dst:
+                dst.scales = (rule['scale'],)
+                for (row, col, rows, cols), percImage, records in results:
+                    dst.write(percImage, 1, window=rasterio.windows.Window(col, row, cols, rows))
+                    run_report.merge(records)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        global worker_arrays
+        worker_arrays = None
+        shutil.rmtree(stage_dir, ignore_errors=True)
+    
+    print (outfile + ' is complete')
+
+
 if __name__ == "__main__":
-    mainRoutine()
-    apply_new_nodata()
\ No newline at end of file
+    mainRoutine()
\ No newline at end of file
@@ -6,7 +6,11 @@
 
 from __future__ import print_function, division
 import sys
-from rios import applier, fileinfo
+try:
+    from rios import applier, fileinfo
+except ImportError:
+    # only the RIOS stage needs rios, the in memory and prefix sum totals run without it
+    applier = fileinfo = None
 import numpy as np
 import csv
 import pdb
@@ -15,6 +19,16 @@ import argparse
 import pandas as pd
 import scipy.stats.mstats as mstats
 import numpy.ma as ma
+import rasterio
+import rasterio.windows
+import monthly_rainfall_cube
+import rainfall_catalog
+import output_policy
+import block_plan
+import run_report
+
+# number of decimal places of the monthly rainfall grids (SILO grids are in 0.1 mm), the totals are rounded to it
+TOTAL_DECIMALS = 1
 
 
 def getCmdargs():
@@ -24,10 +38,16 @@ def getCmdargs():
     p = argparse.ArgumentParser()
     p.add_argument("--imglist", help="Input list of imagery to calculate the total rainfall for the given period")
     p.add_argument("--output", help="provide the output directory and file name")
+    p.add_argument("--cube", help="monthly rainfall cube (see monthly_rainfall_cube.py) used instead of the list of imagery")
+    p.add_argument("--start", help="the year and month identifying the start of the period read from the cube i.e. 202010")
+    p.add_argument("--finish", help="the year and month identifying the end of the period read from the cube i.e. 202104")
+    p.add_argument("--policy", default=output_policy.DEFAULT_POLICY, choices=sorted(output_policy.POLICIES), help="output data type policy, compact (uint16 mm) or float (float32) see output_policy.py")
+    block_plan.add_arguments(p)
+    run_report.add_arguments(p)
     
     cmdargs = p.parse_args()
     
-    if cmdargs.imglist is None:
+    if cmdargs.imglist is None and cmdargs.cube is None:
         p.print_help()
         sys.exit()
         
@@ -47,57 +67,263 @@ def readlist(imglist):
     return flat_list
 
 
+@run_report.timed_block('total')
 def dostats(info, inputs, outputs, otherargs):
     
     """
-    Called from RIOS. calculate the sum of all the monthly rainfall for each year             
+    Called from RIOS. calculate the sum of all the monthly rainfall for each year. RIOS only reads the first
+    month (the reference grid), the window of each month is read here one at a time so a block only holds the
+    running total, the valid month count and one month whatever the number of months.
     """
     np.seterr(all='ignore')
     
-    nullValue  = otherargs.coverNull
-    # select the first band in the image.
-    index = 0
-    # read in the list of images for the given year and iterate over each pixel masking out the nodata values.
-    changeImg = np.array([img[0] for img in inputs.images])
-    maskechangeImg = ma.masked_array(changeImg,changeImg==0)   
-  
-    Total_rainfall = np.ma.sum(maskechangeImg, axis=0) # calucate the total rainfall for a given period output in mm 
+    # the window of the block in the monthly rainfall grids
+    col, row = info.getPixColRow(0, 0)
+    rows, cols = inputs.reference.shape[1:]
+    window = rasterio.windows.Window(col, row, cols, rows)
+    
+    # read the window of each month and add it to the running total
+    months = (read_month(img, otherargs.profile, window) for img in otherargs.images)
+    Total_rainfall = sum_months(months, otherargs.coverNull) # calucate the total rainfall for a given period output in mm 
+    
+    # output the total rainfall with the data type and nodata value of the output policy
+    outputs.stats=np.array([output_policy.encode(Total_rainfall, Total_rainfall == -1, 'total', otherargs.policy)])
+
+
+def round_total(Total_rainfall):
+    
+    """
+    round a total rainfall array (accumulated in float64) to the precision of the monthly rainfall grids, so the
+    totals do not depend on the order or path the months were added in (e.g. 16.99999 is 17.0 mm before it is 
+    truncated to whole mm by the compact output policy)
+    """
+    return np.round(Total_rainfall, TOTAL_DECIMALS)
+
+
+def invalid_month(month, nodata=None):
+    
+    """
+    returns a boolean array flagging the pixels of a monthly rainfall array that are nodata, i.e. equal to the 
+    nodata value, nan or negative. Zero rainfall is a valid value.
+    """
+    invalid = month < 0
+    
+    if nodata is not None and not np.isnan(nodata):
+        invalid |= month == nodata
+    
+    if np.issubdtype(month.dtype, np.floating):
+        invalid |= np.isnan(month)
+    
+    return invalid
+
+
+def sum_months(months, nodata=None):
+    
+    """
+    Add the monthly rainfall arrays into a float64 running total in the order they are supplied, one month at
+    a time so the memory used does not depend on the number of months (the months are read as they are
+    needed, e.g. a generator of read_month). The nodata pixels of each month (see invalid_month) are not added,
+    instead a count of the valid months is kept and any pixel without a valid value for every month is set to
+    the nodata value -1. The total is rounded with round_total.
+    """
+    Total_rainfall = None
+    
+    for month in months:
+        month = np.asarray(month)
+        
+        if Total_rainfall is None:
+            Total_rainfall = np.zeros(month.shape, dtype=np.float64)
+            valid_count = np.zeros(month.shape, dtype=np.uint16)
+            nmonths = 0
+        
+        valid = ~invalid_month(month, nodata)
+        np.add(Total_rainfall, month, out=Total_rainfall, where=valid, casting='unsafe')
+        valid_count += valid
+        nmonths += 1
+    
+    if Total_rainfall is None:
+        raise ValueError('no monthly rainfall grids were supplied')
+    
+    Total_rainfall = round_total(Total_rainfall)
+    
     # set the nodata value to -1
-    Total_rainfall[Total_rainfall < 0] = -1 
-    # output the total rainfall as a interger value
-    outputs.stats=np.array([Total_rainfall],dtype=np.int)     
+    Total_rainfall[valid_count < nmonths] = -1 
+    
+    return Total_rainfall
 
 
-def mainRoutine():
+def window_profile(profile, window):
+    
+    """
+    returns a copy of the rasterio profile for the window (a rasterio.windows.Window) of the grid
+    """
+    profile = profile.copy()
+    
+    if window is not None:
+        profile.update({'height': int(window.height), 'width': int(window.width),
+                        'transform': rasterio.windows.transform(window, profile['transform'])})
+    
+    return profile
 
-    """Run mainRoutine"""
 
-    cmdargs = getCmdargs()
+def read_month(img, profile, window=None):
     
-    imglist = cmdargs.imglist           
-    # create the output file name for the given year    
-    newf = cmdargs.output
-               
-    # create the list of  rainfall grids to calculate the total rainfall   
-    flat_list = readlist(imglist)
-    print (flat_list)
+    """
+    read the first band of a monthly rainfall grid (or a window of it) checking it is on the same grid as the profile
+    """
+    with rasterio.open(img) as src:
+        if (src.height, src.width) != (profile['height'], profile['width']) or src.transform != profile['transform']:
+            raise ValueError(img + ' is not on the same grid as the first monthly rainfall grid')
+        return src.read(1, window=window)
+
+
+def encode_total(Total_rainfall, profile, policy=output_policy.DEFAULT_POLICY):
+    
+    """
+    convert the total rainfall (with the nodata value -1) to the data type of the output policy and set the 
+    data type and nodata value of the rasterio profile
+    """
+    rule = output_policy.stage_policy('total', policy)
+    
+    profile = profile.copy()
+    profile.update({'driver': 'GTiff', 'count': 1, 'dtype': rule['dtype'], 'nodata': rule['nodata']})
+    
+    return output_policy.encode(Total_rainfall, Total_rainfall == -1, 'total', policy), profile
+
+
+def total_rainfall_array(flat_list, window=None, policy=output_policy.DEFAULT_POLICY):
+    
+    """
+    Calculate the total rainfall in memory by reading the monthly rainfall grids one at a time, optionally only 
+    reading a window (a rasterio.windows.Window) of the grids. Returns the total rainfall array and a rasterio 
+    profile with the data type and nodata value of the output policy.
+    """
+    with rasterio.open(flat_list[0]) as src:
+        profile = src.profile.copy()
+    
+    with run_report.stage('total', reads=flat_list):
+        Total_rainfall = sum_months((read_month(img, profile, window) for img in flat_list), profile['nodata'])
+    
+    return encode_total(Total_rainfall, window_profile(profile, window), policy)
+
+
+def total_rainfall_cube(cube, yearM_start, yearM_finish, allow_missing=False, policy=output_policy.DEFAULT_POLICY):
+    
+    """
+    Calculate the total rainfall in memory from the monthly rainfall cube between the start and finish year and 
+    month (inclusive). Missing months raise a rainfall_catalog.MissingMonthsError unless allow_missing is set. 
+    Returns the total rainfall array and a rasterio profile with the data type and nodata value of the output policy.
+    """
+    rainCube = monthly_rainfall_cube.MonthlyRainfallCube(cube)
+    
+    missing = rainCube.missing(yearM_start, yearM_finish)
+    if missing:
+        error = rainfall_catalog.MissingMonthsError(yearM_start, yearM_finish, missing)
+        if not allow_missing:
+            raise error
+        print ('warning: ' + str(error))
+    
+    Total_rainfall = sum_months(rainCube.iter_months(yearM_start, yearM_finish), rainCube.nodata)
+    
+    return encode_total(Total_rainfall, rainCube.profile(), policy)
+
+
+def prefix_sum_totals(dated_grids, seasons, window=None, policy=output_policy.DEFAULT_POLICY):
+    
+    """
+    Calculate the total rainfall for many seasons from a single pass over the monthly rainfall grids.
+    
+    dated_grids is a list of (month number, file name) tuples and seasons is a list of (key, start month number, 
+    finish month number) tuples, where the month number is year * 12 + month - 1. The grids are read once in date 
+    order while a running (prefix) sum and a running count of nodata months are kept for every pixel; the total 
+    for a season is the difference between the prefix sums after its finish month and before its start month. 
+    A pixel with a nodata month in the season is set to -1, as in sum_months.
+    
+    Yields a (key, total rainfall array, rasterio profile) tuple as each season is completed, seasons that
+    run past the end of the archive are yielded at the end with the months available. The totals are written 
+    with the output policy. If a window (a rasterio.windows.Window) is supplied only that part of the grids is read.
+    """
+    dated_grids = sorted(dated_grids)
+    pending = sorted(seasons, key=lambda season: season[1])
+    started = {}
+    
+    with rasterio.open(dated_grids[0][1]) as src:
+        grid_profile = src.profile.copy()
+    profile = window_profile(grid_profile, window)
+    
+    # float64 prefix sums so the differences are not affected by the size of the running total
+    prefix = np.zeros((profile['height'], profile['width']), dtype=np.float64)
+    prefix_nodata = np.zeros(prefix.shape, dtype=np.int32)
+    
+    def season_total(key):
+        start_prefix, start_nodata = started.pop(key)
+        Total_rainfall = round_total(prefix - start_prefix)
+        Total_rainfall[(prefix_nodata - start_nodata) > 0] = -1
+        return encode_total(Total_rainfall, profile, policy)
+    
+    finish_month = dict((key, finish) for key, start, finish in seasons)
+    
+    for month, img in dated_grids:
+        
+        # complete any season that finished before this month (i.e. its finish month is missing)
+        for key in [key for key in started if finish_month[key] < month]:
+            yield (key,) + season_total(key)
+        
+        # save the prefix sums before the first month of any season starting at (or before) this month
+        while pending and pending[0][1] <= month:
+            key, start, finish = pending.pop(0)
+            if finish >= month:
+                started[key] = (prefix.copy(), prefix_nodata.copy())
+        
+        data = read_month(img, grid_profile, window)
+        
+        # nodata months are counted rather than added so they do not carry into later seasons
+        nodata = invalid_month(data, grid_profile['nodata'])
+        prefix += np.where(nodata, 0, data)
+        prefix_nodata += nodata
+        
+        for key in [key for key in started if finish_month[key] == month]:
+            yield (key,) + season_total(key)
+    
+    # seasons that run past the last available month
+    for key in list(started):
+        print (key + ' only includes the monthly rainfall grids up to the end of the archive')
+        yield (key,) + season_total(key)
+
+
+def calc_total_rainfall(flat_list, newf, policy=output_policy.DEFAULT_POLICY, memory_mb=block_plan.DEFAULT_MEMORY_MB):
+    
+    """
+    Calculate the total rainfall with RIOS for the list of monthly rainfall grids and write it to newf using 
+    the data type and nodata value of the output policy. The window size is chosen from the memory budget 
+    (see block_plan.py).
+    """
     #Set up rios to apply images
     controls = applier.ApplierControls()
     infiles = applier.FilenameAssociations()
     outfiles = applier.FilenameAssociations()
     
-    # read in the list of imagery to calculate the mean
-    infiles.images = flat_list 
+    # only the first month is read by RIOS (as the reference grid), dostats reads the window of every month
+    infiles.reference = flat_list[0]
     otherargs = applier.OtherInputs()
-    imginfo = fileinfo.ImageInfo(infiles.images[0])
+    otherargs.images = flat_list
+    imginfo = fileinfo.ImageInfo(infiles.reference)
+    with rasterio.open(flat_list[0]) as src:
+        otherargs.profile = src.profile.copy()
     # set up the nodata values
     otherargs.coverNull = imginfo.nodataval[0]
+    otherargs.policy = policy
     print (otherargs.coverNull)
-    controls.setStatsIgnore(otherargs.coverNull)
+    outNull = output_policy.stage_policy('total', policy)['nodata']
+    controls.setStatsIgnore(outNull)
+    # a block holds the reference grid and the month being added (dostats reads the months one at a time), 
+    # the float64 total and valid count are part of the per pixel working arrays
+    block_plan.set_windows(controls, block_plan.image_plan(flat_list[0], 2, memory_mb))
         
     outfiles.stats = newf
     
-    applier.apply(dostats, infiles, outfiles, otherargs, controls=controls)
+    with run_report.stage('total', reads=flat_list, writes=[newf]):
+        applier.apply(dostats, infiles, outfiles, otherargs, controls=controls)
         
     print (newf + ' is complete')
     
@@ -105,7 +331,36 @@ def mainRoutine():
     when it is open in arcmap or qgis it recognises the new values"""
     
     newImg = gdal.Open(newf, gdal.GA_Update)
-    newImg.GetRasterBand(1).SetNoDataValue(-1)
+    newImg.GetRasterBand(1).SetNoDataValue(outNull)
+    newImg = None
+    
+    output_policy.convert_to_cog(newf, 'total')
+
+
+def mainRoutine():
+
+    """Run mainRoutine"""
+
+    cmdargs = getCmdargs()
+    
+    with run_report.session(cmdargs.report, cmdargs.profile):
+        imglist = cmdargs.imglist           
+        # create the output file name for the given year    
+        newf = cmdargs.output
+    
+        if cmdargs.cube is not None:
+            # read the months directly from the monthly rainfall cube
+            Total_rainfall, profile = total_rainfall_cube(cmdargs.cube, cmdargs.start, cmdargs.finish, policy=cmdargs.policy)
+            with rasterio.open(newf, 'w', **output_policy.cog_profile(profile, 'total')) as dst:
+                dst.write(Total_rainfall, 1)
+            print (newf + ' is complete')
+            return
+               
+        # create the list of  rainfall grids to calculate the total rainfall   
+        flat_list = readlist(imglist)
+        print (flat_list)
+    
+        calc_total_rainfall(flat_list, newf, cmdargs.policy, cmdargs.memory)
     
 if __name__ == "__main__":
     mainRoutine()
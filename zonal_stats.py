@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+This script calculates zonal statistics of the seasonal rainfall, percentile and decile rasters for every region of a
+polygon layer (e.g. pastoral districts, bioregions or properties). The regions are rasterized once for each grid and
+the statistics of every raster are accumulated region by region with bincount in a single pass over strips of rows,
+so any number of rasters (e.g. the full seasonal archive) can be summarised without holding them in memory.
+
+The output is a tidy table (one row per raster and region, or per raster, region and class) written as a csv or,
+if the output file name ends in .parquet, a parquet file (requires pyarrow).
+
+There are two types of statistics;
+
+stats   : the number of valid pixels, area (km2), mean, standard deviation, minimum and maximum of each region
+          (e.g. the mean seasonal total rainfall).
+classes : the number of pixels, area (km2), percent and cumulative percent of each region in every class of an
+          integer raster (e.g. the area in each decile class, the cumulative percent at decile 2 is the percent
+          of the region below decile 3). Every class of the scheme is reported for every region, classes without 
+          any pixels in the region have a count of 0 and carry the cumulative percent forward.
+
+Parameters:
+-----------
+
+img : str
+            is a directory path and name of the raster image to summarise.
+
+imglist : str
+            is a string to name of the txt file or csv file containing a list of raster images to summarise (instead of img).
+
+regions : str
+            is the polygon shapefile (in the same projection as the rasters) containing the regions.
+
+field : str
+            is the attribute used to name the regions (e.g. DISTRICT), the default is the feature id.
+
+output : str
+            is the output csv (or .parquet) file name.
+
+classes : bool
+            if set the area of each region in every class is calculated instead of the summary statistics.
+
+scheme : int int
+            is the first and last class of the class scheme (e.g. 1 10 for deciles), the default is every class 
+            from the lowest to the highest class in the raster.
+
+"""
+
+from __future__ import print_function, division
+import sys
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.features
+import rasterio.windows
+import clip_raster_regions
+import percentile_rank
+
+# number of rows read from the rasters at a time
+STRIP_ROWS = 256
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("-i","--img", help="raster image to summarise")
+
+    p.add_argument("-l","--imglist", help="list of raster images to summarise, should be a pandas df without a header")
+
+    p.add_argument("-r","--regions", help="polygon shapefile containing the regions")
+
+    p.add_argument("-f","--field", help="attribute used to name the regions (default the feature id)")
+
+    p.add_argument("-o","--output", help="output csv (or .parquet) file name")
+
+    p.add_argument("-c","--classes", action="store_true", help="calculate the area of each region in every class of an integer raster (e.g. deciles)")
+
+    p.add_argument("-s","--scheme", type=int, nargs=2, metavar=('FIRST', 'LAST'), help="first and last class of the class scheme (default the classes in the raster)")
+
+    cmdargs = p.parse_args()
+
+    if (cmdargs.img is None and cmdargs.imglist is None) or cmdargs.regions is None or cmdargs.output is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+class RegionLabels(object):
+
+    """
+    The regions rasterized to a label array for each grid the rasters are on (label 0 is outside all the
+    regions, region i has the label i + 1, overlapping regions take the last label). Each grid is only
+    rasterized once so every raster on the same grid shares the labels.
+    """
+
+    def __init__(self, shapes, names):
+
+        self.shapes = shapes
+        self.names = names
+        self.labels = {}
+
+    def get(self, transform, width, height):
+
+        key = (tuple(transform)[:6], width, height)
+
+        if key not in self.labels:
+            self.labels[key] = rasterio.features.rasterize(((shape, i + 1) for i, shape in enumerate(self.shapes)),
+                                                           out_shape=(height, width), transform=transform, fill=0, dtype='int32')
+
+        return self.labels[key]
+
+
+def pixel_area_km2(transform):
+
+    return abs(transform.a * transform.e - transform.b * transform.d) / 1e6
+
+
+def accumulate_stats(img, regions):
+
+    """
+    Accumulate the count, sum, sum of squares, minimum and maximum of the valid pixels in each region of the
+    raster, reading one strip of rows at a time. Returns a data frame with one row per region.
+    """
+    n = len(regions.names) + 1
+
+    count = np.zeros(n, dtype=np.int64)
+    total = np.zeros(n, dtype=np.float64)
+    squares = np.zeros(n, dtype=np.float64)
+    minimum = np.full(n, np.inf)
+    maximum = np.full(n, -np.inf)
+
+    with rasterio.open(img) as src:
+        labels = regions.get(src.transform, src.width, src.height)
+        nodata = src.nodata
+        area = pixel_area_km2(src.transform)
+        # the statistics of scaled rasters (e.g. the uint16 percentile score, see output_policy.py) are in their units
+        scale = src.scales[0]
+
+        for row in range(0, src.height, STRIP_ROWS):
+            nrows = min(STRIP_ROWS, src.height - row)
+            zone = labels[row:row + nrows]
+
+            # skip strips outside all the regions
+            if not zone.any():
+                continue
+
+            data = src.read(1, window=rasterio.windows.Window(0, row, src.width, nrows)).astype(np.float64)
+            valid = (zone > 0) & percentile_rank.valid_mask(data, nodata) & ~np.isnan(data)
+
+            z = zone[valid]
+            v = data[valid] * scale
+
+            count += np.bincount(z, minlength=n)
+            total += np.bincount(z, weights=v, minlength=n)
+            squares += np.bincount(z, weights=v * v, minlength=n)
+            np.minimum.at(minimum, z, v)
+            np.maximum.at(maximum, z, v)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum(squares / count - mean * mean, 0))
+
+    stats = pd.DataFrame({'image': os.path.basename(img),
+                          'region': regions.names,
+                          'count': count[1:],
+                          'area_km2': count[1:] * area,
+                          'mean': mean[1:],
+                          'std': std[1:],
+                          'min': np.where(count[1:] > 0, minimum[1:], np.nan),
+                          'max': np.where(count[1:] > 0, maximum[1:], np.nan)})
+
+    return stats
+
+
+def accumulate_classes(img, regions, scheme=None):
+
+    """
+    Accumulate the number of valid pixels of every class (integer value) in each region of the raster, reading
+    one strip of rows at a time. scheme is the (first, last) class of the class scheme, by default every class
+    from the lowest to the highest class in the raster. Returns a data frame with one row per region (with
+    valid pixels) and class of the scheme, so the classes line up across the regions.
+    """
+    n = len(regions.names) + 1
+    counts = {}
+
+    with rasterio.open(img) as src:
+        labels = regions.get(src.transform, src.width, src.height)
+        nodata = src.nodata
+        area = pixel_area_km2(src.transform)
+
+        for row in range(0, src.height, STRIP_ROWS):
+            nrows = min(STRIP_ROWS, src.height - row)
+            zone = labels[row:row + nrows]
+
+            if not zone.any():
+                continue
+
+            data = src.read(1, window=rasterio.windows.Window(0, row, src.width, nrows))
+            valid = (zone > 0) & percentile_rank.valid_mask(data, nodata)
+
+            z = zone[valid].astype(np.int64)
+            v = data[valid].astype(np.int64)
+
+            if v.size == 0:
+                continue
+
+            # a single bincount over the combined (region, class) index
+            low = v.min()
+            nclass = int(v.max() - low) + 1
+            combined = np.bincount(z * nclass + (v - low), minlength=n * nclass).reshape(n, nclass)
+
+            for c in np.flatnonzero(combined.sum(axis=0)):
+                counts[low + c] = counts.get(low + c, np.zeros(n, dtype=np.int64)) + combined[:, c]
+
+    if scheme is not None:
+        outside = sorted(c for c in counts if not scheme[0] <= c <= scheme[1])
+        if outside:
+            print ('warning: ' + img + ' has classes outside the scheme ' + str(scheme[0]) + ' to ' + str(scheme[1]) + ': ' + ', '.join(str(c) for c in outside))
+        classes = list(range(scheme[0], scheme[1] + 1))
+    elif counts:
+        classes = list(range(min(counts), max(counts) + 1))
+    else:
+        classes = []
+
+    if not classes:
+        return pd.DataFrame(columns=['image', 'region', 'class', 'count', 'area_km2', 'percent', 'cumulative_percent'])
+
+    empty = np.zeros(n, dtype=np.int64)
+    table = np.stack([counts.get(c, empty) for c in classes], axis=1)[1:]
+    region_total = table.sum(axis=1, keepdims=True)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        percent = table * 100.0 / region_total
+    cumulative = np.cumsum(percent, axis=1)
+
+    # every class of the scheme for the regions with valid pixels
+    regionIndex, classIndex = np.nonzero(np.broadcast_to(region_total > 0, table.shape))
+
+    return pd.DataFrame({'image': os.path.basename(img),
+                         'region': np.array(regions.names, dtype=object)[regionIndex],
+                         'class': np.array(classes)[classIndex],
+                         'count': table[regionIndex, classIndex],
+                         'area_km2': table[regionIndex, classIndex] * area,
+                         'percent': percent[regionIndex, classIndex],
+                         'cumulative_percent': cumulative[regionIndex, classIndex]})
+
+
+def zonal_stats(listimg, inshp, field=None, classes=False, scheme=None):
+
+    """
+    Calculate the zonal statistics (or class areas of the class scheme) of every raster in the list for the
+    regions in the shapefile. Returns a tidy data frame.
+    """
+    shapes, names, index = clip_raster_regions.read_regions(inshp, field)
+    regions = RegionLabels(shapes, names)
+
+    tables = []
+    for img in listimg:
+        if classes:
+            tables.append(accumulate_classes(img, regions, scheme))
+        else:
+            tables.append(accumulate_stats(img, regions))
+        print (img + ' has been summarised for ' + str(len(names)) + ' regions')
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def write_table(table, output):
+
+    """
+    write the table as a parquet file if the output file name ends in .parquet, otherwise as a csv
+    """
+    if output.endswith('.parquet'):
+        table.to_parquet(output, index=False)
+    else:
+        table.to_csv(output, index=False)
+
+    print (output + ' is complete')
+
+
+def mainRoutine():
+
+    """Run mainRoutine"""
+
+    cmdargs = getCmdargs()
+
+    if cmdargs.imglist is not None:
+        df = pd.read_csv(cmdargs.imglist, header=None)
+        listimg = df[0].values.tolist()
+    else:
+        listimg = [cmdargs.img]
+
+    table = zonal_stats(listimg, cmdargs.regions, cmdargs.field, cmdargs.classes, cmdargs.scheme)
+
+    write_table(table, cmdargs.output)
+
+
+if __name__ == "__main__":
+    mainRoutine()